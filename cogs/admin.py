@@ -1,5 +1,8 @@
 import discord
 from discord.ext import commands
+from models.context_cache import gemini_context_cache
+from models.providers.google.utils import agent_loop_stats, upload_cache_stats
+from tools.result_cache import tool_result_cache
 
 class Admin(commands.Cog):
     def __init__(self, bot):
@@ -13,6 +16,36 @@ class Admin(commands.Cog):
         await ctx.send("Shutting down...")
         await self.bot.close()
 
+    # Settings cache statistics
+    @commands.command(aliases=['cachestats'])
+    @commands.is_owner()
+    async def admin_cache_stats(self, ctx):
+        """Shows the user settings, file upload, context cache, agent loop, tool result and HTTP cache statistics"""
+        _chat_cog = self.bot.get_cog("Chat")
+        if not _chat_cog:
+            await ctx.send("⚠️ Chat features are not loaded")
+            return
+
+        _stats = _chat_cog.DBConn.cache_stats()
+        await ctx.send("### User settings\n" + "\n".join(f"- **{_key}**: `{_value}`" for _key, _value in _stats.items()))
+
+        _stats = upload_cache_stats()
+        await ctx.send("### Gemini file uploads\n" + "\n".join(f"- **{_key}**: `{_value}`" for _key, _value in _stats.items()))
+
+        _stats = gemini_context_cache.stats()
+        await ctx.send("### Gemini context caches\n" + "\n".join(f"- **{_key}**: `{_value}`" for _key, _value in _stats.items()))
+
+        _stats = agent_loop_stats()
+        await ctx.send("### Gemini agent loop\n" + "\n".join(f"- **{_key}**: `{_value}`" for _key, _value in _stats.items()))
+
+        _stats = tool_result_cache.stats()
+        await ctx.send("### Tool results\n" + "\n".join(f"- **{_key}**: `{_value}`" for _key, _value in _stats.items()))
+
+        # Only when the HTTP cache is enabled
+        if hasattr(self.bot.aiohttp_instance, "stats"):
+            _stats = self.bot.aiohttp_instance.stats()
+            await ctx.send("### HTTP cache\n" + "\n".join(f"- **{_key}**: `{_value}`" for _key, _value in _stats.items()))
+
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
         if isinstance(error, commands.NotOwner):
             await ctx.respond("❌ Sorry, only the owner can use this command.")
@@ -3,7 +3,8 @@ from core.database import History
 from core.exceptions import *
 from discord.commands import SlashCommandGroup
 from discord.ext import commands
-from models.chat_utils import fetch_model
+from models.chat_utils import fetch_model, file_expiry_janitor
+from models.config import is_allowed
 from os import environ
 from tools.utils import fetch_actual_tool_name
 import discord
@@ -16,14 +17,18 @@ class Chat(commands.Cog):
         self.bot: discord.Bot = bot
         self.author = environ.get("BOT_NAME", "Jakey Bot")
 
-        # Initialize the MongoDB connection and History management
+        # Initialize the database connection and History management
+        # The backend is selected with HISTORY_BACKEND, defaults to MongoDB
         try:
             self.DBConn: History = History(
                 bot=bot,
                 conn_string=environ.get("MONGO_DB_URL")
             )
         except Exception as e:
-            raise e(f"Failed to connect to MongoDB: {e}...\n\nPlease set MONGO_DB_URL in dev.env")
+            raise e(f"Failed to connect to the database: {e}...\n\nPlease set MONGO_DB_URL or HISTORY_BACKEND in dev.env")
+
+        # Expose to the bot so it can be closed on shutdown
+        self.bot.history_db = self.DBConn
 
         # Configure cooldown
         self._cooldown = commands.CooldownMapping.from_cooldown(2, 25, commands.BucketType.user)
@@ -31,6 +36,12 @@ class Chat(commands.Cog):
         # Initialize the chat system
         self._ask_event = BaseChat(bot, self.author, self.DBConn)
 
+        # Clear expired files from stored chat threads in the background
+        self._file_janitor = bot.loop.create_task(file_expiry_janitor(self.DBConn))
+
+    def cog_unload(self):
+        self._file_janitor.cancel()
+
     #######################################################
     # Pending request checker, prevents running multiple requests concurrently
     #######################################################
@@ -85,7 +96,7 @@ class Chat(commands.Cog):
     @discord.option(
         "model",
         description="Choose default model for the conversation",
-        autocomplete=discord.utils.basic_autocomplete(models.core.get_chat_models_autocomplete),
+        autocomplete=models.core.get_chat_models_autocomplete,
         required=True
     )
     async def set(self, ctx, model: str):
@@ -95,6 +106,11 @@ class Chat(commands.Cog):
         # Check if inference is in progress
         await self._check_awaiting_response_in_progress(ctx.author.id)
 
+        # Check if the model is allowed in this server
+        if not is_allowed(ctx.guild_id, "models", model):
+            await ctx.respond("⚠️ This model is not available in this server, please choose another model.")
+            return
+
         # Save the default model in the database
         # await self.DBConn.set_default_model(guild_id=ctx.author.id, model=model)
         await self.DBConn.set_key(guild_id=ctx.author.id, key="default_model", value=model)
@@ -134,16 +150,12 @@ class Chat(commands.Cog):
         # Check if inference is in progress
         await self._check_awaiting_response_in_progress(ctx.author.id)
 
-        # Set the default OpenRouter model and clear the OpenRouter chat thread
-        await self.DBConn.set_key(guild_id=ctx.author.id, key="default_openrouter_model", value=model)
-        _setkeymodel = await self.DBConn.get_key(guild_id=ctx.author.id, key="default_openrouter_model")
-
-        # Clear ongoing conversations
-        await self.DBConn.set_key(guild_id=ctx.author.id, key="chat_thread_openrouter", value=None)
+        # Set the default OpenRouter model and clear the OpenRouter chat thread in one write
+        await self.DBConn.clear_thread(guild_id=ctx.author.id, thread="openrouter", values={"default_openrouter_model": model})
 
         # Respond
         await ctx.respond(
-            f"✅ Default OpenRouter model set to **{_setkeymodel}** and chat history for OpenRouter chats are cleared!\n"
+            f"✅ Default OpenRouter model set to **{model}** and chat history for OpenRouter chats are cleared!\n"
             "To use this model, please set the model to OpenRouter using `/model set` command"
         )
 
@@ -171,21 +183,13 @@ class Chat(commands.Cog):
                 await ctx.respond("🚫 This command can only be used in DMs or authorized guilds!")
                 return
 
-        # Save current settings before clearing history
-        _agent = await self.DBConn.get_key(guild_id=ctx.author.id, key="tool_use")
-        _model = await self.DBConn.get_key(guild_id=ctx.author.id, key="default_model")
-        _openrouter_model = await self.DBConn.get_key(guild_id=ctx.author.id, key="default_openrouter_model")
-
-        # Clear chat history
-        await self.DBConn.clear_history(guild_id=ctx.author.id)
-
         if not reset_prefs:
-            # Restore settings if not resetting preferences
-            await self.DBConn.set_key(guild_id=ctx.author.id, key="tool_use", value=_agent)
-            await self.DBConn.set_key(guild_id=ctx.author.id, key="default_model", value=_model)
-            await self.DBConn.set_key(guild_id=ctx.author.id, key="default_openrouter_model", value=_openrouter_model)
+            # Clear chat threads but keep the model and agent settings
+            await self.DBConn.reset_threads(guild_id=ctx.author.id)
             await ctx.respond("✅ Chat history reset!")
         else:
+            # Clear chat history
+            await self.DBConn.clear_history(guild_id=ctx.author.id)
             await ctx.respond("✅ Chat history reset, model and agent settings are cleared!")
 
 
@@ -215,10 +219,8 @@ class Chat(commands.Cog):
                 await ctx.respond("🚫 This command can only be used in DMs or authorized guilds!")
                 return
 
-        # Retrieve current settings
+        # Retrieve current agent
         _current_agent = await self.DBConn.get_key(guild_id=ctx.author.id, key="tool_use")
-        _model = await self.DBConn.get_key(guild_id=ctx.author.id, key="default_model")
-        _openrouter_model = await self.DBConn.get_key(guild_id=ctx.author.id, key="default_openrouter_model")
 
         # Convert "disabled" to None
         if name == "disabled":
@@ -227,14 +229,12 @@ class Chat(commands.Cog):
         if _current_agent == name:
             await ctx.respond("✅ Agent already set!")
         else:
-            # Clear chat history IF the agent is not set to None
+            # Clear chat threads IF the agent is not set to None and set the new agent name
+            # Model preferences are kept as-is
             if _current_agent:
-                await self.DBConn.clear_history(guild_id=ctx.author.id)
-
-            # Set new agent name and restore default model
-            await self.DBConn.set_key(guild_id=ctx.author.id, key="tool_use", value=name)
-            await self.DBConn.set_key(guild_id=ctx.author.id, key="default_model", value=_model)
-            await self.DBConn.set_key(guild_id=ctx.author.id, key="default_openrouter_model", value=_openrouter_model)
+                await self.DBConn.reset_threads(guild_id=ctx.author.id, values={"tool_use": name})
+            else:
+                await self.DBConn.set_key(guild_id=ctx.author.id, key="tool_use", value=name)
 
             if name is None:
                 await ctx.respond("✅ Agents disabled and chat is reset to reflect the changes")
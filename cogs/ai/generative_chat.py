@@ -3,17 +3,25 @@ from core.database import History as typehint_History
 from discord import Message
 from models.core import set_assistant_type
 from models.chat_utils import fetch_model, load_history, save_history
+from models.compaction import schedule_compaction
 
 # TODO: use importlib
 from models.providers.openai.completion import ChatSession as CSOpenAITypeHint
 
 from os import environ
+import asyncio
 import discord
 import importlib
 import inspect
 import logging
 import re
 
+# Number of attachments in a message that are processed at the same time
+CHAT_ATTACHMENT_CONCURRENCY = max(int(environ.get("CHAT_ATTACHMENT_CONCURRENCY", 4)), 1)
+
+# Minimum seconds between edits of the attachment progress message
+CHAT_PROGRESS_EDIT_INTERVAL = float(environ.get("CHAT_PROGRESS_EDIT_INTERVAL", 1.5))
+
 class BaseChat():
     def __init__(self, bot, author, history: typehint_History):
         self.bot: discord.Bot = bot
@@ -23,19 +31,95 @@ class BaseChat():
         # This is to ensure they don't perform inference concurrently
         self.pending_ids = []
 
+    ###############################################
+    # Attachments
+    ###############################################
+    # Processes attachments concurrently and returns the prompt parts in the same order as the attachments
+    # A failed attachment is skipped and reported without aborting the rest
+    async def _process_attachments(self, prompt: Message, chat_session) -> list:
+        _semaphore = asyncio.Semaphore(CHAT_ATTACHMENT_CONCURRENCY)
+        _progress_changed = asyncio.Event()
+        _processed = 0
+        _failed = []
+
+        async def _ingest(attachment: discord.Attachment) -> list:
+            nonlocal _processed
+
+            # Check for alt text
+            _extraMetadata = inspect.cleandoc(
+                f"""
+                <meta>
+                this is system-inserted additional metadata (for additional context about this file, but focus on the file contents itself)
+                filename: {attachment.filename}
+                alt: {attachment.description if attachment.description else None}
+                url: {attachment.url}
+                </meta>
+                """)
+
+            async with _semaphore:
+                try:
+                    return await chat_session.upload_files(attachment=attachment, extra_metadata=_extraMetadata)
+                except Exception as _error:
+                    logging.error("Failed to process attachment %s, skipping it", attachment.filename, exc_info=True)
+                    _failed.append((attachment.filename, _error))
+                    return []
+                finally:
+                    _processed += 1
+                    _progress_changed.set()
+
+        # Progress edits are coalesced so a message with many attachments doesn't hit the rate limit
+        async def _report_progress():
+            while True:
+                await _progress_changed.wait()
+                _progress_changed.clear()
+                try:
+                    await _processFileInterstitial.edit(f"⬆️ Processing: **{_processed}/{len(prompt.attachments)}** file(s)...")
+                except discord.HTTPException:
+                    logging.warning("Failed to update the attachment progress message", exc_info=True)
+                await asyncio.sleep(CHAT_PROGRESS_EDIT_INTERVAL)
+
+        _processFileInterstitial = await prompt.channel.send("⬆️ Please wait...")
+        _reporter = asyncio.create_task(_report_progress())
+        try:
+            _results = await asyncio.gather(*(_ingest(_attachment) for _attachment in prompt.attachments))
+        finally:
+            _reporter.cancel()
+
+        _added = len(prompt.attachments) - len(_failed)
+        if not _added:
+            await _processFileInterstitial.delete()
+
+            # Keep the reason when it's meant for the user such as unsupported file types
+            _error = _failed[0][1]
+            if isinstance(_error, CustomErrorMessage):
+                raise _error
+            raise CustomErrorMessage("⚠️ None of the attachments could be processed, please try again later")
+
+        _status = f"✅ Added: **{_added}** file(s)"
+        if _failed:
+            _skipped = ", ".join(f"`{_filename}`" for _filename, _ in _failed)
+            _status += f"\n> -# ⚠️ Skipped {len(_failed)} file(s) that couldn't be processed: {_skipped[:1500]}"
+        await _processFileInterstitial.edit(_status)
+
+        return [_part for _parts in _results for _part in _parts]
+
     ###############################################
     # Events-based chat
     ###############################################
     async def _ask(self, prompt: Message):
+        # Fetch user settings in a single read
+        _user_settings = await self.DBConn.get_many(guild_id=prompt.author.id, keys=["default_model", "tool_use"])
+
         # Set default model
-        _model_props = await fetch_model(model_alias=(await self.DBConn.get_key(guild_id=prompt.author.id, key="default_model")) or environ.get("DEFAULT_MODEL", "openai::gpt-4.1-mini"))
+        _model_props = await fetch_model(model_alias=_user_settings["default_model"] or environ.get("DEFAULT_MODEL", "openai::gpt-4.1-mini"))
         _chat_session: CSOpenAITypeHint = importlib.import_module(f"models.providers.{_model_props.sdk}.completion").ChatSession(
             user_id=prompt.author.id,
             model_props=_model_props,
             discord_bot=self.bot,
             discord_message=prompt,
             db_conn=self.DBConn,
-            client_name=_model_props.client_name
+            client_name=_model_props.client_name,
+            user_settings=_user_settings
         )
 
         # Check if "thread_name" is set in model props so we can separate chat threads
@@ -46,7 +130,7 @@ class BaseChat():
 
         # Check if we need to load history by checking enable_threads prop
         if _model_props.enable_threads:
-            _chat_history = await load_history(user_id=prompt.author.id, thread_name=_thread_name, db_conn=self.DBConn)
+            _chat_history = await load_history(user_id=prompt.author.id, thread_name=_thread_name, db_conn=self.DBConn, sdk=_model_props.sdk)
 
             # Check for /chat:ephemeral only if enable_threads is true
             if not "/chat:ephemeral" in prompt.content:
@@ -69,24 +153,7 @@ class BaseChat():
         async with prompt.channel.typing():
             if prompt.attachments:
                 if _model_props.enable_files:
-                    _uploadedFilesCount = 0
-                    _processFileInterstitial = await prompt.channel.send("⬆️ Please wait...")
-                    for _attachment in prompt.attachments:
-                        # Check for alt text
-                        _extraMetadata = inspect.cleandoc(
-                            f"""
-                            <meta>
-                            this is system-inserted additional metadata (for additional context about this file, but focus on the file contents itself)
-                            filename: {_attachment.filename}
-                            alt: {_attachment.description if _attachment.description else None}
-                            url: {_attachment.url}
-                            </meta>
-                            """)
-                        await _chat_session.upload_files(attachment=_attachment, extra_metadata=_extraMetadata)
-                        
-                        # Update status
-                        _uploadedFilesCount += 1
-                        await _processFileInterstitial.edit(f"✅ Added: **{_uploadedFilesCount}** file(s)...")
+                    _chat_session.uploaded_files = await self._process_attachments(prompt, _chat_session)
                 else:
                     raise CustomErrorMessage("⚠️ This model doesn't support file attachments, please choose another model to continue")
 
@@ -116,7 +183,18 @@ class BaseChat():
                 user_id=prompt.author.id,
                 thread_name=_thread_name,
                 chat_thread=_result,
-                db_conn=self.DBConn
+                db_conn=self.DBConn,
+                sdk=_model_props.sdk
+            )
+
+            # Summarize old turns in the background when the thread gets too long
+            schedule_compaction(
+                user_id=prompt.author.id,
+                thread_name=_thread_name,
+                sdk=_model_props.sdk,
+                chat_thread=_result,
+                db_conn=self.DBConn,
+                discord_bot=self.bot
             )
 
     async def on_message(self, message: Message):
@@ -1,4 +1,5 @@
 from models.core import set_assistant_type
+from models.config import is_allowed
 from discord.ext import commands
 from os import environ
 import aiofiles
@@ -60,7 +61,7 @@ class AISummaries(commands.Cog):
     @discord.option(
         "model",
         description="Select model to be used for summarization",
-        autocomplete=discord.utils.basic_autocomplete(models.tasks.text_model_utils.get_text_models_async_autocomplete),
+        autocomplete=models.tasks.text_model_utils.get_text_models_async_autocomplete,
         default=None
     )
     @commands.cooldown(2, 60, commands.BucketType.user)
@@ -81,6 +82,11 @@ class AISummaries(commands.Cog):
         if around_date is not None:
             around_date = datetime.datetime.strptime(around_date, '%m/%d/%Y')
 
+        # Check if the model is allowed in this server
+        if model and not is_allowed(ctx.guild_id, "text_models", model):
+            await ctx.respond("⚠️ This model is not available in this server, please choose another model.")
+            return
+
         # Fetch default model
         _default_model_config = await models.tasks.text_model_utils.fetch_text_model_config_async(override_model_id=model)
 
@@ -0,0 +1,87 @@
+import discord
+
+# Discord shows at most 25 choices and 100 characters per choice name
+AUTOCOMPLETE_MAX_CHOICES = 25
+AUTOCOMPLETE_MAX_NAME_LENGTH = 100
+
+# Prefixes longer than this are matched by scanning instead of the index
+AUTOCOMPLETE_MAX_PREFIX_LENGTH = 24
+
+# Prebuilt index for slash command autocomplete, built once when the choices change
+# Matches are ranked by: prefix of a whole term (e.g. the alias), prefix of any word, substring
+# and when nothing matched, a fuzzy match where the typed characters appear in order, ties keep the original order
+class AutocompleteIndex:
+    # entries are (value, name, terms) where terms are the strings that are searched
+    def __init__(self, entries):
+        self._values = []
+        self._choices = []
+        self._haystacks = []
+        self._term_prefixes = {}
+        self._word_prefixes = {}
+
+        for _index, (_value, _name, _terms) in enumerate(entries):
+            _terms = [_term.lower() for _term in _terms if _term]
+            self._values.append(_value)
+            self._choices.append(discord.OptionChoice(_name[:AUTOCOMPLETE_MAX_NAME_LENGTH], _value))
+            self._haystacks.append("\n".join(_terms))
+
+            for _term in _terms:
+                self._add_prefixes(self._term_prefixes, _term, _index)
+                for _word in _term.split():
+                    self._add_prefixes(self._word_prefixes, _word, _index)
+
+        # Sorted so matches keep the original order
+        self._term_prefixes = {_prefix: sorted(_indexes) for _prefix, _indexes in self._term_prefixes.items()}
+        self._word_prefixes = {_prefix: sorted(_indexes) for _prefix, _indexes in self._word_prefixes.items()}
+
+    def __len__(self):
+        return len(self._choices)
+
+    @staticmethod
+    def _add_prefixes(prefixes: dict, word: str, index: int):
+        for _length in range(1, min(len(word), AUTOCOMPLETE_MAX_PREFIX_LENGTH) + 1):
+            prefixes.setdefault(word[:_length], set()).add(index)
+
+    @staticmethod
+    def _is_subsequence(query: str, haystack: str) -> bool:
+        _chars = iter(haystack)
+        return all(_char in _chars for _char in query)
+
+    # Returns up to limit choices matching the query, allowed optionally restricts the values returned
+    def search(self, query: str = None, allowed=None, limit: int = AUTOCOMPLETE_MAX_CHOICES) -> list:
+        _query = (query or "").strip().lower()
+        _results = []
+        _seen = set()
+
+        def _collect(indexes) -> bool:
+            for _index in indexes:
+                if _index in _seen or (allowed is not None and self._values[_index] not in allowed):
+                    continue
+                _seen.add(_index)
+                _results.append(self._choices[_index])
+                if len(_results) >= limit:
+                    return True
+            return False
+
+        if not _query:
+            _collect(range(len(self._choices)))
+            return _results
+
+        if len(_query) <= AUTOCOMPLETE_MAX_PREFIX_LENGTH:
+            if _collect(self._term_prefixes.get(_query, ())) or _collect(self._word_prefixes.get(_query, ())):
+                return _results
+        else:
+            _long_matches = [
+                _index for _index, _haystack in enumerate(self._haystacks)
+                if any(_word.startswith(_query) for _word in _haystack.split("\n") + _haystack.split())
+            ]
+            if _collect(_long_matches):
+                return _results
+
+        if _collect(_index for _index, _haystack in enumerate(self._haystacks) if _query in _haystack):
+            return _results
+
+        # Fuzzy matches are loose, only use them when nothing else matched
+        if not _results:
+            _collect(_index for _index, _haystack in enumerate(self._haystacks) if self._is_subsequence(_query, _haystack))
+        return _results
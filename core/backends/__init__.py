@@ -0,0 +1,16 @@
+from .base import HistoryBackend
+import importlib
+
+# Backends are imported lazily so optional dependencies are only required when selected
+def create_backend(name: str, **kwargs) -> HistoryBackend:
+    try:
+        _module = importlib.import_module(f"core.backends.{name}")
+    except ModuleNotFoundError as e:
+        raise ValueError(f"History backend {name} is not available: {e}")
+
+    return _module.Backend(**kwargs)
+
+__all__ = [
+    "HistoryBackend",
+    "create_backend"
+]
@@ -0,0 +1,92 @@
+# Storage interface used by core.database.History
+# Implementations live in core/backends/<name>.py as a class named Backend
+# guild_id and thread arguments are already validated by History
+class HistoryBackend:
+    # Connect, create tables or indexes
+    async def start(self) -> None:
+        pass
+
+    # Flush pending writes and close connections
+    async def close(self) -> None:
+        pass
+
+    # Calls invalidate(guild_id) whenever a document is changed by another process
+    # Backends that can't be shared across processes don't need to implement this
+    async def watch(self, invalidate) -> None:
+        pass
+
+    ###############################################
+    # Settings document
+    ###############################################
+    # Returns only the keys present in the document
+    async def get_fields(self, guild_id: str, keys: list) -> dict:
+        raise NotImplementedError
+
+    async def set_fields(self, guild_id: str, values: dict) -> None:
+        raise NotImplementedError
+
+    # Removes every field except keep_keys, then sets values, and deletes all chat turns and archives
+    async def reset_document(self, guild_id: str, keep_keys: tuple, values: dict = None) -> None:
+        raise NotImplementedError
+
+    # Removes the document, all chat turns and archives
+    async def delete_document(self, guild_id: str) -> None:
+        raise NotImplementedError
+
+    ###############################################
+    # Chat turns
+    ###############################################
+    # Returns the latest {"seq": int, "turn": dict} records in ascending order
+    async def load_turns(self, guild_id: str, thread: str, limit: int = None, before_seq: int = None) -> list:
+        raise NotImplementedError
+
+    async def get_turn(self, guild_id: str, thread: str, seq: int) -> dict:
+        raise NotImplementedError
+
+    # Returns the sequence numbers assigned to the new turns
+    async def append_turns(self, guild_id: str, thread: str, turns: list) -> list:
+        raise NotImplementedError
+
+    # turns is a {seq: turn} mapping
+    async def update_turns(self, guild_id: str, thread: str, turns: dict) -> None:
+        raise NotImplementedError
+
+    # Deletes the turns from first_seq to last_seq inclusive and stores turns in their place
+    # starting at first_seq, turns must not outnumber the replaced range
+    async def replace_turns(self, guild_id: str, thread: str, first_seq: int, last_seq: int, turns: list) -> None:
+        raise NotImplementedError
+
+    # Returns up to limit {"guild_id": str, "thread": str, "seq": int, "turn": dict} records
+    # of turns across all users whose _meta.expires_at is before the given UNIX timestamp
+    async def find_expiring_turns(self, before: float, limit: int = 100) -> list:
+        raise NotImplementedError
+
+    # Also deletes the archived payloads of the thread, and sets values on the settings document in the same write
+    async def delete_thread(self, guild_id: str, thread: str, values: dict = None) -> None:
+        raise NotImplementedError
+
+    ###############################################
+    # Archive
+    ###############################################
+    # Large payloads removed from chat turns, such as stale tool outputs
+    # Entries belong to a thread and are deleted along with it, but are looked up by key alone
+    async def put_archive(self, guild_id: str, thread: str, key: str, value) -> None:
+        raise NotImplementedError
+
+    # Returns None when the entry doesn't exist
+    async def get_archive(self, guild_id: str, key: str):
+        raise NotImplementedError
+
+    ###############################################
+    # Shared cache
+    ###############################################
+    # Entries shared across users and processes, e.g. uploaded files by content hash
+    # expires_at is a UNIX timestamp, None never expires
+    async def get_cache_entry(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    async def set_cache_entry(self, namespace: str, key: str, value, expires_at: float = None) -> None:
+        raise NotImplementedError
+
+    async def delete_cache_entry(self, namespace: str, key: str) -> None:
+        raise NotImplementedError
@@ -0,0 +1,133 @@
+from .base import HistoryBackend
+import copy
+import time
+
+# In-memory backend, nothing is persisted across restarts
+# Useful for tests, benchmarks and trying out the bot without running a database
+class Backend(HistoryBackend):
+    def __init__(self, **kwargs):
+        # guild_id -> {key: value}
+        self._documents = {}
+
+        # (guild_id, thread) -> {seq: turn}
+        self._turns = {}
+
+        # (guild_id, thread) -> next sequence number
+        self._seqs = {}
+
+        # (guild_id, key) -> (thread, value)
+        self._archive = {}
+
+        # (namespace, key) -> (expires_at, value)
+        self._cache = {}
+
+    ###############################################
+    # Settings document
+    ###############################################
+    # Values are deep copied both ways so callers can't mutate stored state
+    async def get_fields(self, guild_id: str, keys: list) -> dict:
+        _document = self._documents.get(guild_id, {})
+        return {_key: copy.deepcopy(_document[_key]) for _key in keys if _key in _document}
+
+    async def set_fields(self, guild_id: str, values: dict) -> None:
+        self._documents.setdefault(guild_id, {}).update(copy.deepcopy(values))
+
+    def _delete_turns(self, guild_id: str) -> None:
+        for _key in [_key for _key in self._turns if _key[0] == guild_id]:
+            del self._turns[_key]
+            self._seqs.pop(_key, None)
+        for _key in [_key for _key in self._archive if _key[0] == guild_id]:
+            del self._archive[_key]
+
+    async def reset_document(self, guild_id: str, keep_keys: tuple, values: dict = None) -> None:
+        _document = self._documents.get(guild_id, {})
+        self._documents[guild_id] = {_key: _value for _key, _value in _document.items() if _key in keep_keys}
+        if values:
+            self._documents[guild_id].update(copy.deepcopy(values))
+        self._delete_turns(guild_id)
+
+    async def delete_document(self, guild_id: str) -> None:
+        self._documents.pop(guild_id, None)
+        self._delete_turns(guild_id)
+
+    ###############################################
+    # Chat turns
+    ###############################################
+    async def load_turns(self, guild_id: str, thread: str, limit: int = None, before_seq: int = None) -> list:
+        _turns = self._turns.get((guild_id, thread), {})
+        _seqs = sorted(_seq for _seq in _turns if before_seq is None or _seq < before_seq)
+        if limit:
+            _seqs = _seqs[-limit:]
+        return [{"seq": _seq, "turn": copy.deepcopy(_turns[_seq])} for _seq in _seqs]
+
+    async def get_turn(self, guild_id: str, thread: str, seq: int) -> dict:
+        return copy.deepcopy(self._turns.get((guild_id, thread), {}).get(seq))
+
+    async def append_turns(self, guild_id: str, thread: str, turns: list) -> list:
+        _start_seq = self._seqs.get((guild_id, thread), 0)
+        self._seqs[(guild_id, thread)] = _start_seq + len(turns)
+
+        _thread = self._turns.setdefault((guild_id, thread), {})
+        for _index, _turn in enumerate(turns):
+            _thread[_start_seq + _index] = copy.deepcopy(_turn)
+        return list(range(_start_seq, _start_seq + len(turns)))
+
+    async def update_turns(self, guild_id: str, thread: str, turns: dict) -> None:
+        _thread = self._turns.get((guild_id, thread), {})
+        for _seq, _turn in turns.items():
+            if _seq in _thread:
+                _thread[_seq] = copy.deepcopy(_turn)
+
+    async def replace_turns(self, guild_id: str, thread: str, first_seq: int, last_seq: int, turns: list) -> None:
+        _thread = self._turns.get((guild_id, thread), {})
+        for _seq in [_seq for _seq in _thread if first_seq <= _seq <= last_seq]:
+            del _thread[_seq]
+        for _index, _turn in enumerate(turns):
+            _thread[first_seq + _index] = copy.deepcopy(_turn)
+
+    async def find_expiring_turns(self, before: float, limit: int = 100) -> list:
+        _records = []
+        for (_guild_id, _thread), _turns in self._turns.items():
+            for _seq, _turn in _turns.items():
+                _expires_at = (_turn.get("_meta") or {}).get("expires_at")
+                if _expires_at is not None and _expires_at < before:
+                    _records.append({"guild_id": _guild_id, "thread": _thread, "seq": _seq, "turn": copy.deepcopy(_turn)})
+                    if len(_records) >= limit:
+                        return _records
+        return _records
+
+    async def delete_thread(self, guild_id: str, thread: str, values: dict = None) -> None:
+        if values:
+            await self.set_fields(guild_id, values)
+        self._turns.pop((guild_id, thread), None)
+        self._seqs.pop((guild_id, thread), None)
+        for _key in [_key for _key, (_thread, _value) in self._archive.items() if _key[0] == guild_id and _thread == thread]:
+            del self._archive[_key]
+
+    ###############################################
+    # Archive
+    ###############################################
+    async def put_archive(self, guild_id: str, thread: str, key: str, value) -> None:
+        self._archive[(guild_id, key)] = (thread, copy.deepcopy(value))
+
+    async def get_archive(self, guild_id: str, key: str):
+        _entry = self._archive.get((guild_id, key))
+        return copy.deepcopy(_entry[1]) if _entry else None
+
+    ###############################################
+    # Shared cache
+    ###############################################
+    async def get_cache_entry(self, namespace: str, key: str):
+        _entry = self._cache.get((namespace, key))
+        if not _entry:
+            return None
+        if _entry[0] is not None and _entry[0] <= time.time():
+            del self._cache[(namespace, key)]
+            return None
+        return copy.deepcopy(_entry[1])
+
+    async def set_cache_entry(self, namespace: str, key: str, value, expires_at: float = None) -> None:
+        self._cache[(namespace, key)] = (expires_at, copy.deepcopy(value))
+
+    async def delete_cache_entry(self, namespace: str, key: str) -> None:
+        self._cache.pop((namespace, key), None)
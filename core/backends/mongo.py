@@ -0,0 +1,260 @@
+from .base import HistoryBackend
+from core.cache import TTLCache
+from datetime import datetime, timezone
+from os import environ
+from pymongo import DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+import asyncio
+import logging
+import motor.motor_asyncio
+import time
+
+# Fields of the settings document that only track chat threads, changes to them don't affect cached preferences
+_THREAD_FIELD_PREFIXES = ("chat_seq_", "chat_thread_")
+
+# MongoDB backend, settings are stored one document per user and chat turns one document per turn
+class Backend(HistoryBackend):
+    def __init__(self, conn_string: str = None, **kwargs):
+        # Create new connection
+        self._db_conn = motor.motor_asyncio.AsyncIOMotorClient(conn_string or environ.get("MONGO_DB_URL"))
+        
+        # Create a new database if it doesn't exist, access chat_history database
+        self._db = self._db_conn[environ.get("MONGO_DB_NAME", "jakey_prod_db")]
+        self._collection = self._db[environ.get("MONGO_DB_COLLECTION_NAME", "jakey_prod_db_collection")]
+        logging.info("Connected to the database %s and collection %s", self._db.name, self._collection.name)
+
+        # Chat turns are stored one document per turn so new messages are appended instead of rewriting the whole thread
+        self._turns = self._db[environ.get("MONGO_DB_TURNS_COLLECTION_NAME", f"{self._collection.name}_turns")]
+
+        # Payloads removed from chat turns
+        self._archive = self._db[environ.get("MONGO_DB_ARCHIVE_COLLECTION_NAME", f"{self._collection.name}_archive")]
+
+        # Shared cache entries, removed by a TTL index once expired
+        self._cache = self._db[environ.get("MONGO_DB_CACHE_COLLECTION_NAME", f"{self._collection.name}_cache")]
+
+        # Maps document _id to guild_id so change stream events can be resolved to a user
+        self._doc_ids = TTLCache(max_entries=int(environ.get("HISTORY_CACHE_MAX_ENTRIES", 4096)), ttl=float(environ.get("HISTORY_CACHE_TTL", 300)))
+
+    # Setup indexes for the collection
+    async def start(self) -> None:
+        await self._collection.create_index([("guild_id", 1)], name="guild_id_index", background=True, unique=True)
+        logging.info("Created index for guild_id")
+
+        await self._turns.create_index([("guild_id", 1), ("thread", 1), ("seq", 1)], name="thread_seq_index", background=True, unique=True)
+        await self._turns.create_index([("turn._meta.expires_at", 1)], name="expires_at_index", background=True, sparse=True)
+        logging.info("Created index for chat turns")
+
+        await self._archive.create_index([("guild_id", 1), ("key", 1)], name="guild_id_key_index", background=True, unique=True)
+        await self._archive.create_index([("guild_id", 1), ("thread", 1)], name="guild_id_thread_index", background=True)
+        logging.info("Created index for archive")
+
+        await self._cache.create_index([("expire_on", 1)], name="expire_on_ttl_index", background=True, expireAfterSeconds=0)
+        logging.info("Created TTL index for shared cache")
+
+    async def close(self) -> None:
+        self._db_conn.close()
+
+    # Listens for changes made to the collection, requires MongoDB to be deployed as a replica set
+    async def watch(self, invalidate) -> None:
+        _pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+            {"$project": {"operationType": 1, "documentKey": 1, "fullDocument.guild_id": 1, "updateDescription": 1}}
+        ]
+        _retry_delay = 1
+        while True:
+            try:
+                async with self._collection.watch(_pipeline) as _stream:
+                    logging.info("Listening for changes on collection %s for cache invalidation", self._collection.name)
+                    _retry_delay = 1
+                    async for _change in _stream:
+                        # Every chat reply reserves sequence numbers on the settings document, these don't change preferences
+                        if _change["operationType"] == "update":
+                            _description = _change.get("updateDescription") or {}
+                            _fields = [*(_description.get("updatedFields") or {}), *(_description.get("removedFields") or [])]
+                            if _fields and all(_field.startswith(_THREAD_FIELD_PREFIXES) for _field in _fields):
+                                continue
+
+                        _guild_id = (_change.get("fullDocument") or {}).get("guild_id") \
+                            or self._doc_ids.pop(_change["documentKey"]["_id"])
+                        if _guild_id:
+                            invalidate(_guild_id)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # Change streams are unsupported on standalone servers, so there's nothing to retry
+                logging.warning("Change streams are not available, cache invalidation across processes is disabled: %s", e)
+                return
+            except Exception as e:
+                # The cache may be stale while we're disconnected, so start over once reconnected
+                logging.error("Change stream interrupted, retrying in %s seconds: %s", _retry_delay, e)
+                invalidate(None)
+                await asyncio.sleep(_retry_delay)
+                _retry_delay = min(_retry_delay * 2, 60)
+
+    ###############################################
+    # Settings document
+    ###############################################
+    async def get_fields(self, guild_id: str, keys: list) -> dict:
+        _document = await self._collection.find_one({"guild_id": guild_id}, {_key: 1 for _key in keys})
+        if not _document:
+            return {}
+
+        self._doc_ids.set(_document.pop("_id"), guild_id)
+        return _document
+
+    async def set_fields(self, guild_id: str, values: dict) -> None:
+        await self._collection.update_one({"guild_id": guild_id}, {"$set": values}, upsert=True)
+
+    async def reset_document(self, guild_id: str, keep_keys: tuple, values: dict = None) -> None:
+        # Only keep identity and the given fields from the existing document
+        _pipeline = [
+            {"$replaceWith": {
+                "$arrayToObject": {
+                    "$filter": {
+                        "input": {"$objectToArray": "$$ROOT"},
+                        "as": "field",
+                        "cond": {"$in": ["$$field.k", ["_id", "guild_id", *keep_keys]]}
+                    }
+                }
+            }}
+        ]
+
+        # Values are wrapped in $literal so strings starting with $ aren't treated as field paths
+        if values:
+            _pipeline.append({"$set": {_key: {"$literal": _value} for _key, _value in values.items()}})
+
+        await self._collection.update_one({"guild_id": guild_id}, _pipeline, upsert=True)
+        await self._turns.delete_many({"guild_id": guild_id})
+        await self._archive.delete_many({"guild_id": guild_id})
+
+    async def delete_document(self, guild_id: str) -> None:
+        await self._collection.delete_one({"guild_id": guild_id})
+        await self._turns.delete_many({"guild_id": guild_id})
+        await self._archive.delete_many({"guild_id": guild_id})
+
+    ###############################################
+    # Chat turns
+    ###############################################
+    # Moves threads saved as a single array in the settings document into the turns collection
+    async def _migrate_legacy_thread(self, guild_id: str, thread: str) -> bool:
+        _legacy_key = f"chat_thread_{thread}"
+        _document = await self._collection.find_one({"guild_id": guild_id}, {_legacy_key: 1})
+        if not _document or not isinstance(_document.get(_legacy_key), list) or not _document[_legacy_key]:
+            return False
+
+        logging.info("Migrating legacy chat thread %s with %s turns to the turns collection", thread, len(_document[_legacy_key]))
+        await self.append_turns(guild_id, thread, _document[_legacy_key])
+        await self._collection.update_one({"guild_id": guild_id}, {"$unset": {_legacy_key: ""}})
+        return True
+
+    async def _find_turns(self, query: dict, limit: int = None) -> list:
+        _cursor = self._turns.find(query, {"_id": 0, "seq": 1, "turn": 1}).sort("seq", DESCENDING)
+        if limit:
+            _cursor = _cursor.limit(limit)
+        return await _cursor.to_list(length=None)
+
+    async def load_turns(self, guild_id: str, thread: str, limit: int = None, before_seq: int = None) -> list:
+        _query = {"guild_id": guild_id, "thread": thread}
+        if before_seq is not None:
+            _query["seq"] = {"$lt": before_seq}
+
+        _records = await self._find_turns(_query, limit)
+
+        # Threads written before turns were stored separately are migrated on first load
+        if not _records and before_seq is None and await self._migrate_legacy_thread(guild_id, thread):
+            _records = await self._find_turns(_query, limit)
+
+        _records.reverse()
+        return _records
+
+    async def get_turn(self, guild_id: str, thread: str, seq: int) -> dict:
+        _record = await self._turns.find_one({"guild_id": guild_id, "thread": thread, "seq": seq}, {"_id": 0, "turn": 1})
+        return _record["turn"] if _record else None
+
+    async def append_turns(self, guild_id: str, thread: str, turns: list) -> list:
+        # Reserve a range of sequence numbers atomically
+        _counter_key = f"chat_seq_{thread}"
+        _document = await self._collection.find_one_and_update(
+            {"guild_id": guild_id},
+            {"$inc": {_counter_key: len(turns)}},
+            projection={_counter_key: 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        _start_seq = _document[_counter_key] - len(turns)
+
+        await self._turns.insert_many([
+            {"guild_id": guild_id, "thread": thread, "seq": _start_seq + _index, "turn": _turn}
+            for _index, _turn in enumerate(turns)
+        ], ordered=True)
+        return list(range(_start_seq, _start_seq + len(turns)))
+
+    async def update_turns(self, guild_id: str, thread: str, turns: dict) -> None:
+        await self._turns.bulk_write([
+            UpdateOne({"guild_id": guild_id, "thread": thread, "seq": _seq}, {"$set": {"turn": _turn}})
+            for _seq, _turn in turns.items()
+        ], ordered=False)
+
+    # The new turns are upserted over the start of the range before the rest of it is deleted
+    # so the thread never misses turns if we're interrupted in between
+    async def replace_turns(self, guild_id: str, thread: str, first_seq: int, last_seq: int, turns: list) -> None:
+        if turns:
+            await self._turns.bulk_write([
+                UpdateOne({"guild_id": guild_id, "thread": thread, "seq": first_seq + _index}, {"$set": {"turn": _turn}}, upsert=True)
+                for _index, _turn in enumerate(turns)
+            ], ordered=True)
+        await self._turns.delete_many({"guild_id": guild_id, "thread": thread, "seq": {"$gte": first_seq + len(turns), "$lte": last_seq}})
+
+    async def find_expiring_turns(self, before: float, limit: int = 100) -> list:
+        _cursor = self._turns.find(
+            {"turn._meta.expires_at": {"$lt": before}},
+            {"_id": 0, "guild_id": 1, "thread": 1, "seq": 1, "turn": 1}
+        ).limit(limit)
+        return await _cursor.to_list(length=None)
+
+    async def delete_thread(self, guild_id: str, thread: str, values: dict = None) -> None:
+        _update = {"$unset": {f"chat_thread_{thread}": "", f"chat_seq_{thread}": ""}}
+        if values:
+            _update["$set"] = values
+        await self._collection.update_one({"guild_id": guild_id}, _update, upsert=bool(values))
+        await self._turns.delete_many({"guild_id": guild_id, "thread": thread})
+        await self._archive.delete_many({"guild_id": guild_id, "thread": thread})
+
+    ###############################################
+    # Archive
+    ###############################################
+    async def put_archive(self, guild_id: str, thread: str, key: str, value) -> None:
+        await self._archive.update_one(
+            {"guild_id": guild_id, "key": key},
+            {"$set": {"thread": thread, "value": value}},
+            upsert=True
+        )
+
+    async def get_archive(self, guild_id: str, key: str):
+        _entry = await self._archive.find_one({"guild_id": guild_id, "key": key}, {"_id": 0, "value": 1})
+        return _entry["value"] if _entry else None
+
+    ###############################################
+    # Shared cache
+    ###############################################
+    async def get_cache_entry(self, namespace: str, key: str):
+        # The TTL monitor only runs every minute, so expiry is also checked on read
+        _entry = await self._cache.find_one(
+            {"_id": f"{namespace}:{key}", "$or": [{"expires_at": None}, {"expires_at": {"$gt": time.time()}}]},
+            {"_id": 0, "value": 1}
+        )
+        return _entry["value"] if _entry else None
+
+    async def set_cache_entry(self, namespace: str, key: str, value, expires_at: float = None) -> None:
+        await self._cache.replace_one(
+            {"_id": f"{namespace}:{key}"},
+            {
+                "value": value,
+                "expires_at": expires_at,
+                "expire_on": datetime.fromtimestamp(expires_at, tz=timezone.utc) if expires_at is not None else None
+            },
+            upsert=True
+        )
+
+    async def delete_cache_entry(self, namespace: str, key: str) -> None:
+        await self._cache.delete_one({"_id": f"{namespace}:{key}"})
@@ -0,0 +1,284 @@
+from .base import HistoryBackend
+from os import environ
+import aiosqlite
+import asyncio
+import bson
+import logging
+import time
+
+# SQLite backend for single box deployments without external services
+# Uses WAL mode and batches commits, so writes within SQLITE_COMMIT_INTERVAL may be lost on a crash
+class Backend(HistoryBackend):
+    def __init__(self, db_path: str = None, **kwargs):
+        self._db_path = db_path or environ.get("SQLITE_DB_PATH", "jakey_history.db")
+        self._conn: aiosqlite.Connection = None
+        self._connect_lock = asyncio.Lock()
+
+        # Guards read-modify-write sequences such as reserving sequence numbers
+        self._append_lock = asyncio.Lock()
+
+        # Batched commits
+        self._commit_interval = float(environ.get("SQLITE_COMMIT_INTERVAL", 0.25))
+        self._commit_batch_size = int(environ.get("SQLITE_COMMIT_BATCH_SIZE", 64))
+        self._pending_writes = 0
+        self._commit_task: asyncio.Task = None
+
+    # Values are stored as BSON so they round trip the same way as with MongoDB, including bytes
+    @staticmethod
+    def _encode(value) -> bytes:
+        return bson.encode({"v": value})
+
+    @staticmethod
+    def _decode(blob: bytes):
+        return bson.decode(blob)["v"]
+
+    # Expiry is kept in its own column so expiring turns can be found without decoding every turn
+    @staticmethod
+    def _expires_at(turn: dict) -> float:
+        return (turn.get("_meta") or {}).get("expires_at") if isinstance(turn, dict) else None
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        async with self._connect_lock:
+            if self._conn is None:
+                _conn = await aiosqlite.connect(self._db_path)
+                await _conn.execute("PRAGMA journal_mode=WAL")
+                await _conn.execute("PRAGMA synchronous=NORMAL")
+                await _conn.execute(
+                    "CREATE TABLE IF NOT EXISTS documents ("
+                    "guild_id TEXT NOT NULL, key TEXT NOT NULL, value BLOB, "
+                    "PRIMARY KEY (guild_id, key)) WITHOUT ROWID"
+                )
+                await _conn.execute(
+                    "CREATE TABLE IF NOT EXISTS turns ("
+                    "guild_id TEXT NOT NULL, thread TEXT NOT NULL, seq INTEGER NOT NULL, turn BLOB NOT NULL, "
+                    "PRIMARY KEY (guild_id, thread, seq)) WITHOUT ROWID"
+                )
+
+                # Databases created before turns had an expiry column
+                async with _conn.execute("PRAGMA table_info(turns)") as _cursor:
+                    _columns = [_row[1] async for _row in _cursor]
+                if "expires_at" not in _columns:
+                    await _conn.execute("ALTER TABLE turns ADD COLUMN expires_at REAL")
+                await _conn.execute("CREATE INDEX IF NOT EXISTS turns_expires_at ON turns (expires_at) WHERE expires_at IS NOT NULL")
+                await _conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL, "
+                    "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+                )
+                await _conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+                await _conn.execute(
+                    "CREATE TABLE IF NOT EXISTS archive ("
+                    "guild_id TEXT NOT NULL, key TEXT NOT NULL, thread TEXT NOT NULL, value BLOB NOT NULL, "
+                    "PRIMARY KEY (guild_id, key)) WITHOUT ROWID"
+                )
+                await _conn.commit()
+                logging.info("Connected to the SQLite database %s", self._db_path)
+                self._conn = _conn
+        return self._conn
+
+    async def start(self) -> None:
+        await self._connection()
+
+    async def close(self) -> None:
+        if self._commit_task and not self._commit_task.done():
+            self._commit_task.cancel()
+        if self._conn is not None:
+            await self._commit()
+            await self._conn.close()
+            self._conn = None
+
+    ###############################################
+    # Batched commits
+    ###############################################
+    async def _commit(self) -> None:
+        if self._pending_writes and self._conn is not None:
+            self._pending_writes = 0
+            await self._conn.commit()
+
+    async def _delayed_commit(self) -> None:
+        await asyncio.sleep(self._commit_interval)
+        try:
+            await self._commit()
+        except Exception as e:
+            logging.error("Failed to commit pending writes to the SQLite database: %s", e)
+
+    # Reads on the same connection see uncommitted writes, so commits only need to happen eventually
+    async def _after_write(self) -> None:
+        self._pending_writes += 1
+        if self._pending_writes >= self._commit_batch_size:
+            await self._commit()
+        elif self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._delayed_commit())
+
+    ###############################################
+    # Settings document
+    ###############################################
+    async def get_fields(self, guild_id: str, keys: list) -> dict:
+        _conn = await self._connection()
+        async with _conn.execute(
+            f"SELECT key, value FROM documents WHERE guild_id = ? AND key IN ({', '.join('?' * len(keys))})",
+            (guild_id, *keys)
+        ) as _cursor:
+            return {_key: self._decode(_value) async for _key, _value in _cursor}
+
+    # Writes fields without scheduling a commit, for writes made of several statements
+    async def _write_fields(self, conn: aiosqlite.Connection, guild_id: str, values: dict) -> None:
+        await conn.executemany(
+            "INSERT INTO documents (guild_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (guild_id, key) DO UPDATE SET value = excluded.value",
+            [(guild_id, _key, self._encode(_value)) for _key, _value in values.items()]
+        )
+
+    async def set_fields(self, guild_id: str, values: dict) -> None:
+        _conn = await self._connection()
+        await self._write_fields(_conn, guild_id, values)
+        await self._after_write()
+
+    async def reset_document(self, guild_id: str, keep_keys: tuple, values: dict = None) -> None:
+        _conn = await self._connection()
+        await _conn.execute(
+            f"DELETE FROM documents WHERE guild_id = ? AND key NOT IN ({', '.join('?' * len(keep_keys))})",
+            (guild_id, *keep_keys)
+        )
+        await _conn.execute("DELETE FROM turns WHERE guild_id = ?", (guild_id,))
+        await _conn.execute("DELETE FROM archive WHERE guild_id = ?", (guild_id,))
+        if values:
+            await self._write_fields(_conn, guild_id, values)
+        await self._after_write()
+
+    async def delete_document(self, guild_id: str) -> None:
+        _conn = await self._connection()
+        await _conn.execute("DELETE FROM documents WHERE guild_id = ?", (guild_id,))
+        await _conn.execute("DELETE FROM turns WHERE guild_id = ?", (guild_id,))
+        await _conn.execute("DELETE FROM archive WHERE guild_id = ?", (guild_id,))
+        await self._after_write()
+
+    ###############################################
+    # Chat turns
+    ###############################################
+    async def load_turns(self, guild_id: str, thread: str, limit: int = None, before_seq: int = None) -> list:
+        _conn = await self._connection()
+        _query = "SELECT seq, turn FROM turns WHERE guild_id = ? AND thread = ?"
+        _params = [guild_id, thread]
+        if before_seq is not None:
+            _query += " AND seq < ?"
+            _params.append(before_seq)
+        _query += " ORDER BY seq DESC"
+        if limit:
+            _query += " LIMIT ?"
+            _params.append(limit)
+
+        async with _conn.execute(_query, _params) as _cursor:
+            _records = [{"seq": _seq, "turn": self._decode(_turn)} async for _seq, _turn in _cursor]
+        _records.reverse()
+        return _records
+
+    async def get_turn(self, guild_id: str, thread: str, seq: int) -> dict:
+        _conn = await self._connection()
+        async with _conn.execute(
+            "SELECT turn FROM turns WHERE guild_id = ? AND thread = ? AND seq = ?", (guild_id, thread, seq)
+        ) as _cursor:
+            _row = await _cursor.fetchone()
+        return self._decode(_row[0]) if _row else None
+
+    async def append_turns(self, guild_id: str, thread: str, turns: list) -> list:
+        _conn = await self._connection()
+
+        async with self._append_lock:
+            async with _conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM turns WHERE guild_id = ? AND thread = ?", (guild_id, thread)
+            ) as _cursor:
+                _start_seq = (await _cursor.fetchone())[0]
+
+            await _conn.executemany(
+                "INSERT INTO turns (guild_id, thread, seq, turn, expires_at) VALUES (?, ?, ?, ?, ?)",
+                [(guild_id, thread, _start_seq + _index, self._encode(_turn), self._expires_at(_turn)) for _index, _turn in enumerate(turns)]
+            )
+        await self._after_write()
+        return list(range(_start_seq, _start_seq + len(turns)))
+
+    async def update_turns(self, guild_id: str, thread: str, turns: dict) -> None:
+        _conn = await self._connection()
+        await _conn.executemany(
+            "UPDATE turns SET turn = ?, expires_at = ? WHERE guild_id = ? AND thread = ? AND seq = ?",
+            [(self._encode(_turn), self._expires_at(_turn), guild_id, thread, _seq) for _seq, _turn in turns.items()]
+        )
+        await self._after_write()
+
+    async def replace_turns(self, guild_id: str, thread: str, first_seq: int, last_seq: int, turns: list) -> None:
+        _conn = await self._connection()
+        await _conn.execute(
+            "DELETE FROM turns WHERE guild_id = ? AND thread = ? AND seq BETWEEN ? AND ?", (guild_id, thread, first_seq, last_seq)
+        )
+        await _conn.executemany(
+            "INSERT INTO turns (guild_id, thread, seq, turn, expires_at) VALUES (?, ?, ?, ?, ?)",
+            [(guild_id, thread, first_seq + _index, self._encode(_turn), self._expires_at(_turn)) for _index, _turn in enumerate(turns)]
+        )
+        await self._after_write()
+
+    async def find_expiring_turns(self, before: float, limit: int = 100) -> list:
+        _conn = await self._connection()
+        async with _conn.execute(
+            "SELECT guild_id, thread, seq, turn FROM turns WHERE expires_at < ? LIMIT ?", (before, limit)
+        ) as _cursor:
+            return [
+                {"guild_id": _guild_id, "thread": _thread, "seq": _seq, "turn": self._decode(_turn)}
+                async for _guild_id, _thread, _seq, _turn in _cursor
+            ]
+
+    async def delete_thread(self, guild_id: str, thread: str, values: dict = None) -> None:
+        _conn = await self._connection()
+        await _conn.execute("DELETE FROM turns WHERE guild_id = ? AND thread = ?", (guild_id, thread))
+        await _conn.execute("DELETE FROM documents WHERE guild_id = ? AND key = ?", (guild_id, f"chat_thread_{thread}"))
+        await _conn.execute("DELETE FROM archive WHERE guild_id = ? AND thread = ?", (guild_id, thread))
+        if values:
+            await self._write_fields(_conn, guild_id, values)
+        await self._after_write()
+
+    ###############################################
+    # Archive
+    ###############################################
+    async def put_archive(self, guild_id: str, thread: str, key: str, value) -> None:
+        _conn = await self._connection()
+        await _conn.execute(
+            "INSERT INTO archive (guild_id, key, thread, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (guild_id, key) DO UPDATE SET thread = excluded.thread, value = excluded.value",
+            (guild_id, key, thread, self._encode(value))
+        )
+        await self._after_write()
+
+    async def get_archive(self, guild_id: str, key: str):
+        _conn = await self._connection()
+        async with _conn.execute("SELECT value FROM archive WHERE guild_id = ? AND key = ?", (guild_id, key)) as _cursor:
+            _row = await _cursor.fetchone()
+        return self._decode(_row[0]) if _row else None
+
+    ###############################################
+    # Shared cache
+    ###############################################
+    # Expired entries are skipped on read and purged when the database is opened
+    async def get_cache_entry(self, namespace: str, key: str):
+        _conn = await self._connection()
+        async with _conn.execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time())
+        ) as _cursor:
+            _row = await _cursor.fetchone()
+        return self._decode(_row[0]) if _row else None
+
+    async def set_cache_entry(self, namespace: str, key: str, value, expires_at: float = None) -> None:
+        _conn = await self._connection()
+        await _conn.execute(
+            "INSERT INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (namespace, key, self._encode(value), expires_at)
+        )
+        await self._after_write()
+
+    async def delete_cache_entry(self, namespace: str, key: str) -> None:
+        _conn = await self._connection()
+        await _conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+        await self._after_write()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+import time
+
+# Bounded in-process cache with LRU eviction and per-entry TTL
+# Used to keep hot lookups off the network, e.g. user settings from core.database.History
+# max_bytes optionally also bounds the total size of the entries, as given by the caller on set
+class TTLCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 300, max_bytes: int = 0):
+        if max_entries < 0:
+            raise ValueError("max_entries must be zero or a positive integer")
+        if max_bytes < 0:
+            raise ValueError("max_bytes must be zero or a positive integer")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (expires_at, value, size), ordered from least to most recently used
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        _entry = self._entries.get(key)
+        return _entry is not None and _entry[0] > time.monotonic()
+
+    # Returns the cached value or default, expired entries are counted as misses
+    def get(self, key, default=None):
+        _entry = self._entries.get(key)
+        if _entry is None:
+            self.misses += 1
+            return default
+
+        if _entry[0] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return _entry[1]
+
+    # Returns the cached value without counting a lookup or refreshing its position
+    def peek(self, key, default=None):
+        _entry = self._entries.get(key)
+        if _entry is None or _entry[0] <= time.monotonic():
+            return default
+        return _entry[1]
+
+    def _remove(self, key):
+        _entry = self._entries.pop(key)
+        self._bytes -= _entry[2]
+        return _entry
+
+    # Insert or replace an entry, evicting the least recently used entries if full
+    def set(self, key, value, ttl: float = None, size: int = 0) -> None:
+        if self.max_entries == 0:
+            return
+
+        # Entries that would take more than the whole cache aren't stored
+        if self.max_bytes and size > self.max_bytes:
+            self.pop(key)
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, size)
+        self._bytes += size
+
+        while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+        return self._remove(key)[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        _lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / _lookups, 4) if _lookups else 0.0
+        }
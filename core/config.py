@@ -0,0 +1,101 @@
+from os import environ
+import asyncio
+import logging
+import os
+import yaml
+
+# How often in seconds registered files are checked for changes, 0 disables reloading
+CONFIG_RELOAD_INTERVAL = float(environ.get("CONFIG_RELOAD_INTERVAL", 5))
+
+# Parsed and validated YAML files kept in memory
+# Each file is parsed once into an immutable value, readers get it without any file I/O and a
+# background task reparses files whose mtime changed. A file that fails to parse keeps its previous value
+class ConfigRegistry:
+    def __init__(self):
+        # name -> dict with path, parser, optional, mtime, value and version
+        self._files = {}
+
+    # Register a YAML file, the parser receives the loaded YAML and returns the value handed to readers
+    def register(self, name: str, path: str, parser=None, optional: bool = False) -> None:
+        if name in self._files:
+            raise ValueError(f"Config {name} is already registered")
+
+        self._files[name] = {
+            "path": path,
+            "parser": parser or (lambda data: data),
+            "optional": optional,
+            "mtime": None,
+            "value": None,
+            "version": 0,
+            "loaded": False
+        }
+
+    # Returns the parsed value, files are only read the first time they're accessed
+    def get(self, name: str):
+        _file = self._files[name]
+        if not _file["loaded"]:
+            self._load(name)
+        return _file["value"]
+
+    # Incremented on every reload, used to invalidate values derived from a file
+    def version(self, name: str) -> int:
+        self.get(name)
+        return self._files[name]["version"]
+
+    def _load(self, name: str) -> bool:
+        _file = self._files[name]
+        try:
+            _mtime = os.stat(_file["path"]).st_mtime_ns
+        except FileNotFoundError:
+            if not _file["optional"]:
+                raise
+            _mtime = None
+
+        if _file["loaded"] and _mtime == _file["mtime"]:
+            return False
+
+        try:
+            if _mtime is None:
+                _value = _file["parser"](None)
+            else:
+                with open(_file["path"], "r") as _config_file:
+                    _value = _file["parser"](yaml.safe_load(_config_file))
+        except Exception:
+            # Don't retry the same broken file until it's edited again
+            if _file["loaded"]:
+                _file["mtime"] = _mtime
+            raise
+
+        _file["mtime"] = _mtime
+        _file["value"] = _value
+        _file["version"] += 1
+        _file["loaded"] = True
+        return True
+
+    # Reparse changed files, returns the names of the files that were reloaded
+    def reload(self) -> list:
+        _reloaded = []
+        for _name, _file in self._files.items():
+            if not _file["loaded"]:
+                continue
+
+            try:
+                if self._load(_name):
+                    _reloaded.append(_name)
+            except Exception:
+                logging.error("Failed to reload %s, keeping the previous version", _file["path"], exc_info=True)
+
+        if _reloaded:
+            logging.info("Reloaded config files: %s", ", ".join(_reloaded))
+        return _reloaded
+
+    # Background task to reload changed files
+    async def watch(self, interval: float = CONFIG_RELOAD_INTERVAL) -> None:
+        if interval <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.reload)
+
+config_registry = ConfigRegistry()
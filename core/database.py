@@ -1,32 +1,55 @@
+from core.backends import HistoryBackend, create_backend
+from core.cache import TTLCache
 from core.exceptions import HistoryDatabaseError
 from os import environ
-from pymongo import ReturnDocument
 import discord as typehint_Discord
 import logging
 import models.core
-import motor.motor_asyncio
+import time
+
+# User preferences which are kept when chat threads are reset
+# These are never written on read, defaults are resolved lazily in get_key/get_many
+PREFS_KEYS = ("tool_use", "default_model", "default_openrouter_model")
 
 # A class that is responsible for managing and manipulating the chat history
 class History:
-    def __init__(self, bot: typehint_Discord.Bot, conn_string):
+    def __init__(self, bot: typehint_Discord.Bot, conn_string = None, backend: str = None):
         # Grab default model
         self.DEFAULT_MODEL = models.core.get_default_chat_model()
 
-        # Create new connection
-        self._db_conn = motor.motor_asyncio.AsyncIOMotorClient(conn_string)
-        
-        # Create a new database if it doesn't exist, access chat_history database
-        self._db = self._db_conn[environ.get("MONGO_DB_NAME", "jakey_prod_db")]
-        self._collection = self._db[environ.get("MONGO_DB_COLLECTION_NAME", "jakey_prod_db_collection")]
-        logging.info("Connected to the database %s and collection %s", self._db.name, self._collection.name)
+        # Lazy defaults for user preferences
+        self._defaults = {
+            "tool_use": None,
+            "default_model": self.DEFAULT_MODEL,
+            "default_openrouter_model": "openai/gpt-4.1-mini"
+        }
+
+        # Storage backend, one of mongo, sqlite or memory
+        _backend_name = backend or environ.get("HISTORY_BACKEND", "mongo")
+        self._backend: HistoryBackend = create_backend(_backend_name, conn_string=conn_string)
+        logging.info("Using %s backend for chat history", _backend_name)
+
+        # Create task for connecting and indexing
+        bot.loop.create_task(self._backend.start())
+
+        # In-process cache for user preferences, set HISTORY_CACHE_MAX_ENTRIES=0 to disable
+        self._prefs_cache = TTLCache(
+            max_entries=int(environ.get("HISTORY_CACHE_MAX_ENTRIES", 4096)),
+            ttl=float(environ.get("HISTORY_CACHE_TTL", 300))
+        )
 
-        # Create task for indexing the collection
-        bot.loop.create_task(self._init_indexes())
+        # Generation of the cached preferences of users with reads in flight, bumped on every change
+        # so a read that started before a write doesn't fill the cache with the old values
+        self._prefs_reads = {}
+        self._prefs_generations = {}
 
-    # Setup indexes for the collection
-    async def _init_indexes(self):
-        await self._collection.create_index([("guild_id", 1)], name="guild_id_index", background=True, unique=True)
-        logging.info("Created index for guild_id")
+        # Invalidate cached preferences from other bot processes sharing the same database
+        if self._prefs_cache.max_entries and environ.get("HISTORY_CACHE_CHANGE_STREAM", "false").lower() == "true":
+            bot.loop.create_task(self._backend.watch(self._invalidate_cached_prefs))
+
+    # Flush pending writes and close the backend
+    async def close(self) -> None:
+        await self._backend.close()
 
     # Type validation for guild_id
     def _normalize_guild_id(self, guild_id: int) -> str:
@@ -37,35 +60,67 @@ class History:
             raise ValueError("guild_id must be a string of digits")
         return _guild_id_str
 
-    # Returns the document to be manipulated, creates one if it doesn't exist.
-    async def _ensure_document(self, guild_id: str):
-        # Check if guild_id is string
-        if not isinstance(guild_id, str):
-            raise TypeError("guild_id is required and must be a string")
-
-        _existing = await self._collection.find_one({"guild_id": guild_id})
-        if _existing:
-            tool_use = _existing.get("tool_use", None)
-            default_model = _existing.get("default_model", self.DEFAULT_MODEL)
-            default_openrouter_model = _existing.get("default_openrouter_model", "openai/gpt-4.1-mini")
+    # Type validation for keys
+    def _validate_key(self, key: str) -> str:
+        if not key or not isinstance(key, str):
+            raise ValueError("Key must be a non-empty string")
+        if key.startswith("$") or "." in key or key in ("_id", "guild_id"):
+            raise ValueError(f"Key {key} is reserved or contains invalid characters")
+        return key
+
+    # Thread names are used as part of keys in the settings document
+    def _validate_thread(self, thread: str) -> str:
+        if not thread or not isinstance(thread, str):
+            raise ValueError("Thread name must be a non-empty string")
+        if thread.startswith("$") or "." in thread:
+            raise ValueError(f"Thread name {thread} contains invalid characters")
+        return thread
+
+    # Returns the hit/miss/eviction counters of the preferences cache
+    def cache_stats(self) -> dict:
+        return self._prefs_cache.stats()
+
+    # Start tracking a read of the preferences, returns the generation to pass to _end_prefs_read
+    def _begin_prefs_read(self, guild_id: str) -> int:
+        self._prefs_reads[guild_id] = self._prefs_reads.get(guild_id, 0) + 1
+        return self._prefs_generations.get(guild_id, 0)
+
+    # Stop tracking a read, returns False if the preferences changed while it was in flight
+    def _end_prefs_read(self, guild_id: str, generation: int) -> bool:
+        _unchanged = self._prefs_generations.get(guild_id, 0) == generation
+        self._prefs_reads[guild_id] -= 1
+        if not self._prefs_reads[guild_id]:
+            del self._prefs_reads[guild_id]
+            self._prefs_generations.pop(guild_id, None)
+        return _unchanged
+
+    # Marks the preferences as changed for reads in flight, or for every user if guild_id is None
+    def _bump_prefs_generation(self, guild_id: str = None) -> None:
+        for _guild_id in (self._prefs_reads if guild_id is None else [guild_id] if guild_id in self._prefs_reads else []):
+            self._prefs_generations[_guild_id] = self._prefs_generations.get(_guild_id, 0) + 1
+
+    # Drops a cached entry, or the entire cache if guild_id is None
+    def _invalidate_cached_prefs(self, guild_id: str = None) -> None:
+        self._bump_prefs_generation(guild_id)
+        if guild_id is None:
+            self._prefs_cache.clear()
         else:
-            tool_use = None
-            default_model = self.DEFAULT_MODEL
-            default_openrouter_model = "openai/gpt-4.1-mini"
-
-        # Use find_one_and_update with upsert to return the document after update.
-        _document = await self._collection.find_one_and_update(
-            {"guild_id": guild_id},
-            {"$set": {
-                "guild_id": guild_id,
-                "tool_use": tool_use,
-                "default_model": default_model,
-                "default_openrouter_model": default_openrouter_model
-            }},
-            upsert=True,
-            return_document=ReturnDocument.AFTER
-        )
-        return _document
+            self._prefs_cache.pop(guild_id)
+
+    # Write-through for cached preferences, only updates entries already cached
+    def _update_cached_prefs(self, guild_id: str, values: dict) -> None:
+        _prefs = {_key: _value for _key, _value in values.items() if _key in PREFS_KEYS}
+        if not _prefs:
+            return
+
+        self._bump_prefs_generation(guild_id)
+
+        # Peek so writes don't count as cache lookups
+        _cached = self._prefs_cache.peek(guild_id)
+        if _cached is None:
+            return
+
+        self._prefs_cache.set(guild_id, {**_cached, **_prefs})
 
 
 ####################################################################################
@@ -73,33 +128,205 @@ class History:
 ####################################################################################
     # Directly set custom keys and values to the document
     async def set_key(self, guild_id: int, key: str, value) -> None:
+        await self.set_many(guild_id, {key: value})
+
+    # Set multiple keys in a single round trip
+    async def set_many(self, guild_id: int, values: dict) -> None:
         guild_id = self._normalize_guild_id(guild_id)
-        await self._ensure_document(guild_id)
+        if not values:
+            return
+
+        for _key in values.keys():
+            self._validate_key(_key)
+
         try:
-            await self._collection.update_one(
-                {"guild_id": guild_id},
-                {"$set": {key: value}},
-                upsert=True
-            )
+            await self._backend.set_fields(guild_id, values)
         except Exception as e:
             logging.error("Error setting keys: %s", e)
-            raise HistoryDatabaseError(f"Error setting keys: {key}")
+            raise HistoryDatabaseError(f"Error setting keys: {', '.join(values.keys())}")
+
+        self._update_cached_prefs(guild_id, values)
         
     # Directly get custom keys and values from the document
     async def get_key(self, guild_id: int, key: str):
-        if not key or not isinstance(key, str):
-            raise ValueError("Key must be a non-empty string")
+        return (await self.get_many(guild_id, [key]))[key]
+
+    # Get multiple keys in a single projected read, missing preferences fall back to their defaults
+    # Preferences are served from the in-process cache when possible
+    async def get_many(self, guild_id: int, keys: list) -> dict:
+        guild_id = self._normalize_guild_id(guild_id)
+        for _key in keys:
+            self._validate_key(_key)
+
+        # Serve entirely from cache when only preferences are requested
+        if all(_key in PREFS_KEYS for _key in keys):
+            _cached = self._prefs_cache.get(guild_id)
+            if _cached is not None:
+                return {_key: _cached[_key] for _key in keys}
+
+        # Always fetch all preferences so the cache can be filled in the same round trip
+        _generation = self._begin_prefs_read(guild_id)
+        try:
+            _document = await self._backend.get_fields(guild_id, list(dict.fromkeys([*PREFS_KEYS, *keys])))
+        except Exception as e:
+            logging.error("Error getting keys: %s", e)
+            raise HistoryDatabaseError(f"Error getting keys: {', '.join(keys)}")
+        finally:
+            _unchanged = self._end_prefs_read(guild_id, _generation)
 
+        # The values may be older than a write that finished during the read
+        if _unchanged:
+            self._prefs_cache.set(guild_id, {_key: _document.get(_key, self._defaults[_key]) for _key in PREFS_KEYS})
+        return {_key: _document.get(_key, self._defaults.get(_key)) for _key in keys}
+
+    # Atomically drop all chat threads while keeping user preferences
+    # Optionally set new values in the same round trip
+    async def reset_threads(self, guild_id: int, values: dict = None) -> None:
         guild_id = self._normalize_guild_id(guild_id)
-        _document = await self._ensure_document(guild_id)
+        for _key in (values or {}).keys():
+            self._validate_key(_key)
+
         try:
-            return _document.get(key, None)
+            await self._backend.reset_document(guild_id, PREFS_KEYS, values)
         except Exception as e:
-            logging.error("Error getting key: %s", e)
-            raise HistoryDatabaseError(f"Error getting key: {key}")
+            logging.error("Error resetting chat threads: %s", e)
+            raise HistoryDatabaseError("Error resetting chat threads")
+
+        if values:
+            self._update_cached_prefs(guild_id, values)
 
     # Clear chat history
     async def clear_history(self, guild_id: int) -> None:
         guild_id = self._normalize_guild_id(guild_id)
-        await self._collection.delete_one({"guild_id": guild_id})
+        await self._backend.delete_document(guild_id)
+        self._invalidate_cached_prefs(guild_id)
+
+####################################################################################
+# Chat Threads
+####################################################################################
+    # Load the latest turns of a thread in ascending order
+    # Returns a list of {"seq": int, "turn": dict} records, limit=None loads the entire thread
+    # Older turns can be paged lazily by passing the lowest loaded seq as before_seq
+    async def load_thread(self, guild_id: int, thread: str, limit: int = None, before_seq: int = None) -> list:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+
+        try:
+            return await self._backend.load_turns(guild_id, thread, limit=limit, before_seq=before_seq)
+        except Exception as e:
+            logging.error("Error loading chat thread %s: %s", thread, e)
+            raise HistoryDatabaseError(f"Error loading chat thread: {thread}")
+
+    # Fetch a single turn by its sequence number
+    async def get_turn(self, guild_id: int, thread: str, seq: int) -> dict:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+        return await self._backend.get_turn(guild_id, thread, seq)
+
+    # Append new turns to a thread, write cost only depends on the number of new turns
+    # Returns the sequence numbers assigned to the turns
+    async def append_turns(self, guild_id: int, thread: str, turns: list) -> list:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+        if not turns:
+            return []
+
+        try:
+            return await self._backend.append_turns(guild_id, thread, turns)
+        except Exception as e:
+            logging.error("Error appending turns to chat thread %s: %s", thread, e)
+            raise HistoryDatabaseError(f"Error appending turns to chat thread: {thread}")
+
+    # Replace existing turns by their sequence numbers in a single bulk write
+    async def update_turns(self, guild_id: int, thread: str, turns: dict) -> None:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+        if not turns:
+            return
+
+        try:
+            await self._backend.update_turns(guild_id, thread, turns)
+        except Exception as e:
+            logging.error("Error updating turns in chat thread %s: %s", thread, e)
+            raise HistoryDatabaseError(f"Error updating turns in chat thread: {thread}")
+
+    # Replace a range of turns with fewer turns, e.g. a summary of them
+    async def replace_turns(self, guild_id: int, thread: str, first_seq: int, last_seq: int, turns: list) -> None:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+        if len(turns) > last_seq - first_seq + 1:
+            raise ValueError("Replacement turns must not outnumber the replaced range")
+
+        try:
+            await self._backend.replace_turns(guild_id, thread, first_seq, last_seq, turns)
+        except Exception as e:
+            logging.error("Error replacing turns in chat thread %s: %s", thread, e)
+            raise HistoryDatabaseError(f"Error replacing turns in chat thread: {thread}")
+
+    # Find turns of any user whose _meta.expires_at is before the given UNIX timestamp
+    async def find_expiring_turns(self, before: float, limit: int = 100) -> list:
+        try:
+            return await self._backend.find_expiring_turns(before, limit=limit)
+        except Exception as e:
+            logging.error("Error finding expiring turns: %s", e)
+            raise HistoryDatabaseError("Error finding expiring turns")
+
+    # Store a payload removed from a chat turn, it's deleted along with the thread
+    async def put_archive(self, guild_id: int, thread: str, key: str, value) -> None:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+
+        try:
+            await self._backend.put_archive(guild_id, thread, key, value)
+        except Exception as e:
+            logging.error("Error archiving %s from chat thread %s: %s", key, thread, e)
+            raise HistoryDatabaseError(f"Error archiving payload from chat thread: {thread}")
+
+    # Fetch an archived payload, returns None if it doesn't exist
+    async def get_archive(self, guild_id: int, key: str):
+        guild_id = self._normalize_guild_id(guild_id)
+        if not key or not isinstance(key, str):
+            raise ValueError("Key must be a non-empty string")
+        return await self._backend.get_archive(guild_id, key)
+
+    # Clear a single chat thread
+    # Optionally set new values in the same round trip
+    async def clear_thread(self, guild_id: int, thread: str, values: dict = None) -> None:
+        guild_id = self._normalize_guild_id(guild_id)
+        thread = self._validate_thread(thread)
+        for _key in (values or {}).keys():
+            self._validate_key(_key)
+
+        try:
+            await self._backend.delete_thread(guild_id, thread, values)
+        except Exception as e:
+            logging.error("Error clearing chat thread %s: %s", thread, e)
+            raise HistoryDatabaseError(f"Error clearing chat thread: {thread}")
 
+        if values:
+            self._update_cached_prefs(guild_id, values)
+
+####################################################################################
+# Shared cache
+####################################################################################
+    # Entries shared across users and bot processes, e.g. uploaded files by content hash
+    # The cache is best effort, so failures are logged and treated as misses
+    async def get_cached(self, namespace: str, key: str):
+        try:
+            return await self._backend.get_cache_entry(namespace, key)
+        except Exception as e:
+            logging.error("Error reading shared cache entry %s:%s: %s", namespace, key, e)
+            return None
+
+    # ttl is in seconds, None never expires
+    async def set_cached(self, namespace: str, key: str, value, ttl: float = None) -> None:
+        try:
+            await self._backend.set_cache_entry(namespace, key, value, expires_at=time.time() + ttl if ttl is not None else None)
+        except Exception as e:
+            logging.error("Error writing shared cache entry %s:%s: %s", namespace, key, e)
+
+    async def delete_cached(self, namespace: str, key: str) -> None:
+        try:
+            await self._backend.delete_cache_entry(namespace, key)
+        except Exception as e:
+            logging.error("Error deleting shared cache entry %s:%s: %s", namespace, key, e)
@@ -0,0 +1,585 @@
+from email.utils import parsedate_to_datetime
+from multidict import CIMultiDict, CIMultiDictProxy
+from os import environ
+from yarl import URL
+import aiohttp
+import aiosqlite
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+# zstd is optional, bodies are compressed with zlib without it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Persistent HTTP cache for the shared aiohttp session
+# GET responses with an ETag, Last-Modified or a max-age are stored compressed in a local SQLite file.
+# Fresh responses are served without a request, stale ones are revalidated with If-None-Match and
+# If-Modified-Since so unchanged resources come back as a 304 that doesn't count against API quotas
+HTTP_CACHE_PATH = environ.get("HTTP_CACHE_PATH", "http_cache.db")
+
+# Total size of the stored responses, the least recently used responses are evicted first
+HTTP_CACHE_MAX_BYTES = int(environ.get("HTTP_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Larger responses are passed through without being stored
+HTTP_CACHE_MAX_ENTRY_BYTES = int(environ.get("HTTP_CACHE_MAX_ENTRY_BYTES", 2 * 1024 * 1024))
+
+# Only API and page responses are stored, media is downloaded once
+_CACHEABLE_CONTENT_TYPES = ("json", "text/", "xml", "javascript")
+
+# Discord attachments are user uploads fetched once per message, including text and JSON files,
+# and their signed URLs change when they expire so storing them only evicts useful responses
+_UNCACHED_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+# Describe the stored body rather than the original transfer, aiohttp already decoded it
+_DROPPED_HEADERS = ("Content-Encoding", "Content-Length", "Transfer-Encoding", "Connection", "Keep-Alive", "Set-Cookie")
+
+# Headers of a 304 that must not replace the stored ones
+_NOT_UPDATED_HEADERS = _DROPPED_HEADERS + ("Content-Type",)
+
+# Request headers that can't carry credentials, every other header is part of the cache key
+# so responses fetched with different API keys in custom headers are stored separately
+# Content negotiation headers are matched with Vary instead
+_UNKEYED_REQUEST_HEADERS = ("Accept", "Accept-Encoding", "Accept-Language", "Cache-Control", "Connection", "Pragma", "Referer", "User-Agent")
+
+# Last access times are only written when they're older than this many seconds
+# so serving fresh responses doesn't cost a database write each
+_TOUCH_INTERVAL = 300
+
+_COMPRESS_IN_THREAD_BYTES = 64 * 1024
+
+_zstd_compressor = zstandard.ZstdCompressor(level=3) if zstandard else None
+_zstd_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+def _compress(data: bytes) -> tuple:
+    if _zstd_compressor:
+        return "zstd", _zstd_compressor.compress(data)
+    return "zlib", zlib.compress(data, 6)
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        if not _zstd_decompressor:
+            raise RuntimeError("The cached response is zstd compressed but zstandard is not installed")
+        return _zstd_decompressor.decompress(data)
+    return zlib.decompress(data)
+
+def _parse_cache_control(value: str) -> dict:
+    _directives = {}
+    for _directive in (value or "").split(","):
+        _name, _, _argument = _directive.strip().partition("=")
+        if _name:
+            _directives[_name.lower()] = _argument.strip('"')
+    return _directives
+
+def _parse_http_date(value: str) -> float:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+# Seconds from now the response stays fresh, 0 when it must be revalidated before every use
+def _freshness(headers) -> float:
+    _cache_control = _parse_cache_control(headers.get("Cache-Control"))
+    if "no-cache" in _cache_control:
+        return 0
+
+    if "max-age" in _cache_control:
+        try:
+            _max_age = int(_cache_control["max-age"])
+        except ValueError:
+            return 0
+        try:
+            _age = int(headers.get("Age") or 0)
+        except ValueError:
+            _age = 0
+        return max(_max_age - _age, 0)
+
+    _expires = _parse_http_date(headers.get("Expires"))
+    if _expires is not None:
+        _date = _parse_http_date(headers.get("Date")) or time.time()
+        return max(_expires - _date, 0)
+    return 0
+
+def _is_storable(response: aiohttp.ClientResponse) -> bool:
+    if response.status != 200:
+        return False
+    if "no-store" in _parse_cache_control(response.headers.get("Cache-Control")):
+        return False
+    if response.headers.get("Vary", "").strip() == "*":
+        return False
+    if not any(_type in response.headers.get("Content-Type", "").lower() for _type in _CACHEABLE_CONTENT_TYPES):
+        return False
+    if response.content_length is not None and response.content_length > HTTP_CACHE_MAX_ENTRY_BYTES:
+        return False
+    return bool(response.headers.get("ETag") or response.headers.get("Last-Modified") or _freshness(response.headers))
+
+# Subset of aiohttp.StreamReader for reading a body that's already in memory
+# rest is the response the remaining body is read from when only the beginning was buffered
+class _BufferedStream:
+    def __init__(self, data: bytes, rest: aiohttp.ClientResponse = None):
+        self._data = data
+        self._rest = rest
+
+    def at_eof(self) -> bool:
+        return not self._data and (self._rest is None or self._rest.content.at_eof())
+
+    async def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            _data = self._data + (await self._rest.content.read() if self._rest else b"")
+            self._data = b""
+            return _data
+        if not self._data and self._rest:
+            return await self._rest.content.read(n)
+
+        _data, self._data = self._data[:n], self._data[n:]
+        return _data
+
+    async def readany(self) -> bytes:
+        return await self.read(65536)
+
+    async def iter_chunked(self, n: int):
+        while _chunk := await self.read(n):
+            yield _chunk
+
+    async def iter_any(self):
+        while _chunk := await self.readany():
+            yield _chunk
+
+# Response with a body in memory, returned for cached responses and responses read to be stored
+# It implements the parts of aiohttp.ClientResponse used with the shared session
+class CachedResponse:
+    def __init__(self, method: str, url: URL, status: int, reason: str, headers, body: bytes, rest: aiohttp.ClientResponse = None, from_cache: bool = False):
+        self.method = method
+        self.url = url
+        self.real_url = url
+        self.status = status
+        self.reason = reason
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.content = _BufferedStream(body, rest)
+        self.history = ()
+
+        # True when the body came from the cache rather than the network
+        self.from_cache = from_cache
+
+        self._body = body if rest is None else None
+        self._rest = rest
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get("Content-Type", "application/octet-stream").split(";")[0].strip().lower()
+
+    @property
+    def content_length(self) -> int:
+        return len(self._body) if self._body is not None else self._rest.content_length
+
+    @property
+    def charset(self) -> str:
+        for _param in self.headers.get("Content-Type", "").split(";")[1:]:
+            _name, _, _value = _param.strip().partition("=")
+            if _name.lower() == "charset":
+                return _value.strip('"')
+        return None
+
+    def get_encoding(self) -> str:
+        return self.charset or "utf-8"
+
+    @property
+    def request_info(self) -> aiohttp.RequestInfo:
+        return aiohttp.RequestInfo(self.url, self.method, CIMultiDictProxy(CIMultiDict()), self.url)
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise aiohttp.ClientResponseError(self.request_info, (), status=self.status, message=self.reason, headers=self.headers)
+
+    async def read(self) -> bytes:
+        if self._body is None:
+            self._body = await self.content.read()
+        return self._body
+
+    async def text(self, encoding: str = None, errors: str = "strict") -> str:
+        return (await self.read()).decode(encoding or self.get_encoding(), errors=errors)
+
+    async def json(self, *, encoding: str = None, loads=json.loads, content_type: str = "application/json"):
+        _text = (await self.text(encoding)).strip()
+        if not _text:
+            return None
+        if content_type and content_type not in self.content_type:
+            raise aiohttp.ContentTypeError(self.request_info, (), status=self.status, message=f"Attempt to decode JSON with unexpected mimetype: {self.content_type}", headers=self.headers)
+        return loads(_text)
+
+    def release(self) -> None:
+        if self._rest is not None:
+            self._rest.release()
+
+    def close(self) -> None:
+        if self._rest is not None:
+            self._rest.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.release()
+
+class HTTPCacheStore:
+    def __init__(self, path: str = HTTP_CACHE_PATH, max_bytes: int = HTTP_CACHE_MAX_BYTES):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._conn: aiosqlite.Connection = None
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._bytes = 0
+        self._entries = 0
+
+        # Counters
+        self.hits = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": self._entries,
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "stored": self.stored,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors
+        }
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        async with self._connect_lock:
+            if self._conn is None:
+                _conn = await aiosqlite.connect(self._path)
+                await _conn.execute("PRAGMA journal_mode=WAL")
+                await _conn.execute("PRAGMA synchronous=NORMAL")
+                await _conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, status INTEGER NOT NULL, reason TEXT, headers TEXT NOT NULL, vary TEXT, "
+                    "codec TEXT NOT NULL, body BLOB NOT NULL, size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL) WITHOUT ROWID"
+                )
+                await _conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+                await _conn.commit()
+
+                async with _conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses") as _cursor:
+                    self._entries, self._bytes = await _cursor.fetchone()
+                logging.info("Opened the HTTP cache %s with %s responses", self._path, self._entries)
+                self._conn = _conn
+        return self._conn
+
+    # Returns the stored entry as a dict or None
+    async def get(self, key: str) -> dict:
+        _conn = await self._connection()
+        async with _conn.execute("SELECT status, reason, headers, vary, codec, body, expires_at, accessed_at FROM responses WHERE key = ?", (key,)) as _cursor:
+            _row = await _cursor.fetchone()
+        if not _row:
+            return None
+
+        _status, _reason, _headers, _vary, _codec, _body, _expires_at, _accessed_at = _row
+        return {
+            "status": _status,
+            "reason": _reason,
+            "headers": json.loads(_headers),
+            "vary": json.loads(_vary) if _vary else {},
+            "codec": _codec,
+            "body": _body,
+            "expires_at": _expires_at,
+            "accessed_at": _accessed_at
+        }
+
+    async def touch(self, key: str, headers: list = None, expires_at: float = None) -> None:
+        _conn = await self._connection()
+        async with self._write_lock:
+            if headers is None:
+                await _conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            else:
+                await _conn.execute(
+                    "UPDATE responses SET accessed_at = ?, headers = ?, expires_at = ? WHERE key = ?",
+                    (time.time(), json.dumps(headers), expires_at, key)
+                )
+            await _conn.commit()
+
+    async def put(self, key: str, status: int, reason: str, headers: list, vary: dict, body: bytes, expires_at: float) -> None:
+        if len(body) > _COMPRESS_IN_THREAD_BYTES:
+            _codec, _compressed = await asyncio.to_thread(_compress, body)
+        else:
+            _codec, _compressed = _compress(body)
+
+        _headers = json.dumps(headers)
+        _size = len(_compressed) + len(_headers)
+        if _size > self._max_bytes:
+            return
+
+        _conn = await self._connection()
+        async with self._write_lock:
+            async with _conn.execute("SELECT size FROM responses WHERE key = ?", (key,)) as _cursor:
+                _previous = await _cursor.fetchone()
+            await _conn.execute(
+                "INSERT OR REPLACE INTO responses (key, status, reason, headers, vary, codec, body, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, status, reason, _headers, json.dumps(vary) if vary else None, _codec, _compressed, _size, expires_at, time.time())
+            )
+            if _previous:
+                self._bytes -= _previous[0]
+            else:
+                self._entries += 1
+            self._bytes += _size
+            self.stored += 1
+
+            # Evict the least recently used responses
+            if self._bytes > self._max_bytes:
+                async with _conn.execute("SELECT key, size FROM responses ORDER BY accessed_at") as _cursor:
+                    _evicted = []
+                    async for _key, _entry_size in _cursor:
+                        if self._bytes <= self._max_bytes:
+                            break
+                        _evicted.append((_key,))
+                        self._bytes -= _entry_size
+                        self._entries -= 1
+                await _conn.executemany("DELETE FROM responses WHERE key = ?", _evicted)
+                self.evictions += len(_evicted)
+            await _conn.commit()
+
+    async def delete(self, key: str) -> None:
+        _conn = await self._connection()
+        async with self._write_lock:
+            async with _conn.execute("SELECT size FROM responses WHERE key = ?", (key,)) as _cursor:
+                _row = await _cursor.fetchone()
+            if _row:
+                await _conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._bytes -= _row[0]
+                self._entries -= 1
+            await _conn.commit()
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+# Returned by CachedClientSession.request, usable with both await and async with like aiohttp's
+class _RequestContextManager:
+    def __init__(self, coroutine):
+        self._coroutine = coroutine
+        self._response = None
+
+    def __await__(self):
+        return self._coroutine.__await__()
+
+    async def __aenter__(self):
+        self._response = await self._coroutine
+        return self._response
+
+    async def __aexit__(self, *args):
+        self._response.release()
+
+# Wraps an aiohttp.ClientSession so GET requests go through the HTTP cache, everything else is passed through
+class CachedClientSession:
+    def __init__(self, session: aiohttp.ClientSession, store: HTTPCacheStore):
+        self._session = session
+        self._store = store
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def stats(self) -> dict:
+        return self._store.stats()
+
+    async def close(self) -> None:
+        await self._session.close()
+        await self._store.close()
+
+    def request(self, method: str, url, **kwargs) -> _RequestContextManager:
+        return _RequestContextManager(self._request(method, url, **kwargs))
+
+    def get(self, url, **kwargs) -> _RequestContextManager:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self._session.head(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._session.post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._session.put(url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self._session.patch(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._session.delete(url, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self._session.options(url, **kwargs)
+
+    def _request_headers(self, kwargs: dict) -> CIMultiDict:
+        _headers = CIMultiDict(self._session.headers)
+        _headers.update(kwargs.get("headers") or {})
+        return _headers
+
+    # Responses to requests with different credentials are stored separately
+    def _key(self, method: str, url: URL, headers: CIMultiDict, kwargs: dict) -> str:
+        _auth = kwargs.get("auth") or self._session.auth
+        _keyed_headers = sorted(
+            f"{_name.lower()}: {_value}" for _name, _value in headers.items()
+            if not any(_name.lower() == _unkeyed.lower() for _unkeyed in _UNKEYED_REQUEST_HEADERS)
+        )
+        _credentials = "\n".join([*_keyed_headers, _auth.encode() if _auth else ""])
+        return hashlib.sha256(f"{method}\n{url}\n{_credentials}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _vary(response_headers, request_headers: CIMultiDict) -> dict:
+        return {
+            _name.strip().lower(): request_headers.get(_name.strip(), "")
+            for _name in response_headers.get("Vary", "").split(",") if _name.strip()
+        }
+
+    @staticmethod
+    def _stored_headers(headers) -> list:
+        return [(_name, _value) for _name, _value in headers.items() if _name not in _DROPPED_HEADERS]
+
+    async def _request(self, method: str, url, **kwargs):
+        _headers = self._request_headers(kwargs)
+        _cache_control = _parse_cache_control(_headers.get("Cache-Control"))
+        _url = URL(url)
+        # Requests that don't simply fetch a resource, that handle caching themselves or that fetch Discord attachments
+        if method.upper() != "GET" or "data" in kwargs or "json" in kwargs or "no-store" in _cache_control \
+            or any(_name in _headers for _name in ("Range", "If-None-Match", "If-Modified-Since")) \
+            or _url.host in _UNCACHED_HOSTS:
+            return await self._session.request(method, url, **kwargs)
+
+        if kwargs.get("params"):
+            _url = _url.extend_query(kwargs["params"])
+        _key = self._key("GET", _url, _headers, kwargs)
+
+        _entry = None
+        try:
+            _entry = await self._store.get(_key)
+            if _entry and _entry["vary"] != self._vary(CIMultiDict(_entry["headers"]), _headers):
+                _entry = None
+        except Exception:
+            self._store.errors += 1
+            logging.warning("Failed to read the HTTP cache, sending the request", exc_info=True)
+
+        # Fresh, no request needed
+        if _entry and _entry["expires_at"] > time.time() and "no-cache" not in _cache_control:
+            try:
+                return await self._from_entry(_key, _url, _entry)
+            except Exception:
+                self._store.errors += 1
+                logging.warning("Failed to read a response from the HTTP cache, sending the request", exc_info=True)
+                _entry = None
+
+        # Stale, ask the server if it changed
+        if _entry:
+            _stored_headers = CIMultiDict(_entry["headers"])
+            _conditional = {}
+            if _stored_headers.get("ETag"):
+                _conditional["If-None-Match"] = _stored_headers["ETag"]
+            if _stored_headers.get("Last-Modified"):
+                _conditional["If-Modified-Since"] = _stored_headers["Last-Modified"]
+            if _conditional:
+                kwargs["headers"] = {**(kwargs.get("headers") or {}), **_conditional}
+
+        _response = await self._session.request(method, url, **kwargs)
+
+        if _entry and _response.status == 304:
+            # Unchanged, refresh the stored headers from the 304
+            _stored_headers = CIMultiDict(_entry["headers"])
+            for _name, _value in _response.headers.items():
+                if _name not in _NOT_UPDATED_HEADERS:
+                    _stored_headers[_name] = _value
+            _response.release()
+
+            _entry["headers"] = list(_stored_headers.items())
+            _entry["expires_at"] = time.time() + _freshness(_stored_headers)
+            self._store.revalidated += 1
+            try:
+                return await self._from_entry(_key, _url, _entry, refreshed=True)
+            except Exception:
+                # The stored body can't be used, fetch it again without validators
+                self._store.errors += 1
+                logging.warning("Failed to read a revalidated response from the HTTP cache, sending the request again", exc_info=True)
+                try:
+                    await self._store.delete(_key)
+                except Exception:
+                    self._store.errors += 1
+                    logging.warning("Failed to delete a response from the HTTP cache", exc_info=True)
+                for _name in _conditional:
+                    kwargs["headers"].pop(_name, None)
+                return await self._session.request(method, url, **kwargs)
+
+        self._store.misses += 1
+        if not _is_storable(_response):
+            return _response
+
+        # Read the body to store it, stop when it turns out larger than an entry can be
+        _buffer = bytearray()
+        while len(_buffer) <= HTTP_CACHE_MAX_ENTRY_BYTES:
+            _chunk = await _response.content.read(65536)
+            if not _chunk:
+                break
+            _buffer += _chunk
+        _body = bytes(_buffer)
+
+        if len(_body) > HTTP_CACHE_MAX_ENTRY_BYTES:
+            return CachedResponse("GET", _response.url, _response.status, _response.reason, _response.headers, _body, rest=_response)
+
+        _response.release()
+        try:
+            await self._store.put(
+                _key,
+                _response.status,
+                _response.reason,
+                self._stored_headers(_response.headers),
+                self._vary(_response.headers, _headers),
+                _body,
+                time.time() + _freshness(_response.headers)
+            )
+        except Exception:
+            self._store.errors += 1
+            logging.warning("Failed to store the response of %s in the HTTP cache", _url.host, exc_info=True)
+        return CachedResponse("GET", _response.url, _response.status, _response.reason, self._stored_headers(_response.headers), _body)
+
+    async def _from_entry(self, key: str, url: URL, entry: dict, refreshed: bool = False) -> CachedResponse:
+        if len(entry["body"]) > _COMPRESS_IN_THREAD_BYTES:
+            _body = await asyncio.to_thread(_decompress, entry["codec"], entry["body"])
+        else:
+            _body = _decompress(entry["codec"], entry["body"])
+
+        try:
+            if refreshed:
+                await self._store.touch(key, entry["headers"], entry["expires_at"])
+            elif time.time() - entry["accessed_at"] > _TOUCH_INTERVAL:
+                await self._store.touch(key)
+        except Exception:
+            self._store.errors += 1
+            logging.warning("Failed to update the HTTP cache", exc_info=True)
+
+        if not refreshed:
+            self._store.hits += 1
+        return CachedResponse("GET", url, entry["status"], entry["reason"], entry["headers"], _body, from_cache=True)
+
+# Returns the session shared by the bot, wrapped with the HTTP cache unless HTTP_CACHE_PATH is empty
+def create_http_session(**kwargs):
+    _session = aiohttp.ClientSession(**kwargs)
+    if not HTTP_CACHE_PATH or HTTP_CACHE_MAX_BYTES <= 0:
+        return _session
+    return CachedClientSession(_session, HTTPCacheStore())
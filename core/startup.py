@@ -36,6 +36,11 @@ class SubClassBotPlugServices(bridge.Bot):
         #logging.info("OpenAI client for Groq initialized successfully")
 
     async def stop_services(self):
+        # Flush pending writes and close the chat history database
+        if hasattr(self, "history_db"):
+            await self.history_db.close()
+            logging.info("Chat history database closed successfully")
+
         # Close aiohttp client sessions
         await self.aiohttp_instance.close()
         logging.info("aiohttp client session closed successfully")
\ No newline at end of file
@@ -1,9 +1,10 @@
+from core.config import config_registry
+from core.http_cache import create_http_session
 from core.startup import SubClassBotPlugServices
 from inspect import cleandoc
 from os import chdir, mkdir, environ
 from pathlib import Path
 import aiofiles.os
-import aiohttp
 import discord
 import dotenv
 import logging
@@ -54,10 +55,13 @@ class InitBot(SubClassBotPlugServices):
         self.loop.create_task(self.start_services())
         logging.info("Services initialized successfully")
 
-        # HTTP Client
-        self.aiohttp_instance = aiohttp.ClientSession(loop=self.loop)
+        # HTTP Client, GET responses are cached on disk and revalidated, see core.http_cache
+        self.aiohttp_instance = create_http_session(loop=self.loop)
         logging.info("HTTP client session initialized successfully")
 
+        # Reload data files such as models.yaml when they're edited
+        self._config_watcher = self.loop.create_task(config_registry.watch())
+
 
     def _lock_socket_instance(self, port):
         try:
@@ -76,6 +80,9 @@ class InitBot(SubClassBotPlugServices):
 
     # Shutdown the bot
     async def close(self):
+        # Stop reloading data files
+        self._config_watcher.cancel()
+
         # Close services
         await self.stop_services()
         logging.info("Services stopped successfully")
@@ -90,12 +97,9 @@ class InitBot(SubClassBotPlugServices):
 
         await super().close()
 
-bot = InitBot(command_prefix=environ.get("BOT_PREFIX", "$"), intents = intents)
-
 ###############################################
 # ON USER MESSAGE
 ###############################################
-@bot.event
 async def on_message(message: discord.Message):
     # https://discord.com/channels/881207955029110855/1146373275669241958
     await bot.process_commands(message)
@@ -126,13 +130,19 @@ async def on_message(message: discord.Message):
                     If you have any questions, you can visit my [documentation or contact me here](https://zavocc.github.io)"""))
 
 
-with open('commands.yaml', 'r') as file:
-    cog_commands = yaml.safe_load(file)
-    for command in cog_commands:
-        try:
-            bot.load_extension(f'cogs.{command}')
-        except Exception as e:
-            logging.error("cogs.%s failed to load, skipping... The following error of the cog: %s", command, e)
-            continue
+# Image preprocessing workers are spawned and import this module again, so the bot only starts when it's run directly
+if __name__ == "__main__":
+    bot = InitBot(command_prefix=environ.get("BOT_PREFIX", "$"), intents = intents)
+    bot.event(on_message)
+
+    with open('commands.yaml', 'r') as file:
+        cog_commands = yaml.safe_load(file)
+        for command in cog_commands:
+            try:
+                bot.load_extension(f'cogs.{command}')
+            except Exception as e:
+                logging.error("cogs.%s failed to load, skipping... The following error of the cog: %s", command, e)
+                continue
+
+    bot.run(environ.get('TOKEN'))
 
-bot.run(environ.get('TOKEN')) 
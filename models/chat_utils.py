@@ -1,36 +1,193 @@
+from .compaction import drop_compacted_updates, stub_tool_outputs
+from .config import get_chat_models
+from .context_window import get_turn_tokens, load_thread_window
+from .turns import decode_turn, encode_turn
 from .validation import ModelProps
 from core.database import History
 from core.exceptions import CustomErrorMessage
-import aiofiles
+from os import environ
+import asyncio
 import logging
-import yaml
+import time
 # Methods for generative_chat.py
 
+# Files are treated as expired this many seconds early so they don't expire mid-request
+CHAT_FILE_EXPIRY_MARGIN = int(environ.get("CHAT_FILE_EXPIRY_MARGIN", 600))
+
+# How often expired files are cleared from stored threads in seconds, 0 disables the janitor
+CHAT_FILE_JANITOR_INTERVAL = int(environ.get("CHAT_FILE_JANITOR_INTERVAL", 3600))
+
+FILE_EXPIRED_NOTICE = "[<system_notice>File attachment processed but expired from history. DO NOT make stuff up about it! Ask the user to reattach for more details</system_notice>]"
+
 # Fetch and validate models
 async def fetch_model(model_alias: str) -> ModelProps:
-    # Load the models list from YAML file
-    async with aiofiles.open("data/models.yaml", "r") as models:
-        _models_list = yaml.safe_load(await models.read())
-
-    # Find the model dict with the matching alias
-    _model_dict = next((mdl for mdl in _models_list if mdl.get("model_alias") == model_alias), None)
+    # Models are validated once when data/models.yaml is loaded
+    _model_props = get_chat_models().by_alias.get(model_alias)
 
-    if not _model_dict:
+    if not _model_props:
         raise CustomErrorMessage("⚠️ The current model you had chosen is not yet available, please try another model.")
 
-    return ModelProps(**_model_dict)
+    return _model_props
+
+############################################
+# TURN METADATA
+############################################
+# Turns loaded from the database carry bookkeeping under the "_meta" key, e.g. its sequence number
+# Providers must never send it to the model, so strip it before each request
+def strip_turn_metadata(chat_history: list) -> list:
+    _stripped = []
+    for _turn in chat_history:
+        if not isinstance(_turn, dict):
+            _stripped.append(_turn)
+            continue
+
+        _turn = {_key: _value for _key, _value in _turn.items() if _key != "_meta"}
+
+        # Parts may also carry metadata, e.g. file uploads
+        for _parts_key in ("parts", "content"):
+            if isinstance(_turn.get(_parts_key), list):
+                _turn[_parts_key] = [
+                    {_key: _value for _key, _value in _part.items() if _key != "_meta"} if isinstance(_part, dict) else _part
+                    for _part in _turn[_parts_key]
+                ]
+        _stripped.append(_turn)
+    return _stripped
+
+# Flag a loaded turn as modified so save_history writes it back
+def mark_turn_dirty(turn: dict) -> None:
+    _meta = turn.setdefault("_meta", {})
+    _meta["dirty"] = True
+
+    # The cached token count is stale
+    _meta.pop("tokens", None)
+
+############################################
+# FILE EXPIRY
+############################################
+# Earliest expiry of the file parts in a turn, stored in the turn metadata so expiring turns can be queried
+def update_turn_expiry(turn: dict) -> None:
+    _expiries = [
+        _part["_meta"]["expires_at"] for _part in turn.get("parts") or []
+        if isinstance(_part, dict) and _part.get("file_data") and "expires_at" in (_part.get("_meta") or {})
+    ]
+    if _expiries:
+        turn.setdefault("_meta", {})["expires_at"] = min(_expiries)
+    elif "expires_at" in (turn.get("_meta") or {}):
+        del turn["_meta"]["expires_at"]
+
+# Replace Gemini file parts that are expired or about to expire with a notice, returns the number of replaced parts
+def expire_file_parts(chat_history: list, now: float = None) -> int:
+    _deadline = (now or time.time()) + CHAT_FILE_EXPIRY_MARGIN
+    _expired = 0
+    for _turn in chat_history:
+        if not isinstance(_turn, dict) or (_turn.get("_meta") or {}).get("expires_at", _deadline) >= _deadline:
+            continue
+
+        for _part in _turn.get("parts") or []:
+            if isinstance(_part, dict) and _part.get("file_data") and (_part.get("_meta") or {}).get("expires_at", _deadline) < _deadline:
+                _part.pop("file_data")
+                _part.pop("_meta")
+                _part["text"] = FILE_EXPIRED_NOTICE
+                _expired += 1
+
+        update_turn_expiry(_turn)
+        mark_turn_dirty(_turn)
+    return _expired
+
+# Clears expired files from stored threads so they don't need to be rewritten when the thread is loaded
+async def file_expiry_janitor(db_conn: History) -> None:
+    if not CHAT_FILE_JANITOR_INTERVAL:
+        return
+
+    while True:
+        await asyncio.sleep(CHAT_FILE_JANITOR_INTERVAL)
+        try:
+            _cleared = 0
+
+            # Batches are bounded so a turn that can't be rewritten doesn't keep the janitor busy
+            for _ in range(100):
+                _records = await db_conn.find_expiring_turns(time.time() + CHAT_FILE_EXPIRY_MARGIN)
+                if not _records:
+                    break
+
+                # Only Gemini turns carry expiring files
+                _updates = {}
+                for _record in _records:
+                    _turn = decode_turn(_record["turn"], "google")
+                    if _turn is None:
+                        continue
+                    _cleared += expire_file_parts([_turn])
+                    _turn["_meta"].pop("dirty", None)
+                    get_turn_tokens(_turn)
+                    _updates.setdefault((_record["guild_id"], _record["thread"]), {})[_record["seq"]] = encode_turn(_turn, "google")
+
+                for (_guild_id, _thread), _turns in _updates.items():
+                    await db_conn.update_turns(_guild_id, _thread, _turns)
+
+            if _cleared:
+                logging.info("Cleared %s expired files from stored chat threads", _cleared)
+        except Exception as e:
+            logging.error("Error clearing expired files from stored chat threads, reason: %s", e)
 
 # Load chat history from thread_name
-async def load_history(user_id: int, thread_name: str, db_conn: History) -> list:
-    """Fetch chat history for a specific thread_name using get_key method."""
+async def load_history(user_id: int, thread_name: str, db_conn: History, sdk: str) -> list:
+    """Fetch the latest turns of a chat thread in the wire format of the sdk, each turn is tagged with its sequence number."""
     try:
-        _history = await db_conn.get_key(user_id, f"chat_thread_{thread_name}")
-        return _history # Returns none for new threads
+        _records = await load_thread_window(user_id, thread_name, db_conn, sdk)
     except Exception as e:
+        # None means a new thread, which would be saved on top of the existing one
         logging.error("Error loading history for thread_name %s, reason: %s", thread_name, e)
-        return None
+        raise CustomErrorMessage("⚠️ Your chat history could not be loaded, please try again later.") from e
+
+    if not _records:
+        return None # Returns none for new threads
+
+    _history = []
+    for _record in _records:
+        _turn = _record["turn"]
+        _turn["_meta"] = {**(_turn.get("_meta") or {}), "seq": _record["seq"]}
+        _history.append(_turn)
+    return _history or None
 
 # Save chat history
-async def save_history(user_id: int, thread_name: str, chat_thread: list, db_conn: History) -> None:
-    """Save chat history for a specific thread_name using set_key method."""
-    await db_conn.set_key(user_id, f"chat_thread_{thread_name}", chat_thread)
\ No newline at end of file
+async def save_history(user_id: int, thread_name: str, chat_thread: list, db_conn: History, sdk: str) -> None:
+    """Append new turns and write back modified turns of a chat thread, turns are stored in the compact format."""
+    # Older tool outputs are archived so they aren't sent with every request
+    await stub_tool_outputs(user_id, thread_name, chat_thread, db_conn)
+
+    _new_turns = []
+    _dirty_turns = {}
+
+    for _turn in chat_thread:
+        _meta = _turn.get("_meta") or {}
+
+        # Stored turns that weren't modified are skipped so they aren't encoded again
+        if "seq" in _meta and not _meta.get("dirty"):
+            continue
+
+        # Cache token counts of new and modified turns so they don't need to be estimated again
+        get_turn_tokens(_turn)
+        update_turn_expiry(_turn)
+        _meta = _turn["_meta"]
+
+        # Drop bookkeeping keys before storing
+        _stored_meta = {_key: _value for _key, _value in _meta.items() if _key not in ("seq", "dirty")}
+        _stored_turn = {_key: _value for _key, _value in _turn.items() if _key != "_meta"}
+        if _stored_meta:
+            _stored_turn["_meta"] = _stored_meta
+        _stored_turn = encode_turn(_stored_turn, sdk)
+
+        # Nothing left to store, e.g. a Gemini turn made only of thoughts
+        if _stored_turn is None:
+            continue
+
+        if "seq" not in _meta:
+            _new_turns.append(_stored_turn)
+        elif _meta.get("dirty"):
+            _dirty_turns[_meta["seq"]] = _stored_turn
+
+    # The thread may have been compacted since it was loaded
+    _dirty_turns = await drop_compacted_updates(user_id, thread_name, _dirty_turns, db_conn)
+
+    await db_conn.update_turns(user_id, thread_name, _dirty_turns)
+    await db_conn.append_turns(user_id, thread_name, _new_turns)
@@ -0,0 +1,329 @@
+from .context_window import PINNED_HEAD_TURNS, get_turn_tokens, is_user_turn, load_thread_window, load_turns_between, pinned_length
+from .turns import encode_turn
+from core.database import History
+from models.core import set_assistant_type
+from models.tasks.text_model_utils import fetch_text_model_config_async
+from os import environ
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+# Keeps stored chat threads small
+# - Large tool outputs are replaced with stubs once they're a few turns old, see stub_tool_outputs
+# - Old turns are summarized in the background after save_history, see schedule_compaction
+
+# Threads whose estimated tokens exceed this are compacted, 0 disables compaction
+CHAT_COMPACTION_THRESHOLD = int(environ.get("CHAT_COMPACTION_THRESHOLD", 64000))
+
+# Estimated tokens of the newest turns that are always kept verbatim
+CHAT_COMPACTION_KEEP_TOKENS = int(environ.get("CHAT_COMPACTION_KEEP_TOKENS", 16000))
+
+# Tool results and arguments are clipped in the transcript sent to the summarizer
+TRANSCRIPT_TOOL_CHARS = 2000
+
+# Tool outputs are stubbed once this many user turns came after them, 0 disables stubbing
+CHAT_TOOL_OUTPUT_STUB_AFTER = int(environ.get("CHAT_TOOL_OUTPUT_STUB_AFTER", 3))
+
+# Only tool outputs larger than this many characters are stubbed
+CHAT_TOOL_OUTPUT_STUB_MIN_CHARS = int(environ.get("CHAT_TOOL_OUTPUT_STUB_MIN_CHARS", 2000))
+
+# Characters of the original output kept in the stub
+STUB_PREVIEW_CHARS = 200
+
+# Built-in tool that returns archived outputs, see tools/builtin/tools/fetch_archived_tool_output.py
+ARCHIVE_TOOL_NAME = "fetch_archived_tool_output"
+
+# Threads being compacted and the background tasks, the references keep tasks from being garbage collected
+_compacting = set()
+_background_tasks = set()
+
+# Checks if the thread is large enough to be compacted, chat_thread is the loaded window along with the new turns
+def needs_compaction(chat_thread: list) -> bool:
+    if not CHAT_COMPACTION_THRESHOLD or not chat_thread:
+        return False
+    return sum(get_turn_tokens(_turn) for _turn in chat_thread if isinstance(_turn, dict)) > CHAT_COMPACTION_THRESHOLD
+
+def _clip(text: str) -> str:
+    return text if len(text) <= TRANSCRIPT_TOOL_CHARS else f"{text[:TRANSCRIPT_TOOL_CHARS]}... (truncated)"
+
+# Renders a turn of any provider format as plain text for the summarizer
+def _render_turn(turn: dict) -> str:
+    if isinstance(turn.get("parts"), list):
+        _parts = turn["parts"]
+    elif isinstance(turn.get("content"), list):
+        _parts = turn["content"]
+    elif isinstance(turn.get("content"), str):
+        _parts = [turn["content"]]
+    else:
+        # Gemini tool results are stored as bare parts
+        _parts = [turn]
+
+    _lines = []
+    for _part in _parts:
+        if isinstance(_part, str):
+            _lines.append(_part if turn.get("role") != "tool" else f"[tool result: {_clip(_part)}]")
+        elif not isinstance(_part, dict) or _part.get("thought"):
+            continue
+        elif _part.get("function_call"):
+            _lines.append(f"[called tool {_part['function_call'].get('name')} with {_clip(json.dumps(_part['function_call'].get('args'), default=str))}]")
+        elif _part.get("function_response"):
+            _lines.append(f"[tool {_part['function_response'].get('name')} returned: {_clip(json.dumps(_part['function_response'].get('response'), default=str))}]")
+        elif _part.get("file_data") or _part.get("inline_data") or _part.get("type") == "image_url":
+            _lines.append("[file attachment]")
+        elif _part.get("text"):
+            _lines.append(_part["text"])
+
+    # OpenAI tool calls
+    for _tool_call in turn.get("tool_calls") or []:
+        _function = _tool_call.get("function") or {}
+        _lines.append(f"[called tool {_function.get('name')} with {_clip(str(_function.get('arguments')))}]")
+
+    if not _lines:
+        return ""
+    return f"# {turn.get('role') or 'tool'}:\n" + "\n".join(_lines)
+
+############################################
+# TOOL OUTPUT STUBS
+############################################
+# Finds the name and arguments of the tool call that produced an output
+# OpenAI calls are matched by ID since tool results don't carry the name, Gemini calls are matched by name
+def _find_tool_call(chat_thread: list, index: int, name: str = None, tool_call_id: str = None) -> tuple:
+    for _turn in reversed(chat_thread[:index]):
+        if not isinstance(_turn, dict):
+            continue
+
+        for _tool_call in _turn.get("tool_calls") or []:
+            if tool_call_id and _tool_call.get("id") == tool_call_id:
+                _function = _tool_call.get("function") or {}
+                try:
+                    return _function.get("name"), json.loads(_function.get("arguments") or "null")
+                except ValueError:
+                    return _function.get("name"), _function.get("arguments")
+
+        for _part in _turn.get("parts") or []:
+            if name and isinstance(_part, dict) and (_part.get("function_call") or {}).get("name") == name:
+                return name, _part["function_call"].get("args")
+    return name, None
+
+def _build_stub(archive_id: str, name: str, args, serialized: str) -> dict:
+    return {
+        "archived_output": {
+            "archive_id": archive_id,
+            "tool": name,
+            "args": args,
+            "size_chars": len(serialized),
+            "preview": serialized[:STUB_PREVIEW_CHARS]
+        },
+        "notice": f"This tool output was archived to save space, call {ARCHIVE_TOOL_NAME} with its archive_id if you need the full output"
+    }
+
+# Returns the stub for a tool output, archiving the output if it's not archived yet
+async def _stub_tool_output(user_id: int, thread_name: str, db_conn: History, name: str, args, payload) -> dict:
+    _serialized = payload if isinstance(payload, str) else json.dumps(payload, default=str, ensure_ascii=False)
+    if len(_serialized) < CHAT_TOOL_OUTPUT_STUB_MIN_CHARS:
+        return None
+
+    # Outputs of the archive tool already point to an existing entry
+    if name == ARCHIVE_TOOL_NAME and isinstance(args, dict) and args.get("archive_id"):
+        return _build_stub(args["archive_id"], name, args, _serialized)
+
+    # Thread name is part of the digest since entries are deleted along with their thread
+    _archive_id = hashlib.sha256(f"{thread_name}\n{_serialized}".encode("utf-8")).hexdigest()[:16]
+    await db_conn.put_archive(user_id, thread_name, f"tool_output:{_archive_id}", {"tool": name, "args": args, "output": payload})
+    return _build_stub(_archive_id, name, args, _serialized)
+
+async def stub_tool_outputs(user_id: int, thread_name: str, chat_thread: list, db_conn: History) -> int:
+    """Replace large tool outputs that are CHAT_TOOL_OUTPUT_STUB_AFTER user turns old with stubs and archive the full outputs.
+
+    Stubbed turns are flagged dirty so save_history writes them back, returns the number of stubbed outputs."""
+    if not CHAT_TOOL_OUTPUT_STUB_AFTER:
+        return 0
+
+    _stubbed = 0
+    _user_turns_after = 0
+    for _index in range(len(chat_thread) - 1, -1, -1):
+        _turn = chat_thread[_index]
+        if not isinstance(_turn, dict):
+            continue
+
+        if is_user_turn(_turn):
+            _user_turns_after += 1
+            continue
+
+        if _user_turns_after < CHAT_TOOL_OUTPUT_STUB_AFTER:
+            continue
+
+        _changed = False
+
+        # OpenAI tool results
+        if _turn.get("role") == "tool" and isinstance(_turn.get("content"), str):
+            _name, _args = _find_tool_call(chat_thread, _index, tool_call_id=_turn.get("tool_call_id"))
+            if '"archived_output"' not in _turn["content"][:32]:
+                _stub = await _stub_tool_output(user_id, thread_name, db_conn, _name, _args, _turn["content"])
+                if _stub:
+                    _turn["content"] = json.dumps(_stub)
+                    _changed = True
+
+        # Gemini function responses, stored either as bare parts or within a turn
+        else:
+            for _part in _turn["parts"] if isinstance(_turn.get("parts"), list) else [_turn]:
+                if not isinstance(_part, dict) or not isinstance(_part.get("function_response"), dict):
+                    continue
+
+                _function_response = _part["function_response"]
+                if isinstance(_function_response.get("response"), dict) and "archived_output" in _function_response["response"]:
+                    continue
+
+                _name, _args = _find_tool_call(chat_thread, _index, name=_function_response.get("name"))
+                _stub = await _stub_tool_output(user_id, thread_name, db_conn, _name, _args, _function_response.get("response"))
+                if _stub:
+                    _function_response["response"] = _stub
+                    _changed = True
+
+        if _changed:
+            # Token count is estimated again on save
+            _meta = _turn.setdefault("_meta", {})
+            _meta["dirty"] = True
+            _meta.pop("tokens", None)
+            _stubbed += 1
+
+    if _stubbed:
+        logging.info("Stubbed %s tool outputs in chat thread %s", _stubbed, thread_name)
+    return _stubbed
+
+############################################
+# SUMMARIZATION
+############################################
+# Summary exchange in the format of the provider that owns the thread
+# The summary is flagged in its metadata so it's kept at the start of the window, see models.context_window
+def _summary_turns(sdk: str, summary: str, meta: dict) -> list:
+    _summary_prompt = f"<conversation_summary>\nSummary of our earlier conversation, refer to it as your memory of it:\n{summary}\n</conversation_summary>"
+    _acknowledgement = "Got it, I'll keep that in mind."
+
+    if sdk == "google":
+        return [
+            {"role": "user", "parts": [{"text": _summary_prompt}], "_meta": meta},
+            {"role": "model", "parts": [{"text": _acknowledgement}]}
+        ]
+    else:
+        return [
+            {"role": "user", "content": [{"type": "text", "text": _summary_prompt}], "_meta": meta},
+            {"role": "assistant", "content": _acknowledgement}
+        ]
+
+async def compact_history(user_id: int, thread_name: str, sdk: str, db_conn: History, discord_bot = None) -> None:
+    """Replace the oldest turns of a chat thread with a summary, keeping the newest turns verbatim.
+
+    The turns kept are chosen from the same window that needs_compaction measured, every older turn is summarized."""
+    _records = await load_thread_window(user_id, thread_name, db_conn, sdk)
+
+    # Keep the system turn at the start of the thread
+    _head_seq = 0
+    while _records and _records[0]["turn"].get("role") == "system":
+        _head_seq = _records.pop(0)["seq"] + 1
+
+    # Turns between the previous summary and a truncated window are replaced by the summary too, so they're summarized as well
+    _pinned = pinned_length([_record["turn"] for _record in _records])
+    if len(_records) > _pinned:
+        _after_seq = _records[_pinned - 1]["seq"] if _pinned else _head_seq - 1
+        _records[_pinned:_pinned] = await load_turns_between(user_id, thread_name, db_conn, sdk, _after_seq, _records[_pinned]["seq"])
+
+    # Group into exchanges so tool calls and results are never split
+    _exchanges = []
+    for _record in _records:
+        if not _exchanges or is_user_turn(_record["turn"]):
+            _exchanges.append([_record])
+        else:
+            _exchanges[-1].append(_record)
+
+    # Keep the newest exchanges up to the keep budget, the latest exchange is always kept
+    _kept_tokens = 0
+    _split = len(_exchanges)
+    while _split > 0:
+        _exchange_tokens = sum(get_turn_tokens(_record["turn"]) for _record in _exchanges[_split - 1])
+        if _split < len(_exchanges) and _kept_tokens + _exchange_tokens > CHAT_COMPACTION_KEEP_TOKENS:
+            break
+        _kept_tokens += _exchange_tokens
+        _split -= 1
+
+    _compacted = [_record for _exchange in _exchanges[:_split] for _record in _exchange]
+
+    # The summary takes two turns, so nothing would be saved
+    if len(_compacted) <= 2:
+        return
+
+    # Carry over the ranges compacted by previous summaries
+    _ranges = []
+    for _record in _compacted:
+        _ranges.extend((_record["turn"].get("_meta") or {}).get("compacted") or [])
+
+    # The summary is stored right after the system turn so it can be found when the window is truncated
+    _first_seq, _last_seq = _head_seq, _compacted[-1]["seq"]
+    _ranges.append([_first_seq, _last_seq])
+
+    _transcript = "\n\n".join(filter(None, (_render_turn(_record["turn"]) for _record in _compacted)))
+
+    # Summarize using the default text model
+    _default_model_config = await fetch_text_model_config_async()
+    _completions = getattr(importlib.import_module(f"models.tasks.text.{_default_model_config['sdk']}"), "completion")
+    _summary = await _completions(
+        prompt=f"Summarize this conversation:\n\n{_transcript}",
+        model_name=_default_model_config["model_id"],
+        system_instruction=await set_assistant_type("chat_history_compactor_prompt", type=1),
+        client_session=getattr(discord_bot, _default_model_config["client_name"], None) if _default_model_config["client_name"] else None,
+        return_text=True,
+        **_default_model_config["model_specific_params"]
+    )
+
+    if not _summary or not _summary.strip():
+        logging.warning("Skipped compacting chat thread %s, the summarizer returned an empty response", thread_name)
+        return
+
+    _summary_exchange = _summary_turns(sdk, _summary.strip(), {"compacted": _ranges, "summary": True})
+    for _turn in _summary_exchange:
+        get_turn_tokens(_turn)
+
+    await db_conn.replace_turns(user_id, thread_name, _first_seq, _last_seq, [encode_turn(_turn, sdk) for _turn in _summary_exchange])
+    logging.info("Compacted turns %s to %s of chat thread %s into a summary", _first_seq, _last_seq, thread_name)
+
+# A request that loaded the thread before it was compacted may still write back turns that the summary replaced
+# Drops updates of turns within the range of the stored summary, except for the summary itself
+async def drop_compacted_updates(user_id: int, thread_name: str, turns: dict, db_conn: History) -> dict:
+    if not turns:
+        return turns
+
+    _head = await db_conn.load_thread(user_id, thread_name, limit=PINNED_HEAD_TURNS, before_seq=PINNED_HEAD_TURNS)
+    _summary_meta = next((
+        _record["turn"]["_meta"] for _record in _head
+        if isinstance(_record["turn"], dict) and (_record["turn"].get("_meta") or {}).get("summary")
+    ), None)
+    if not _summary_meta or not _summary_meta.get("compacted"):
+        return turns
+
+    _first_seq, _last_seq = _summary_meta["compacted"][-1]
+    _kept = {
+        _seq: _turn for _seq, _turn in turns.items()
+        if not _first_seq <= _seq <= _last_seq or (_turn.get("_meta") or {}).get("compacted") == _summary_meta["compacted"]
+    }
+    if len(_kept) < len(turns):
+        logging.info("Skipped writing back %s turns of chat thread %s that were compacted", len(turns) - len(_kept), thread_name)
+    return _kept
+
+async def _run_compaction(user_id: int, thread_name: str, sdk: str, db_conn: History, discord_bot) -> None:
+    try:
+        await compact_history(user_id, thread_name, sdk, db_conn, discord_bot)
+    except Exception as e:
+        logging.error("Error compacting chat thread %s, reason: %s", thread_name, e)
+    finally:
+        _compacting.discard((user_id, thread_name))
+
+# Start compacting the thread in the background if it's too large, so the reply isn't delayed
+def schedule_compaction(user_id: int, thread_name: str, sdk: str, chat_thread: list, db_conn: History, discord_bot = None) -> None:
+    if (user_id, thread_name) in _compacting or not needs_compaction(chat_thread):
+        return
+
+    _compacting.add((user_id, thread_name))
+    _task = asyncio.create_task(_run_compaction(user_id, thread_name, sdk, db_conn, discord_bot))
+    _background_tasks.add(_task)
+    _task.add_done_callback(_background_tasks.discard)
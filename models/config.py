@@ -0,0 +1,162 @@
+from core.autocomplete import AutocompleteIndex
+from core.config import config_registry
+from models.validation import ModelParamsGeminiDefaults, ModelParamsOpenAIDefaults, ModelProps, TextTaskModelProps
+from types import MappingProxyType
+from typing import NamedTuple
+import logging
+
+# Data files used by the models and their parsed form
+# Entries are validated once when the file is loaded, invalid entries are logged and skipped
+class ChatModels(NamedTuple):
+    # In file order
+    models: tuple
+    by_alias: MappingProxyType
+    default_alias: str
+
+    # Request params of each model by alias, see compile_model_params
+    params: MappingProxyType
+
+    # Searched by alias, name and description
+    index: AutocompleteIndex
+
+class TextModels(NamedTuple):
+    models: tuple
+    by_id: MappingProxyType
+    default: TextTaskModelProps
+
+    # Searched by model id and name
+    index: AutocompleteIndex
+
+class RemixStyles(NamedTuple):
+    styles: tuple
+    by_style: MappingProxyType
+
+def _validate_entries(data, validator, path: str) -> tuple:
+    _entries = []
+    for _index, _entry in enumerate(data or []):
+        try:
+            _entries.append(validator(**_entry))
+        except Exception as _error:
+            logging.error("Skipping entry %s in %s, reason: %s", _index, path, _error)
+    return tuple(_entries)
+
+# SDK defaults and additional_params keys that are set by the session instead
+_SDK_PARAMS = {
+    "google": (ModelParamsGeminiDefaults, ("system_instruction", "tools")),
+    "openai": (ModelParamsOpenAIDefaults, ("model", "messages", "tools")),
+    "litellm": (ModelParamsOpenAIDefaults, ("model", "messages", "tools"))
+}
+
+# Merges the SDK defaults with the model's additional_params into the params sent with every request
+# The SDK defaults take precedence over additional_params
+def compile_model_params(model_props: ModelProps) -> MappingProxyType:
+    _defaults_model, _conflicting_keys = _SDK_PARAMS.get(model_props.sdk, _SDK_PARAMS["openai"])
+    _defaults = _defaults_model().model_dump()
+    _params = {_key: _value for _key, _value in model_props.additional_params.items() if _key not in _conflicting_keys}
+
+    # OpenAI reasoning models only accept max_completion_tokens
+    if model_props.sdk == "openai" and "reasoning_effort" in _params:
+        _defaults["max_completion_tokens"] = _defaults.pop("max_tokens")
+
+    for _key in _defaults:
+        if _key in _params:
+            logging.warning("Ignoring %s in additional_params of %s, it's set by the bot", _key, model_props.model_alias)
+            del _params[_key]
+
+    _params.update(_defaults)
+    return MappingProxyType(_params)
+
+def _parse_chat_models(data) -> ChatModels:
+    _models = _validate_entries(data, ModelProps, "data/models.yaml")
+
+    # The first model with default: true, otherwise the first model
+    _default = next((_model for _model in _models if _model.default), _models[0] if _models else None)
+    return ChatModels(
+        models=_models,
+        by_alias=MappingProxyType({_model.model_alias: _model for _model in _models}),
+        default_alias=_default.model_alias if _default else None,
+        params=MappingProxyType({_model.model_alias: compile_model_params(_model) for _model in _models}),
+        index=AutocompleteIndex(
+            (_model.model_alias, f"{_model.model_human_name} - {_model.model_description}", (_model.model_alias, _model.model_human_name, _model.model_description))
+            for _model in _models
+        )
+    )
+
+def _parse_text_models(data) -> TextModels:
+    _models = _validate_entries(data, TextTaskModelProps, "data/text_models.yaml")
+    return TextModels(
+        models=_models,
+        by_id=MappingProxyType({_model.model_id: _model for _model in _models}),
+        default=next((_model for _model in _models if _model.default), None),
+        index=AutocompleteIndex(
+            (_model.model_id, _model.model_human_name or _model.model_id, (_model.model_id, _model.model_human_name))
+            for _model in _models
+        )
+    )
+
+def _parse_assistants(data) -> MappingProxyType:
+    return MappingProxyType({
+        _mode: MappingProxyType(dict(data.get(_mode) or {}))
+        for _mode in ("chat_assistants", "utility_assistants")
+    })
+
+# None when there's no emojis.yaml
+def _parse_emojis(data) -> tuple:
+    return tuple(data) if data is not None else None
+
+def _parse_remix_styles(data) -> RemixStyles:
+    _styles = tuple(_style["image_style"] for _style in data or [])
+    return RemixStyles(
+        styles=_styles,
+        by_style=MappingProxyType({_style["image_style"]: _style["preprompt"] for _style in data or []})
+    )
+
+# Per-guild allowlists, the format is
+# <guild id>:
+#   models: [model aliases from models.yaml]
+#   text_models: [model ids from text_models.yaml]
+# Guilds or kinds that aren't listed can use every model
+def _parse_allowlists(data) -> MappingProxyType:
+    return MappingProxyType({
+        int(_guild_id): MappingProxyType({_kind: frozenset(_values or []) for _kind, _values in (_lists or {}).items()})
+        for _guild_id, _lists in (data or {}).items()
+    })
+
+config_registry.register("models", "data/models.yaml", _parse_chat_models)
+config_registry.register("text_models", "data/text_models.yaml", _parse_text_models)
+config_registry.register("assistants", "data/assistants.yaml", _parse_assistants)
+config_registry.register("emojis", "emojis.yaml", _parse_emojis, optional=True)
+config_registry.register("remix_styles", "data/prompts/remix.yaml", _parse_remix_styles)
+config_registry.register("allowlists", "allowlists.yaml", _parse_allowlists, optional=True)
+
+def get_chat_models() -> ChatModels:
+    return config_registry.get("models")
+
+# Returns the compiled request params, models that aren't from models.yaml are compiled on the spot
+def get_model_params(model_props: ModelProps) -> MappingProxyType:
+    _chat_models = get_chat_models()
+    if _chat_models.by_alias.get(model_props.model_alias) is model_props:
+        return _chat_models.params[model_props.model_alias]
+    return compile_model_params(model_props)
+
+def get_text_models() -> TextModels:
+    return config_registry.get("text_models")
+
+def get_assistants() -> MappingProxyType:
+    return config_registry.get("assistants")
+
+def get_emojis() -> tuple:
+    return config_registry.get("emojis")
+
+def get_remix_styles() -> RemixStyles:
+    return config_registry.get("remix_styles")
+
+# Returns the allowed values of kind (models or text_models) in the guild, None when everything is allowed
+def get_allowlist(guild_id: int, kind: str) -> frozenset:
+    if not guild_id:
+        return None
+    return (config_registry.get("allowlists").get(guild_id) or {}).get(kind)
+
+def is_allowed(guild_id: int, kind: str, value: str) -> bool:
+    _allowlist = get_allowlist(guild_id, kind)
+    return _allowlist is None or value in _allowlist
@@ -0,0 +1,146 @@
+from models.context_window import estimate_tokens
+from os import environ
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+# Provider-side caching of the static request prefix, i.e. the system prompt and tool declarations
+# Gemini needs the prefix stored as a cached content resource while OpenAI caches matching prefixes
+# automatically and only needs a stable key to route requests with the same prefix together
+
+# How long Gemini context caches live in seconds, renewed while they're used, 0 disables them
+GEMINI_CONTEXT_CACHE_TTL = int(environ.get("GEMINI_CONTEXT_CACHE_TTL", 3600))
+
+# Gemini rejects caches below a minimum size, smaller prefixes are sent inline
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 1024))
+
+# Seconds to wait before trying to create a cache again for a prefix that failed
+GEMINI_CONTEXT_CACHE_RETRY_AFTER = 600
+
+# OpenAI compatible APIs known to accept prompt_cache_key, others may reject unknown parameters
+OPENAI_PROMPT_CACHE_KEY_HOSTS = ("api.openai.com", "openrouter.ai")
+
+# Caches this close to expiring aren't used so they don't expire mid-request
+_EXPIRY_MARGIN = 60
+
+# Stable short hash of any JSON-like value
+def hash_content(value) -> str:
+    if isinstance(value, str):
+        _content_hash = getattr(value, "content_hash", None)
+        if _content_hash:
+            return _content_hash
+        _serialized = value
+    else:
+        _serialized = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(_serialized.encode("utf-8")).hexdigest()[:16]
+
+# Key for OpenAI's prompt_cache_key, requests with the same model, system prompt and tools share it
+def prompt_cache_key(model_id: str, system_instructions: str = None, tools: list = None) -> str:
+    return hashlib.sha256(f"{model_id}\n{hash_content(system_instructions or '')}\n{hash_content(tools or [])}".encode("utf-8")).hexdigest()[:32]
+
+# Gemini request config carrying the system instruction and tools inline
+def inline_request_config(system_instruction: str = None, params: dict = None) -> dict:
+    return {
+        "system_instruction": system_instruction or None,
+        **(params or {})
+    }
+
+class GeminiContextCache:
+    def __init__(self, ttl: int = GEMINI_CONTEXT_CACHE_TTL, min_tokens: int = GEMINI_CONTEXT_CACHE_MIN_TOKENS):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+
+        # (model, system prompt hash, tools hash) -> {"name", "expires_at"} or {"failed_until"}
+        self._entries = {}
+        self._locks = {}
+
+        # Counters
+        self.hits = 0
+        self.created = 0
+        self.renewed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": sum(1 for _entry in self._entries.values() if "name" in _entry),
+            "hits": self.hits,
+            "created": self.created,
+            "renewed": self.renewed,
+            "failed": self.failed,
+            "skipped": self.skipped
+        }
+
+    # Returns the name of a cached content holding the system instruction and tools, or None to send them inline
+    async def get(self, client, model_id: str, system_instruction: str = None, tools: list = None) -> str:
+        if not self.ttl or not (system_instruction or tools):
+            return None
+
+        if estimate_tokens([system_instruction, tools]) < self.min_tokens:
+            self.skipped += 1
+            return None
+
+        _key = (model_id, hash_content(system_instruction or ""), hash_content(tools or []))
+        async with self._locks.setdefault(_key, asyncio.Lock()):
+            _now = time.time()
+            _entry = self._entries.get(_key)
+            if _entry and _entry.get("failed_until", 0) > _now:
+                return None
+
+            if _entry and "name" in _entry and _entry["expires_at"] > _now + _EXPIRY_MARGIN:
+                # Extend the TTL once half of it has passed so caches in use don't expire
+                if _entry["expires_at"] - _now < self.ttl / 2:
+                    try:
+                        _cache = await client.aio.caches.update(name=_entry["name"], config={"ttl": f"{self.ttl}s"})
+                        _entry["expires_at"] = _cache.expire_time.timestamp() if getattr(_cache, "expire_time", None) else _now + self.ttl
+                        self.renewed += 1
+                    except Exception:
+                        logging.warning("Failed to renew context cache %s, it will be used until it expires", _entry["name"], exc_info=True)
+
+                self.hits += 1
+                return _entry["name"]
+
+            try:
+                _cache = await client.aio.caches.create(
+                    model=model_id,
+                    config={
+                        "system_instruction": system_instruction or None,
+                        "tools": tools or None,
+                        "ttl": f"{self.ttl}s",
+                        "display_name": f"jakey-{_key[1]}-{_key[2]}"
+                    }
+                )
+            except Exception as _error:
+                logging.warning("Failed to create a context cache for %s, sending the prefix inline: %s", model_id, _error)
+                self._entries[_key] = {"failed_until": _now + GEMINI_CONTEXT_CACHE_RETRY_AFTER}
+                self.failed += 1
+                return None
+
+            self._entries[_key] = {
+                "name": _cache.name,
+                "expires_at": _cache.expire_time.timestamp() if getattr(_cache, "expire_time", None) else _now + self.ttl
+            }
+            self.created += 1
+            logging.info("Created context cache %s for %s", _cache.name, model_id)
+            return _cache.name
+
+    # Request config and cached content name, the system instruction and tools are sent inline when no cache is available
+    async def request_config(self, client, model_id: str, system_instruction: str = None, params: dict = None) -> tuple:
+        _params = params or {}
+        _cached_content = await self.get(client, model_id, system_instruction, _params.get("tools"))
+        if not _cached_content:
+            return inline_request_config(system_instruction, _params), None
+
+        _config = {_key: _value for _key, _value in _params.items() if _key != "tools"}
+        _config["cached_content"] = _cached_content
+        return _config, _cached_content
+
+    # Forget a cache that the API no longer knows about
+    def invalidate(self, name: str) -> None:
+        for _key, _entry in list(self._entries.items()):
+            if _entry.get("name") == name:
+                del self._entries[_key]
+
+gemini_context_cache = GeminiContextCache()
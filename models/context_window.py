@@ -0,0 +1,213 @@
+from .turns import decode_turn
+from core.database import History
+from core.exceptions import CustomErrorMessage
+from os import environ
+import logging
+import math
+
+# Token counts are estimated locally since each provider tokenizes differently
+# and counting through the API would cost a round trip per turn
+CHARS_PER_TOKEN = 4
+TURN_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 1024
+FILE_TOKENS = 4096
+
+# Used when the model doesn't define context_window in data/models.yaml
+DEFAULT_CONTEXT_WINDOW = int(environ.get("CHAT_DEFAULT_CONTEXT_WINDOW", 128000))
+
+# Maximum number of latest turns loaded per thread, 0 loads the entire thread
+CHAT_THREAD_MAX_TURNS = int(environ.get("CHAT_THREAD_MAX_TURNS", 200))
+
+# The system turn and the summary of compacted turns are stored at the start of the thread
+# and take at most this many turns, see models.compaction
+PINNED_HEAD_TURNS = 3
+
+# Checks if the turn is written by the user rather than a tool result or a model response
+def is_user_turn(turn: dict) -> bool:
+    if not isinstance(turn, dict) or turn.get("role") != "user":
+        return False
+    return not any(isinstance(_part, dict) and _part.get("function_response") for _part in turn.get("parts") or [])
+
+# Checks if the turn is the summary of compacted turns
+def is_summary_turn(turn: dict) -> bool:
+    return isinstance(turn, dict) and bool((turn.get("_meta") or {}).get("summary"))
+
+# Length of the turns at the start of the history that are always kept
+# These are the system turn and the summary exchange, which is the summary and the model's acknowledgement
+def pinned_length(chat_history: list) -> int:
+    _index = 0
+    while _index < len(chat_history) and isinstance(chat_history[_index], dict) and chat_history[_index].get("role") == "system":
+        _index += 1
+
+    if _index < len(chat_history) and is_summary_turn(chat_history[_index]):
+        _index += 1
+        while _index < len(chat_history) and not is_user_turn(chat_history[_index]):
+            _index += 1
+    return _index
+
+# Decodes stored records, dropping turns that can't be sent such as empty Gemini turns
+def _decode_records(records: list, sdk: str) -> list:
+    for _record in records:
+        _record["turn"] = decode_turn(_record["turn"], sdk)
+    return [_record for _record in records if _record["turn"] is not None]
+
+# Loads the latest turns of a stored thread decoded to the wire format of the sdk, as {"seq": int, "turn": dict} records
+# This is the view the model gets and compaction works on, the pinned turns are kept when the thread is truncated
+async def load_thread_window(user_id: int, thread_name: str, db_conn: History, sdk: str) -> list:
+    _records = await db_conn.load_thread(user_id, thread_name, limit=CHAT_THREAD_MAX_TURNS or None)
+    _records = _decode_records(_records, sdk)
+
+    if not _records or _records[0]["seq"] == 0:
+        return _records
+
+    # When the thread is truncated, the window must start on a user turn so tool calls and results stay paired
+    while _records and not is_user_turn(_records[0]["turn"]):
+        _records.pop(0)
+
+    _head = _decode_records(await db_conn.load_thread(user_id, thread_name, limit=PINNED_HEAD_TURNS, before_seq=PINNED_HEAD_TURNS), sdk)
+
+    _first_seq = _records[0]["seq"] if _records else float("inf")
+    _pinned = [_record for _record in _head[:pinned_length([_record["turn"] for _record in _head])] if _record["seq"] < _first_seq]
+    return _pinned + _records
+
+# Loads the stored turns with after_seq < seq < before_seq, paging backwards from before_seq
+async def load_turns_between(user_id: int, thread_name: str, db_conn: History, sdk: str, after_seq: int, before_seq: int) -> list:
+    _records = []
+    while before_seq - after_seq > 1:
+        _page = await db_conn.load_thread(user_id, thread_name, limit=CHAT_THREAD_MAX_TURNS or None, before_seq=before_seq)
+        _page = [_record for _record in _page if _record["seq"] > after_seq]
+        if not _page:
+            break
+
+        before_seq = _page[0]["seq"]
+        _records[:0] = _decode_records(_page, sdk)
+    return _records
+
+# Estimate tokens of any JSON-like value, attachments are counted as a fixed cost
+def estimate_tokens(value) -> int:
+    _chars = 0
+    _tokens = 0
+    _stack = [value]
+    while _stack:
+        _value = _stack.pop()
+        if isinstance(_value, str):
+            _chars += len(_value)
+        elif isinstance(_value, dict):
+            # Gemini file parts or OpenAI image parts
+            _attachment = _value.get("file_data") or _value.get("inline_data")
+            if _attachment or _value.get("type") == "image_url":
+                _mime_type = _attachment.get("mime_type", "") if isinstance(_attachment, dict) else "image/"
+                _tokens += IMAGE_TOKENS if _mime_type.startswith("image/") else FILE_TOKENS
+                continue
+
+            _stack.extend(_item for _key, _item in _value.items() if _key != "_meta")
+        elif isinstance(_value, (list, tuple)):
+            _stack.extend(_value)
+    return _tokens + math.ceil(_chars / CHARS_PER_TOKEN)
+
+# Token count of a turn, cached in its metadata so it's stored along with the turn
+def get_turn_tokens(turn: dict) -> int:
+    _meta = turn.setdefault("_meta", {})
+    if "tokens" not in _meta:
+        _meta["tokens"] = TURN_OVERHEAD_TOKENS + estimate_tokens(turn)
+    return _meta["tokens"]
+
+# Tokens available for the chat history after reserving output, system instructions and tool declarations
+def compute_context_budget(model_props, params: dict, system_instructions: str = None) -> int:
+    _context_window = getattr(model_props, "context_window", None) or DEFAULT_CONTEXT_WINDOW
+    _reserved = params.get("max_output_tokens") or params.get("max_completion_tokens") or params.get("max_tokens") or 0
+    if system_instructions:
+        _reserved += estimate_tokens(system_instructions)
+    if params.get("tools"):
+        _reserved += estimate_tokens(params["tools"])
+    return max(_context_window - _reserved, 0)
+
+TRIMMED_TOOL_RESULT_NOTICE = "This tool output was removed to fit the context window, call the tool again if you still need it"
+
+# Copy of a tool result turn with its output replaced by a notice, or None if the turn has no tool results
+def _trim_tool_result(turn: dict) -> dict:
+    if not isinstance(turn, dict):
+        return None
+
+    # OpenAI tool results
+    if turn.get("role") == "tool":
+        return {_key: _value for _key, _value in turn.items() if _key not in ("_meta", "content")} | {"content": TRIMMED_TOOL_RESULT_NOTICE}
+
+    # Gemini function responses, either as bare parts or within a turn
+    _parts = turn["parts"] if isinstance(turn.get("parts"), list) else [turn]
+    if not any(isinstance(_part, dict) and isinstance(_part.get("function_response"), dict) for _part in _parts):
+        return None
+
+    _trimmed_parts = []
+    for _part in _parts:
+        if isinstance(_part, dict) and isinstance(_part.get("function_response"), dict):
+            _part = {
+                _key: _value for _key, _value in _part.items() if _key != "_meta"
+            } | {"function_response": {**_part["function_response"], "response": {"notice": TRIMMED_TOOL_RESULT_NOTICE}}}
+        _trimmed_parts.append(_part)
+
+    if "parts" in turn:
+        return {_key: _value for _key, _value in turn.items() if _key not in ("_meta", "parts")} | {"parts": _trimmed_parts}
+    return _trimmed_parts[0]
+
+# The newest exchange is sent again with every tool result during an agent loop
+# When it outgrows the budget, its oldest tool results are replaced with a notice until it fits
+# Only the turns sent to the model are trimmed, the chat history keeps the full results
+def _trim_exchange(exchange: list, budget: int) -> list:
+    _exchange = list(exchange)
+    _tokens = sum(get_turn_tokens(_turn) for _turn in _exchange)
+    for _index, _turn in enumerate(_exchange):
+        if _tokens <= budget:
+            break
+
+        _trimmed = _trim_tool_result(_turn) if _index > 0 else None
+        if _trimmed is None:
+            continue
+
+        _tokens -= get_turn_tokens(_turn)
+        _exchange[_index] = _trimmed
+        _tokens += get_turn_tokens(_trimmed)
+
+    if _tokens > budget:
+        return None
+
+    logging.info("Trimmed tool results of the current exchange to fit the context budget of %s tokens", budget)
+    return _exchange
+
+# Returns the newest turns of the chat history that fit within the token budget
+# System turns and the summary are always kept, and turns are dropped per exchange starting from a user turn
+# so tool calls and their results are never separated
+def fit_context_window(chat_history: list, budget: int) -> list:
+    _system_turns = chat_history[:pinned_length(chat_history)]
+
+    # Group the rest into exchanges
+    _exchanges = []
+    for _turn in chat_history[len(_system_turns):]:
+        if not _exchanges or is_user_turn(_turn):
+            _exchanges.append([_turn])
+        else:
+            _exchanges[-1].append(_turn)
+
+    _used_tokens = sum(get_turn_tokens(_turn) for _turn in _system_turns)
+    _kept = []
+    for _exchange in reversed(_exchanges):
+        _exchange_tokens = sum(get_turn_tokens(_turn) for _turn in _exchange)
+        if _used_tokens + _exchange_tokens > budget:
+            # The newest exchange has the current prompt, no point sending it if it can't fit
+            if not _kept:
+                _exchange = _trim_exchange(_exchange, budget - _used_tokens)
+                if _exchange is None:
+                    logging.warning("Prompt with %s estimated tokens exceeds the context budget of %s tokens", _used_tokens + _exchange_tokens, budget)
+                    raise CustomErrorMessage("⚠️ Your message is too long for this model, please shorten it or choose a model with a larger context window.")
+
+                # Older exchanges are dropped
+                _kept.append(_exchange)
+            break
+
+        _kept.append(_exchange)
+        _used_tokens += _exchange_tokens
+
+    if len(_kept) < len(_exchanges):
+        logging.info("Trimmed %s of %s exchanges to fit the context budget of %s tokens", len(_exchanges) - len(_kept), len(_exchanges), budget)
+
+    return _system_turns + [_turn for _exchange in reversed(_kept) for _turn in _exchange]
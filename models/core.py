@@ -1,9 +1,10 @@
-import aiofiles
+from core.config import config_registry
+from models.config import get_allowlist, get_assistants, get_chat_models, get_emojis, get_remix_styles
+from tools.registry import get_agents
 import discord
+import hashlib
 import io
 import logging
-import os
-import yaml
 
 
 def _handle_missing_models(message: str):
@@ -42,93 +43,71 @@ async def send_ai_response(ctx: discord.Message, prompt: str, response: str, met
     else:
         await method_send(response)
 
-# Sets system prompt
-async def set_assistant_type(assistant_name: str, type: int = 0):
-    # 0 - chat_assistants
-    # 1 - utility_assistants
+# Rendered system prompt, the content hash is stable across restarts and can be used as a prompt cache key
+class SystemPrompt(str):
+    content_hash: str
 
-    # Load the assistants from YAML file
-    async with aiofiles.open("data/assistants.yaml", "r") as assistants:
-        _assistants_data = yaml.safe_load(await assistants.read())
+    def __new__(cls, text: str):
+        _prompt = super().__new__(cls, text)
+        _prompt.content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        return _prompt
 
+# Rendered prompts by (assistant name, type), cleared when assistants.yaml or emojis.yaml change
+_system_prompts = {}
+_system_prompts_versions = None
+
+def _render_assistant(assistant_name: str, type: int) -> SystemPrompt:
+    # Assistants are loaded from data/assistants.yaml
     if type == 0:
-        _assistants_mode = _assistants_data["chat_assistants"]
+        _assistants_mode = get_assistants()["chat_assistants"]
     else:
-        _assistants_mode = _assistants_data["utility_assistants"]
+        _assistants_mode = get_assistants()["utility_assistants"]
 
-    # Return the assistant
     # We format {} to have emojis, if we use type 0
-    if type == 0 and (await aiofiles.ospath.exists("emojis.yaml")):
+    _emojis = get_emojis()
+    if type == 0 and _emojis is not None:
         # The yaml format is
         # - emoji1
         # - emoji2
         # So we need to join them with newline and dash each same as yaml 
-        async with aiofiles.open("emojis.yaml") as emojis_list:
-            _emojis_list = "\n - ".join(yaml.safe_load(await emojis_list.read()))
-            print(_emojis_list)
-
-            if not _emojis_list:
-                _emojis_list = "No emojis found"
-        return _assistants_mode[assistant_name].strip().format(_emojis_list)
+        _emojis_list = "\n - ".join(_emojis)
+        if not _emojis_list:
+            _emojis_list = "No emojis found"
+        return SystemPrompt(_assistants_mode[assistant_name].strip().format(_emojis_list))
     else:
-        return _assistants_mode[assistant_name].strip()
+        return SystemPrompt(_assistants_mode[assistant_name].strip())
+
+# Sets system prompt
+async def set_assistant_type(assistant_name: str, type: int = 0) -> SystemPrompt:
+    # 0 - chat_assistants
+    # 1 - utility_assistants
+    global _system_prompts_versions
+
+    _versions = (config_registry.version("assistants"), config_registry.version("emojis"))
+    if _versions != _system_prompts_versions:
+        _system_prompts.clear()
+        _system_prompts_versions = _versions
+
+    _key = (assistant_name, type)
+    if _key not in _system_prompts:
+        _system_prompts[_key] = _render_assistant(assistant_name, type)
+    return _system_prompts[_key]
 
 # For /avatar remix command
 async def get_remix_styles_async(style: str = "I'm feeling lucky"):
-    # Load the tools list from YAML file
-    async with aiofiles.open("data/prompts/remix.yaml", "r") as remix_styles:
-        _remix_prompts = yaml.safe_load(await remix_styles.read())
-
-    # Return when matching style is found
-    # - image_style:
-    #   preprompt:
-    # This is the syntax of yaml so we need to iterate through the list until we find the matching style
-    for styles in _remix_prompts:
-        if styles["image_style"] == style:
-            return styles["preprompt"]
+    # Styles are loaded from data/prompts/remix.yaml
+    return get_remix_styles().by_style.get(style)
 
 # For getting default chat model for async contexts
 async def get_default_chat_model_async():
-    # Load the models list from YAML file
-    async with aiofiles.open("data/models.yaml", "r") as models:
-        _models_list = yaml.safe_load(await models.read())
-
-    # Search through models for the first one with default: true
-    if _models_list:
-        for _model in _models_list:
-            if _model.get("default") is True:
-                logging.info("Used default chat model %s", _model.get("model_id"))
-                return _model["model_alias"]
-
-        # Fallback to first model when no default is set
-        _first_model = _models_list[0]
-        if _first_model:
-            logging.info("No default set; using first model %s", _first_model.get("model_id"))
-            return _first_model["model_alias"]
-
-    # If list is empty or first entry is empty, shut down
-    _handle_missing_models("No models are defined in models.yaml. Please add at least one model entry.")
+    return get_default_chat_model()
 
 
 # Autocomplete to fetch available models in data/models.yaml
+# Matches are ranked by the prebuilt index and restricted to the guild's allowlist if it has one
+# https://docs.pycord.dev/en/v2.6.1/api/application_commands.html#discord.AutocompleteContext
 async def get_chat_models_autocomplete(ctx: discord.AutocompleteContext):
-    # ctx use is unused but required for autocomplete functions
-    # so
-    # TODO: add features like allowlist
-    # https://docs.pycord.dev/en/v2.6.1/api/application_commands.html#discord.AutocompleteContext
-    if not ctx:
-        pass
-
-    # Load the models list from YAML file
-    async with aiofiles.open("data/models.yaml", "r") as models:
-        _internal_model_data = yaml.safe_load(await models.read())
-
-    # Return the list of models
-    # Use list comprehension to build discord.OptionChoice list
-    return [
-        discord.OptionChoice(f"{_model['model_human_name']} - {_model['model_description']}", _model["model_alias"])
-        for _model in _internal_model_data
-    ]
+    return get_chat_models().index.search(ctx.value, allowed=get_allowlist(ctx.interaction.guild_id, "models"))
 
 ############################################
 # SYNC UTILITY FUNCTIONS
@@ -136,64 +115,25 @@ async def get_chat_models_autocomplete(ctx: discord.AutocompleteContext):
 # For getting default chat model for sync contexts, e.g. database.py History init constructor to set default model when chat history is reset
 # NOTE: This can only be used once, for example, initializing History class from database.py to only get default model
 def get_default_chat_model():
-    # Load the models list from YAML file
-    with open("data/models.yaml", "r") as models:
-        _models_list = yaml.safe_load(models)
-
-    # Search through models for the first one with default: true
-    if _models_list:
-        for _model in _models_list:
-            if _model.get("default") is True:
-                logging.info("Used default chat model %s", _model.get("model_id"))
-                return _model["model_alias"]
-
-        # Fallback to first model when no default is set
-        _first_model = _models_list[0]
-        if _first_model:
-            logging.info("No default set; using first model %s", _first_model.get("model_id"))
-            return _first_model["model_alias"]
-
-    # If list is empty or first entry is empty, shut down
+    # The first model with default: true, otherwise the first model
+    _default_alias = get_chat_models().default_alias
+    if _default_alias:
+        logging.info("Used default chat model %s", _default_alias)
+        return _default_alias
+
+    # If the list is empty, shut down
     _handle_missing_models("No models are defined in models.yaml. Please add at least one model entry.")
  
 # For fetching available tools used in /agent command in cogs/ai/chat.py
 def get_tools_list_generator():
-    _toolsPath = "tools/apis"
-
-    _hasYieldDisableValue = False
-    if not _hasYieldDisableValue:
-        yield discord.OptionChoice("Disabled", "disabled")
-
-    # Get directory names in /tools/apis except ones starting with "."
-    # Then we yield each as a discord.OptionChoice
-    for _tool_names in os.listdir("tools/apis"):
-        # Folders starting with __pycache__ or . are not tools
-        if _tool_names.startswith("__") or _tool_names.startswith("."):
-            logging.info("Skipping %s because it starts with __ or .", _tool_names)
-            continue
+    yield discord.OptionChoice("Disabled", "disabled")
 
-        # Check if it has manifest.yaml file
-        if not os.path.isfile(f"{_toolsPath}/{_tool_names}/manifest.yaml"):
-            logging.error("The tool %s does not have manifest.yaml file", _tool_names)
-            continue
-
-        # Check if we have "tool_name" in the manifest
-        with open(f"{_toolsPath}/{_tool_names}/manifest.yaml", "r") as _manifest:
-            _manifest_data = yaml.safe_load(_manifest)
-
-            if not _manifest_data.get("tool_name"):
-                logging.error("The tool %s does not have a tool_name", _tool_names)
-                continue
-
-        # Yield as discord.OptionChoice
-        yield discord.OptionChoice(_manifest_data["tool_name"], _tool_names)
+    # Agents are scanned once by the tool registry
+    for _agent, _tool_name in get_agents():
+        yield discord.OptionChoice(_tool_name, _agent)
 
 # For /avatar remix command generator
 def get_remix_styles_generator():
-    # Load the tools list from YAML file
-    with open("data/prompts/remix.yaml", "r") as remix_styles:
-        _remix_prompts = yaml.safe_load(remix_styles)
-
-    # Iterate through the tools and yield each as a discord.OptionChoice
-    for uioptions in _remix_prompts:
-        yield discord.OptionChoice(uioptions["image_style"])
+    # Iterate through the styles and yield each as a discord.OptionChoice
+    for _style in get_remix_styles().styles:
+        yield discord.OptionChoice(_style)
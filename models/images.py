@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import environ
+import aiohttp
+import asyncio
+import discord as typehint_Discord
+import io
+import logging
+import math
+import multiprocessing
+
+# Pillow is optional, images are sent as-is without it
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Image preprocessing for vision models
+# Large photos are downsampled to the model's max_image_resolution in data/models.yaml and re-encoded without metadata
+# Decoding and encoding is CPU bound so it runs in a process pool, 0 workers disables preprocessing
+IMAGE_PREPROCESS_WORKERS = int(environ.get("IMAGE_PREPROCESS_WORKERS", 2))
+
+# webp or jpeg
+IMAGE_PREPROCESS_FORMAT = environ.get("IMAGE_PREPROCESS_FORMAT", "webp").lower()
+IMAGE_PREPROCESS_QUALITY = int(environ.get("IMAGE_PREPROCESS_QUALITY", 85))
+
+# Images within the max resolution are still re-encoded when they're larger than this many bytes
+IMAGE_PREPROCESS_MIN_BYTES = int(environ.get("IMAGE_PREPROCESS_MIN_BYTES", 512 * 1024))
+
+# Larger images are sent as-is rather than decoded in memory
+IMAGE_PREPROCESS_MAX_BYTES = int(environ.get("IMAGE_PREPROCESS_MAX_BYTES", 50 * 1024 * 1024))
+
+_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+if IMAGE_PREPROCESS_FORMAT not in _FORMATS:
+    logging.warning("Unknown IMAGE_PREPROCESS_FORMAT %s, using webp", IMAGE_PREPROCESS_FORMAT)
+    IMAGE_PREPROCESS_FORMAT = "webp"
+
+if not Image and IMAGE_PREPROCESS_WORKERS:
+    logging.info("Pillow is not installed, images are sent to models without preprocessing")
+
+_pool: ProcessPoolExecutor = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Workers are spawned rather than forked, a fork would inherit the locks held by the threads
+        # of aiohttp, aiosqlite and the SDK clients and could deadlock
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+# Rough vision token estimate using 512px tiles, only used to log the savings
+def _estimate_image_tokens(width: int, height: int) -> int:
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+# Runs in the process pool, returns None when the re-encoded image isn't worth sending
+def _downsample_image(data: bytes, max_resolution: int, format: str, quality: int):
+    with Image.open(io.BytesIO(data)) as _image:
+        # Keep animations as-is
+        if getattr(_image, "n_frames", 1) > 1:
+            return None
+
+        _size = _image.size
+
+        # JPEGs can be decoded at a reduced scale which is much faster for large photos
+        if _image.format == "JPEG":
+            _image.draft("RGB", (max_resolution, max_resolution))
+
+        # Apply the EXIF orientation before the metadata is dropped
+        _image = ImageOps.exif_transpose(_image)
+        _image.thumbnail((max_resolution, max_resolution), Image.Resampling.LANCZOS)
+
+        _format, _ = _FORMATS[format]
+        if _format == "JPEG" and _image.mode != "RGB":
+            _image = _image.convert("RGB")
+        elif _image.mode not in ("RGB", "RGBA"):
+            _image = _image.convert("RGBA" if "A" in _image.getbands() or "transparency" in _image.info else "RGB")
+
+        # A new image is saved without EXIF, XMP or ICC metadata unless they're passed explicitly
+        _output = io.BytesIO()
+        _image.save(_output, format=_format, quality=quality)
+
+    _resized = _image.size != _size
+    if not _resized and _output.tell() >= len(data):
+        return None
+    return _output.getvalue(), _size, _image.size
+
+# Checks if the attachment should be downloaded and preprocessed before it's sent
+def should_preprocess_image(attachment: typehint_Discord.Attachment, max_resolution: int) -> bool:
+    if not Image or not IMAGE_PREPROCESS_WORKERS or not max_resolution:
+        return False
+    if not (attachment.content_type or "").startswith("image/") or attachment.size > IMAGE_PREPROCESS_MAX_BYTES:
+        return False
+
+    # Discord reports image dimensions so small images are skipped without downloading them
+    if attachment.width and attachment.height and max(attachment.width, attachment.height) <= max_resolution:
+        return attachment.size > IMAGE_PREPROCESS_MIN_BYTES
+    return True
+
+# Downsamples and re-encodes the image bytes, returns the original when preprocessing fails or doesn't help
+async def preprocess_image(data: bytes, mime_type: str, max_resolution: int, filename: str = None) -> tuple:
+    global _pool
+    try:
+        _result = await asyncio.get_running_loop().run_in_executor(
+            _get_pool(), _downsample_image, data, max_resolution, IMAGE_PREPROCESS_FORMAT, IMAGE_PREPROCESS_QUALITY
+        )
+    except BrokenProcessPool:
+        logging.error("Image preprocessing pool has crashed, sending %s as-is", filename, exc_info=True)
+        _pool = None
+        return data, mime_type
+    except Exception:
+        logging.warning("Failed to preprocess image %s, sending it as-is", filename, exc_info=True)
+        return data, mime_type
+
+    if not _result:
+        logging.info("Image %s is already optimized, sending it as-is", filename)
+        return data, mime_type
+
+    _processed, _original_size, _processed_size = _result
+    logging.info(
+        "Preprocessed image %s from %sx%s (%s bytes, ~%s tokens) to %sx%s (%s bytes, ~%s tokens)",
+        filename,
+        *_original_size, len(data), _estimate_image_tokens(*_original_size),
+        *_processed_size, len(_processed), _estimate_image_tokens(*_processed_size)
+    )
+    return _processed, _FORMATS[IMAGE_PREPROCESS_FORMAT][1]
+
+# Downloads and preprocesses the attachment, returns None when it should be sent as-is
+async def preprocess_attachment(attachment: typehint_Discord.Attachment, aiohttp_session: aiohttp.ClientSession, max_resolution: int) -> tuple:
+    if not aiohttp_session or not should_preprocess_image(attachment, max_resolution):
+        return None
+
+    async with aiohttp_session.get(attachment.url, allow_redirects=True) as _image_dl:
+        _image_dl.raise_for_status()
+        _data = await _image_dl.read()
+
+    return await preprocess_image(_data, attachment.content_type.split(";")[0], max_resolution, attachment.filename)
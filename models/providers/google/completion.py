@@ -1,12 +1,17 @@
-from .utils import GoogleUtils
+from .utils import GoogleUtils, record_agent_turn
 from core.database import History as typehint_History
 from core.exceptions import CustomErrorMessage
-from models.validation import ModelParamsGeminiDefaults as typehint_ModelParams
+from models.chat_utils import FILE_EXPIRED_NOTICE, expire_file_parts, mark_turn_dirty, strip_turn_metadata
+from models.context_window import compute_context_budget, fit_context_window
+from models.config import get_model_params
+from models.context_cache import gemini_context_cache, inline_request_config
 from models.validation import ModelProps as typehint_ModelProps
 from os import environ
+from types import MappingProxyType
 import discord
 import io
 import logging
+import time
 import google.genai as google_genai
 import google.genai.errors as google_genai_errors
 import google.genai.types as google_genai_types
@@ -19,7 +24,8 @@ class ChatSession(GoogleUtils):
                  discord_bot: discord.Bot = None,
                  discord_message: discord.Message = None,
                  db_conn: typehint_History = None,
-                 client_name: str = None):
+                 client_name: str = None,
+                 user_settings: dict = None):
         # Discord bot object - needed for interactions with current state of Discord API
         self.discord_bot: discord.Bot = discord_bot or None
 
@@ -51,15 +57,17 @@ class ChatSession(GoogleUtils):
             logging.error("Invalid model_props provided: %s", e)
             raise ValueError(f"Invalid model_props: {e}")
 
-        # Model params
-        _model_params: typehint_ModelParams = typehint_ModelParams()
-        self.model_params: dict = _model_params.model_dump()
+        # Request params are compiled once per model when models.yaml is loaded
+        self.model_params: MappingProxyType = get_model_params(self.model_props)
 
         # User ID
         self.user_id: int = user_id
 
         # Database
         self.db_conn: typehint_History = db_conn or None
+
+        # Pre-fetched user settings to avoid extra database reads
+        self.user_settings: dict = user_settings or {}
         
     # Chat
     async def send_message(self, prompt: str, chat_history: list = None, system_instructions: str = None):
@@ -90,58 +98,66 @@ class ChatSession(GoogleUtils):
         # Add the prepared prompt to chat history
         chat_history.append(_prep_prompt)
 
-        # Check for tools
-        if self.model_props.enable_tools:
-            await self.load_tools()
-            self.model_params["tools"] = [{"function_declarations": self.tool_schema}]
+        # Replace files that expired since they were uploaded before they're sent
+        _expired_files = expire_file_parts(chat_history)
+        if _expired_files:
+            logging.info("Replaced %s expired files in the chat history", _expired_files)
 
         # Get response
         if not self.model_props.model_id:
             raise ValueError("Model is required, chose nothing")
-        
-        # Additional model params
-        # Log
-        if self.model_props.additional_params:
-            logging.info("Merging additional_params into model_params: %s", self.model_props.additional_params)
-
-        # Reverse merge 
-        _merged_params = self.model_props.additional_params.copy() if self.model_props.additional_params else {}
-
-        # Remove model and messages if they exist in additional_params to avoid conflicts
-        logging.info("Removing conflicting keys from additional_params if present")
-        # Remove core conflicting keys
-        _merged_params.pop("system_instruction", None)
-        _merged_params.pop("tools", None)
-
-        # Remove others found in model_params
-        for _keys in self.model_params.keys():
-            if _keys in _merged_params:
-                logging.info("Removing key from additional_params to avoid conflict: %s", _keys)
-                _merged_params.pop(_keys, None)
-
-        # Update with model defaults
-        _merged_params.update(self.model_params)
-        
+
+        # Model params already merged with additional_params
+        _merged_params = dict(self.model_params)
+
+        # Check for tools
+        if self.model_props.enable_tools:
+            await self.load_tools()
+            _merged_params["tools"] = [{"function_declarations": self.tool_schema}]
+
+        # Token budget for the chat history, older turns are trimmed to fit
+        _context_budget = compute_context_budget(self.model_props, _merged_params, system_instructions=system_instructions)
+
+        # The system instruction and tools are the same for every request, serve them from a context cache when possible
+        _request_config, _cached_content = await gemini_context_cache.request_config(self.google_genai_client, self.model_props.model_id, system_instructions, _merged_params)
+
+        # Round trips and time spent on the model and tools during this message, see agent_loop_stats
+        self.turn_stats = {"round_trips": 0, "tool_calls": 0, "model_seconds": 0.0, "tool_seconds": 0.0}
+
+        async def _generate(config: dict) -> google_genai_types.GenerateContentResponse:
+            _started = time.perf_counter()
+            try:
+                return await self.google_genai_client.aio.models.generate_content(
+                    model=self.model_props.model_id,
+                    contents=strip_turn_metadata(fit_context_window(chat_history, _context_budget)),
+                    config=config
+                )
+            finally:
+                self.turn_stats["round_trips"] += 1
+                self.turn_stats["model_seconds"] += time.perf_counter() - _started
+
         # Generate
         try:
-            _response: google_genai_types.GenerateContentResponse = await self.google_genai_client.aio.models.generate_content(
-                model=self.model_props.model_id,
-                contents=chat_history,
-                config={
-                    "system_instruction": system_instructions or None,
-                    **_merged_params
-                }
-            )
+            _response: google_genai_types.GenerateContentResponse = await _generate(_request_config)
         except google_genai_errors.ClientError as e:
+            # The context cache is gone before it was supposed to expire, send the prefix inline instead
+            if _cached_content and "cachedcontent" in str(e).lower().replace(" ", ""):
+                logging.warning("Context cache %s is no longer available, retrying without it: %s", _cached_content, e)
+                gemini_context_cache.invalidate(_cached_content)
+                _request_config = inline_request_config(system_instructions, _merged_params)
+                _response: google_genai_types.GenerateContentResponse = await _generate(_request_config)
             # Attempt to clear all file URLs since they may be expired
-            if "do not have permission" in e.message:
+            elif "do not have permission" in e.message:
                 logging.error("Uh oh something went wrong while generating content, files may be expired, clearing files and raising error: %s", e)
                 for _chat_turns in chat_history:
-                    for _part in _chat_turns["parts"]:
+                    for _part in _chat_turns.get("parts") or []:
                         # Check if we have file_data key then we just set it as None and set the text to "Expired"
                         if _part.get("file_data"):
                             _part["file_data"] = None
-                            _part["text"] = "[<system_notice>File attachment processed but expired from history. DO NOT make stuff up about it! Ask the user to reattach for more details</system_notice>]"
+                            _part["text"] = FILE_EXPIRED_NOTICE
+
+                            # Stored turns must be written back
+                            mark_turn_dirty(_chat_turns)
 
                 # Send message
                 await self.discord_message.channel.send("Something went wrong, please send me a message again.")
@@ -158,11 +174,11 @@ class ChatSession(GoogleUtils):
             logging.warning("The model did not finish with STOP, it finished with: %s", _response.candidates[0].finish_reason)
             raise CustomErrorMessage("⚠️ The model did not return a response, please try again.")
 
-        # Send each part of the response
+        # Send each part of the response, then run every function call of the response together
+        # and send all the results in a single follow-up request until the model stops calling tools
         while True:
-            _tool_parts = None
-            # Iterate through each part of the response
-            for _part in _response.candidates[0].content.parts:
+            _function_calls = []
+            for _part in _response.candidates[0].content.parts or []:
                 # Send text message if needed
                 if _part.text and _part.text.strip():
                     await models.core.send_ai_response(self.discord_message, prompt, _part.text, self.discord_message.channel.send)
@@ -178,37 +194,27 @@ class ChatSession(GoogleUtils):
 
                 # Check for tool calls
                 if _part.function_call:
-                    chat_history.append(_response.candidates[0].content.model_dump(exclude_unset=True))
-
-                    # Tool parts
-                    _tool_parts = await self.execute_tools(name=_part.function_call.name, arguments=_part.function_call.args)
-
-                    # Extend chat history with tool parts
-                    chat_history.extend(_tool_parts)
-
-                    # Run the response the second time
-                    _response: google_genai_types.GenerateContentResponse = await self.google_genai_client.aio.models.generate_content(
-                        model=self.model_props.model_id,
-                        contents=chat_history,
-                        config={
-                            **self.model_params,
-                            "system_instruction": system_instructions or None
-                        }
-                    )
-
-            # Check if we need to run tools again, this block will stop the loop and response should have been sent
-            # _tool_parts would indicate if we ran tools before, which means there is a new _response assigned
-            if _tool_parts:
-                if not _response.function_calls:
-                    _textResponse = _response.text or _response.candidates[0].content.parts[-1].text
-                    if _textResponse and _textResponse.strip():
-                        await models.core.send_ai_response(self.discord_message, prompt, _textResponse, self.discord_message.channel.send)
-                else:
-                    continue  # Continue the while loop to process tool calls
-                
-            # Assuming everything went well
-            break
+                    _function_calls.append(_part.function_call)
+
+            if not _function_calls:
+                break
+
+            chat_history.append(_response.candidates[0].content.model_dump(exclude_unset=True))
+
+            # Tool parts in the same order as the function calls
+            _started = time.perf_counter()
+            _tool_parts = await self.execute_tools(_function_calls)
+            self.turn_stats["tool_calls"] += len(_function_calls)
+            self.turn_stats["tool_seconds"] += time.perf_counter() - _started
+
+            # All function responses go in one turn
+            chat_history.append({"role": "user", "parts": _tool_parts})
+
+            # Run the response again with the tool results
+            _response: google_genai_types.GenerateContentResponse = await _generate(_request_config)
 
+        record_agent_turn(self.turn_stats)
+        logging.info("Gemini agent loop for %s: %s", self.model_props.model_id, self.turn_stats)
 
         # Append to chat history
         chat_history.append(_response.candidates[0].content.model_dump(exclude_unset=True))
@@ -1,20 +1,91 @@
+from core.cache import TTLCache
 from core.exceptions import CustomErrorMessage
+from models.images import preprocess_attachment
 from os import environ
-from pathlib import Path
-from tools.utils import fetch_tool_schema, return_api_tools_object, return_builtin_tool_object
-from uuid import uuid4
+from tools.runtime import ToolContext, call_tool, get_tool_dispatch
+from tools.utils import fetch_tool_schema
 import discord as typehint_Discord
-import aiofiles
 import aiohttp
 import asyncio
+import hashlib
 import logging
+import tempfile
+import time
+
+# Gemini keeps uploaded files for 48 hours, used when the API doesn't return the expiration time
+GEMINI_FILE_TTL = 48 * 60 * 60
+
+# Attachments up to this size are kept in memory while uploading, larger ones are spooled to TEMP_DIR
+GEMINI_UPLOAD_SPOOL_MAX_BYTES = int(environ.get("GEMINI_UPLOAD_SPOOL_MAX_BYTES", 32 * 1024 * 1024))
+
+# Attachments up to this size are sent inline with the request instead of being uploaded to the Files API
+GEMINI_INLINE_MAX_BYTES = int(environ.get("GEMINI_INLINE_MAX_BYTES", 1024 * 1024))
+
+# Polling for files that are still processing, in seconds
+GEMINI_UPLOAD_POLL_INITIAL_DELAY = 0.25
+GEMINI_UPLOAD_POLL_MAX_DELAY = 4
+GEMINI_UPLOAD_PROCESSING_TIMEOUT = int(environ.get("GEMINI_UPLOAD_PROCESSING_TIMEOUT", 300))
+
+# Uploaded files are reused by content hash and MIME type across all users
+# Files are only reused while they have at least GEMINI_UPLOAD_CACHE_MIN_TTL seconds left
+GEMINI_UPLOAD_CACHE_MIN_TTL = int(environ.get("GEMINI_UPLOAD_CACHE_MIN_TTL", 6 * 60 * 60))
+_upload_cache = TTLCache(max_entries=int(environ.get("GEMINI_UPLOAD_CACHE_MAX_ENTRIES", 1024)), ttl=GEMINI_FILE_TTL)
+_upload_cache_counters = {"hits": 0, "persisted_hits": 0, "misses": 0, "bytes_saved": 0}
+
+# Totals of the Gemini agent loop across every message, see ChatSession.turn_stats
+_agent_loop_counters = {"messages": 0, "round_trips": 0, "tool_calls": 0, "model_seconds": 0.0, "tool_seconds": 0.0}
+
+def record_agent_turn(turn_stats: dict) -> None:
+    _agent_loop_counters["messages"] += 1
+    for _key, _value in turn_stats.items():
+        _agent_loop_counters[_key] += _value
+
+# Agent loop statistics for the admin cachestats command
+def agent_loop_stats() -> dict:
+    _messages = _agent_loop_counters["messages"]
+    return {
+        **{_key: round(_value, 2) if isinstance(_value, float) else _value for _key, _value in _agent_loop_counters.items()},
+        "round_trips_per_message": round(_agent_loop_counters["round_trips"] / _messages, 2) if _messages else 0.0,
+        "model_seconds_per_round_trip": round(_agent_loop_counters["model_seconds"] / _agent_loop_counters["round_trips"], 2) if _agent_loop_counters["round_trips"] else 0.0
+    }
+
+# Upload cache statistics for the admin cachestats command
+def upload_cache_stats() -> dict:
+    _lookups = _upload_cache_counters["hits"] + _upload_cache_counters["misses"]
+    return {
+        "entries": len(_upload_cache),
+        **_upload_cache_counters,
+        "hit_rate": round(_upload_cache_counters["hits"] / _lookups, 4) if _lookups else 0.0
+    }
+
+# Looks up a live upload in memory, then in the database shared with other bot processes
+async def _get_cached_upload(cache_key: str, db_conn) -> dict:
+    _upload = _upload_cache.get(cache_key)
+    if not _upload and db_conn:
+        _upload = await db_conn.get_cached("gemini_uploads", cache_key)
+        if _upload:
+            _upload_cache_counters["persisted_hits"] += 1
+            _upload_cache.set(cache_key, _upload, ttl=_upload["expires_at"] - GEMINI_UPLOAD_CACHE_MIN_TTL - time.time())
+
+    if _upload:
+        _upload_cache_counters["hits"] += 1
+    else:
+        _upload_cache_counters["misses"] += 1
+    return _upload
+
+async def _set_cached_upload(cache_key: str, upload: dict, db_conn) -> None:
+    _ttl = upload["expires_at"] - GEMINI_UPLOAD_CACHE_MIN_TTL - time.time()
+    if _ttl <= 0:
+        return
+
+    _upload_cache.set(cache_key, upload, ttl=_ttl)
+    if db_conn:
+        await db_conn.set_cached("gemini_uploads", cache_key, upload, ttl=_ttl)
 
 class GoogleUtils:
     # Handle multimodal
-    async def upload_files(self, attachment: typehint_Discord.Attachment, extra_metadata: str = None):
-        if not hasattr(self, "uploaded_files"):
-            self.uploaded_files = []
-
+    # Returns the prompt parts for the attachment, the caller adds them to uploaded_files in attachment order
+    async def upload_files(self, attachment: typehint_Discord.Attachment, extra_metadata: str = None) -> list:
         # Test if we have "self.discord_bot.aiohttp_instance"
         if hasattr(self.discord_bot, "aiohttp_instance"):
             logging.info("Found aiohttp_instance in discord bot, using that for downloading the file")
@@ -24,133 +95,205 @@ class GoogleUtils:
             logging.warning("No aiohttp_instance found in discord bot, aborting")
             raise CustomErrorMessage("⚠️ An error has occurred while processing the file, please try again later.")
 
-        # Grab filename
-        _filename = f"{environ.get('TEMP_DIR')}/JAKEY.{uuid4()}.{attachment.filename}"
-         # Sometimes mimetype has text/plain; charset=utf-8, we need to grab the first part
+        # Sometimes mimetype has text/plain; charset=utf-8, we need to grab the first part
         _mimetype = attachment.content_type.split(";")[0]
-        try:
-            async with _aiohttp_session.get(attachment.url, allow_redirects=True) as file_dl:
-                # write to file with random number ID
-                async with aiofiles.open(_filename, "wb") as filepath:
-                    async for _chunk in file_dl.content.iter_chunked(8192):
-                        await filepath.write(_chunk)
-
-            # Upload the file
-            _filedata = await self.google_genai_client.aio.files.upload(
-                file=_filename, 
-                config={
-                    "mime_type": _mimetype
-                }
-            )
 
-            while _filedata.state == "PROCESSING":
-                _filedata = await self.google_genai_client.aio.files.get(name=_filedata.name)
-                await asyncio.sleep(2.5)
-        except Exception as e:
-            # Raise exception
-            raise e
-        finally:
-            # Remove the file if it exists ensuring no data persists even on failure
-            if Path(_filename).exists():
-                await aiofiles.os.remove(_filename)
+        # Large images are downsampled first, so most photos can be sent inline afterwards
+        _data = None
+        _preprocessed = await preprocess_attachment(attachment, _aiohttp_session, getattr(getattr(self, "model_props", None), "max_image_resolution", None))
+        if _preprocessed:
+            _data, _mimetype = _preprocessed
 
-            # Close the temporary aiohttp session if we created one
-            if not hasattr(self.discord_bot, "aiohttp_instance"):
-                logging.info("Closing temporary aiohttp client session on models.providers.google.utils.GoogleUtils.upload_files")
-                await _aiohttp_session.close()
+        # Small attachments skip the upload, polling and expiry entirely
+        if (len(_data) if _data is not None else attachment.size) <= GEMINI_INLINE_MAX_BYTES:
+            if _data is None:
+                async with _aiohttp_session.get(attachment.url, allow_redirects=True) as file_dl:
+                    file_dl.raise_for_status()
+                    _data = await file_dl.read()
 
-        # Add to the uploaded files
-        self.uploaded_files.append(
-            {
-                "file_data": {
-                    "file_uri": _filedata.uri,
-                    "mime_type": _mimetype
+            logging.info("Sending attachment %s inline with %s bytes", attachment.filename, len(_data))
+            _parts = [
+                {
+                    "inline_data": {
+                        "mime_type": _mimetype,
+                        "data": _data
+                    }
                 }
-            }
-        )
+            ]
+        else:
+            _parts = [await self._upload_to_files_api(attachment, _mimetype, _aiohttp_session, data=_data)]
 
         # Check for extra metadata
         if extra_metadata:
-            self.uploaded_files.append(
+            _parts.append(
                 {
                     "text": extra_metadata
                 }
             )
+        return _parts
 
-    # Tool Runs
-    # Process Tools
-    async def load_tools(self):
-        _tool_name = await self.db_conn.get_key(self.user_id, "tool_use")
+    # Uploads large attachments to the Files API, returns the file_data part
+    # The attachment is downloaded unless its preprocessed contents are passed as data
+    async def _upload_to_files_api(self, attachment: typehint_Discord.Attachment, _mimetype: str, _aiohttp_session: aiohttp.ClientSession, data: bytes = None) -> dict:
+        # The download is spooled in memory and only rolls over to TEMP_DIR for large files
+        # The spool is passed to the Files API as is, so the bytes are never copied to a named temp file
+        _spool = tempfile.SpooledTemporaryFile(max_size=GEMINI_UPLOAD_SPOOL_MAX_BYTES, dir=environ.get("TEMP_DIR"))
+        try:
+            # Hash the contents while downloading to find previous uploads of the same file
+            _sha256 = hashlib.sha256()
+            _size = 0
 
-        # For models to read the available tools to be executed
-        self.tool_schema: list = await fetch_tool_schema(_tool_name, tool_type="google")
+            # Once the spool rolls over to disk, writes go through a thread so they don't block the event loop
+            async def _write(chunk: bytes) -> None:
+                nonlocal _size
+                _sha256.update(chunk)
+                _size += len(chunk)
+                if _size > GEMINI_UPLOAD_SPOOL_MAX_BYTES:
+                    await asyncio.to_thread(_spool.write, chunk)
+                else:
+                    _spool.write(chunk)
 
-        # Tool class object containing all functions
-        self.tool_object_payload: object = await return_api_tools_object(_tool_name, discord_message=self.discord_message, discord_bot=self.discord_bot)
+            if data is not None:
+                await _write(data)
+            else:
+                async with _aiohttp_session.get(attachment.url, allow_redirects=True) as file_dl:
+                    file_dl.raise_for_status()
+                    async for _chunk in file_dl.content.iter_chunked(65536):
+                        await _write(_chunk)
 
-    # Runs tools and outputs parts
-    async def execute_tools(self, name: str, arguments: str) -> list:
-        _tool_parts = []
-        # Reject tool calls when no schema is loaded to avoid hallucinated tools
-        if not isinstance(getattr(self, "tool_schema", None), list) or not self.tool_schema:
-            logging.critical("Attempted to call tools without a loaded schema nor proper initialization... THIS IS A SECURITY RISK! Therefore we stopped executing this tool: %s", name)
-            _tool_parts.append(
-                {
-                    "function_response": {
-                        "name": name,
-                        "response": {
-                            "error": "Tools and agents are not yet properly initialized. Please tell the user to activate any tools via the /agent slash command and try again."
-                        }
+            _cache_key = f"{_sha256.hexdigest()}:{_mimetype}"
+            _upload = await _get_cached_upload(_cache_key, self.db_conn)
+            if _upload:
+                logging.info("Reusing uploaded file %s for attachment %s", _upload["file_uri"], attachment.filename)
+                _upload_cache_counters["bytes_saved"] += _size
+            else:
+                # Upload the file
+                _spool.seek(0)
+                _filedata = await self.google_genai_client.aio.files.upload(
+                    file=_spool,
+                    config={
+                        "mime_type": _mimetype,
+                        "display_name": attachment.filename
                     }
+                )
+                _filedata = await self._wait_for_file_processing(_filedata)
+
+                # Upload and expiry times are tracked so expired files can be replaced before they're sent
+                _uploaded_at = time.time()
+                _upload = {
+                    "file_uri": _filedata.uri,
+                    "uploaded_at": _uploaded_at,
+                    "expires_at": _filedata.expiration_time.timestamp() if _filedata.expiration_time else _uploaded_at + GEMINI_FILE_TTL
                 }
-            )
-            return _tool_parts
+                await _set_cached_upload(_cache_key, _upload, self.db_conn)
+        finally:
+            # Discard the spool ensuring no data persists even on failure
+            _spool.close()
 
-        # Check if the requested tool name is in the schema or hallucinated
-        _tool_names = [
-            _tool["name"] for _tool in self.tool_schema
-            if isinstance(_tool, dict) and _tool.get("name")
-        ]
-        if name not in _tool_names:
-            logging.critical("Attempted to call a tool that is not in the loaded tool schema: %s", name)
-            raise CustomErrorMessage("🛑 The response is terminated due to an invalid tool call.")
+            # Close the temporary aiohttp session if we created one
+            if not hasattr(self.discord_bot, "aiohttp_instance"):
+                logging.info("Closing temporary aiohttp client session on models.providers.google.utils.GoogleUtils.upload_files")
+                await _aiohttp_session.close()
 
-        # Import builtin tool payload if applicable
-        _builtin_tool_object_payload = await return_builtin_tool_object(name, discord_message=self.discord_message, discord_bot=self.discord_bot)
+        return {
+            "file_data": {
+                "file_uri": _upload["file_uri"],
+                "mime_type": _mimetype
+            },
+            "_meta": {
+                "uploaded_at": _upload["uploaded_at"],
+                "expires_at": _upload["expires_at"]
+            }
+        }
 
-        # Execute tools
-        # Check for payloads and presence of the function to determine the type of tool to call
-        if self.tool_object_payload and hasattr(self.tool_object_payload, f"tool_{name}"):
-            _func_payload = getattr(self.tool_object_payload, f"tool_{name}")
+    # Poll until the file leaves the PROCESSING state, most files are ready within the first few polls
+    # so the interval starts short and backs off exponentially
+    async def _wait_for_file_processing(self, filedata):
+        _delay = GEMINI_UPLOAD_POLL_INITIAL_DELAY
+        _deadline = time.monotonic() + GEMINI_UPLOAD_PROCESSING_TIMEOUT
+        while filedata.state == "PROCESSING":
+            if time.monotonic() + _delay > _deadline:
+                logging.error("File %s is still processing after %s seconds", filedata.name, GEMINI_UPLOAD_PROCESSING_TIMEOUT)
+                raise CustomErrorMessage("⚠️ The file took too long to process, please try again later.")
 
-            # Show indicator if the user-selected tool is being used
-            await self.discord_message.channel.send(f"> -# Using: ***{name}***")
+            await asyncio.sleep(_delay)
+            _delay = min(_delay * 2, GEMINI_UPLOAD_POLL_MAX_DELAY)
+            filedata = await self.google_genai_client.aio.files.get(name=filedata.name)
 
-        # Check if it's a built-in tool, hopefully, and don't show indicator since it's not an agentic tool
-        elif hasattr(_builtin_tool_object_payload, f"tool_{name}"):
-            _func_payload = getattr(_builtin_tool_object_payload, f"tool_{name}")
+        if filedata.state == "FAILED":
+            logging.error("File %s failed to process: %s", filedata.name, filedata.error)
+            raise CustomErrorMessage("⚠️ This file could not be processed, please try another file.")
+        return filedata
 
-        # If all else fails
+    # Tool Runs
+    # Process Tools
+    async def load_tools(self):
+        # Use pre-fetched settings when available
+        if "tool_use" in self.user_settings:
+            _tool_name = self.user_settings["tool_use"]
         else:
-            logging.error("I think I found a problem related to function calling or the tool function implementation is not available: %s")
-            raise CustomErrorMessage("⚠️ An error has occurred while trying to execute agent tools, try choosing another tools to continue.")
+            _tool_name = await self.db_conn.get_key(self.user_id, "tool_use")
+
+        # For models to read the available tools to be executed
+        self.tool_schema: list = await fetch_tool_schema(_tool_name, tool_type="google")
+
+        # Tool functions resolved once by the tool runtime and the Discord state they're called with
+        self.tool_dispatch = get_tool_dispatch(_tool_name)
+        self.tool_context = ToolContext(discord_message=self.discord_message, discord_bot=self.discord_bot)
+
+    # Runs a function call and returns its part, errors raised by the tool are returned to the model
+    async def _execute_tool_call(self, function_call, serial_lock: asyncio.Lock) -> dict:
+        _func_payload = self.tool_dispatch.functions[function_call.name]
+
+        # Show indicator if the user-selected tool is being used, built-in tools don't show it since they're not agentic
+        if _func_payload.agentic:
+            await self.discord_message.channel.send(f"> -# Using: ***{function_call.name}***")
 
         # Call the tools
         try:
-            _tool_result = {"api_result": await _func_payload(**arguments)}
+            _tool_result = {"api_result": await call_tool(_func_payload, self.tool_context, function_call.args or {}, serial_lock)}
         except Exception as e:
             logging.error("An error occurred while calling tool function: %s", e)
             _tool_result = {"error": f"⚠️ Something went wrong while executing the tool: {e}\nTell the user about this error"}
 
-        # Append the parts
-        _tool_parts.append(
-            {
-                "function_response": {
-                    "name": name,
-                    "response": _tool_result
-                }
-            }
-        )
+        _function_response = {
+            "name": function_call.name,
+            "response": _tool_result
+        }
+        if function_call.id:
+            _function_response["id"] = function_call.id
+        return {"function_response": _function_response}
+
+    # Runs every function call of a response and outputs the parts in the same order
+    async def execute_tools(self, function_calls: list) -> list:
+        # Reject tool calls when no schema is loaded to avoid hallucinated tools
+        if not isinstance(getattr(self, "tool_schema", None), list) or not self.tool_schema:
+            _tool_parts = []
+            for _function_call in function_calls:
+                logging.critical("Attempted to call tools without a loaded schema nor proper initialization... THIS IS A SECURITY RISK! Therefore we stopped executing this tool: %s", _function_call.name)
+                _tool_parts.append(
+                    {
+                        "function_response": {
+                            "name": _function_call.name,
+                            "response": {
+                                "error": "Tools and agents are not yet properly initialized. Please tell the user to activate any tools via the /agent slash command and try again."
+                            }
+                        }
+                    }
+                )
+            return _tool_parts
+
+        # Check every call before running any of them
+        for _function_call in function_calls:
+            # Check if the requested tool name is in the schema or hallucinated
+            if _function_call.name not in self.tool_dispatch.names:
+                logging.critical("Attempted to call a tool that is not in the loaded tool schema: %s", _function_call.name)
+                raise CustomErrorMessage("🛑 The response is terminated due to an invalid tool call.")
+
+            if _function_call.name not in self.tool_dispatch.functions:
+                logging.error("I think I found a problem related to function calling or the tool function implementation is not available: %s", _function_call.name)
+                raise CustomErrorMessage("⚠️ An error has occurred while trying to execute agent tools, try choosing another tools to continue.")
 
-        # Return the parts
-        return _tool_parts
+        # Independent calls run concurrently, gather keeps the parts in the same order as function_calls
+        _serial_lock = asyncio.Lock()
+        return list(await asyncio.gather(*(self._execute_tool_call(_function_call, _serial_lock) for _function_call in function_calls)))
@@ -1,9 +1,12 @@
 from .utils import LiteLLMUtils
 from core.database import History as typehint_History
 from core.exceptions import CustomErrorMessage
-from models.validation import ModelParamsOpenAIDefaults as typehint_ModelParams
+from models.chat_utils import strip_turn_metadata
+from models.context_window import compute_context_budget, fit_context_window
+from models.config import get_model_params
 from models.validation import ModelProps as typehint_ModelProps
 from os import environ
+from types import MappingProxyType
 import discord as typehint_Discord
 import litellm
 import logging
@@ -16,7 +19,8 @@ class ChatSession(LiteLLMUtils):
                  discord_bot: typehint_Discord.Bot = None,
                  discord_message: typehint_Discord.Message = None,
                  db_conn: typehint_History = None,
-                 client_name: str = None):
+                 client_name: str = None,
+                 user_settings: dict = None):
         # Discord bot object - needed for interactions with current state of Discord API
         self.discord_bot: typehint_Discord.Bot = discord_bot or None
 
@@ -39,15 +43,17 @@ class ChatSession(LiteLLMUtils):
             logging.error("Invalid model_props provided: %s", e)
             raise ValueError(f"Invalid model_props: {e}")
 
-        # Model params
-        _model_params: typehint_ModelParams = typehint_ModelParams()
-        self.model_params: dict = _model_params.model_dump()
+        # Request params are compiled once per model when models.yaml is loaded
+        self.model_params: MappingProxyType = get_model_params(self.model_props)
 
         # User ID
         self.user_id: int = user_id
 
         # Database
         self.db_conn: typehint_History = db_conn or None
+
+        # Pre-fetched user settings to avoid extra database reads
+        self.user_settings: dict = user_settings or {}
         
     # Chat
     async def send_message(self, prompt: str, chat_history: list = None, system_instructions: str = None):
@@ -81,45 +87,26 @@ class ChatSession(LiteLLMUtils):
         # Add the prepared prompt to chat history
         chat_history.append(_prep_prompt)
 
+        # Get response
+        if not self.model_props.model_id:
+            raise ValueError("Model is required, chose nothing")
+
+        # Model params already merged with additional_params
+        _merged_params = dict(self.model_params)
+
         # Check for tools
         if self.model_props.enable_tools:
             await self.load_tools()
-            self.model_params["tools"] = self.tool_schema
+            _merged_params["tools"] = self.tool_schema
 
-        # Get response
-        if not self.model_props.model_id:
-            raise ValueError("Model is required, chose nothing")
-        
-        # Additional model params
-        # Log
-        if self.model_props.additional_params:
-            logging.info("Merging additional_params into model_params: %s", self.model_props.additional_params)
-
-        # Reverse merge 
-        _merged_params = self.model_props.additional_params.copy() if self.model_props.additional_params else {}
-
-        # Remove model and messages if they exist in additional_params to avoid conflicts
-        logging.info("Removing conflicting keys from additional_params if present")
-        # Remove core conflicting keys
-        _merged_params.pop("model", None)
-        _merged_params.pop("messages", None)
-        _merged_params.pop("tools", None)
-
-        # Remove others found in model_params
-        for _keys in self.model_params.keys():
-            if _keys in _merged_params:
-                logging.info("Removing key from additional_params to avoid conflict: %s", _keys)
-                _merged_params.pop(_keys, None)
-
-        # Update with model defaults
-        _merged_params.update(self.model_params)
-        logging.info("Final merged model parameters: %s", _merged_params)
+        # Token budget for the chat history, older turns are trimmed to fit
+        _context_budget = compute_context_budget(self.model_props, _merged_params)
         
         # Drop unnecessary params
         litellm.drop_params = True
         _response = await litellm.acompletion(
             model=self.model_props.model_id,
-            messages=chat_history,
+            messages=strip_turn_metadata(fit_context_window(chat_history, _context_budget)),
             **_merged_params
         )
 
@@ -146,7 +133,7 @@ class ChatSession(LiteLLMUtils):
                 # Run the response the second time
                 _response = await litellm.acompletion(
                     model=self.model_props.model_id,
-                    messages=chat_history,
+                    messages=strip_turn_metadata(fit_context_window(chat_history, _context_budget)),
                     **_merged_params
                 )
 
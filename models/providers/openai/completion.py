@@ -1,9 +1,13 @@
 from .utils import OpenAIUtils
 from core.database import History as typehint_History
 from core.exceptions import CustomErrorMessage
-from models.validation import ModelParamsOpenAIDefaults as typehint_ModelParams
+from models.chat_utils import mark_turn_dirty, strip_turn_metadata
+from models.context_window import compute_context_budget, fit_context_window
+from models.config import get_model_params
+from models.context_cache import OPENAI_PROMPT_CACHE_KEY_HOSTS, prompt_cache_key
 from models.validation import ModelProps as typehint_ModelProps
 from os import environ
+from types import MappingProxyType
 import discord as typehint_Discord
 import logging
 import models.core
@@ -16,7 +20,8 @@ class ChatSession(OpenAIUtils):
                  discord_bot: typehint_Discord.Bot = None,
                  discord_message: typehint_Discord.Message = None,
                  db_conn: typehint_History = None,
-                 client_name: str = None):
+                 client_name: str = None,
+                 user_settings: dict = None):
         # Discord bot object - needed for interactions with current state of Discord API
         self.discord_bot: typehint_Discord.Bot = discord_bot or None
 
@@ -48,15 +53,17 @@ class ChatSession(OpenAIUtils):
             logging.error("Invalid model_props provided: %s", e)
             raise ValueError(f"Invalid model_props: {e}")
 
-        # Model params
-        _model_params: typehint_ModelParams = typehint_ModelParams()
-        self.model_params: dict = _model_params.model_dump()
+        # Request params are compiled once per model when models.yaml is loaded
+        self.model_params: MappingProxyType = get_model_params(self.model_props)
 
         # User ID
         self.user_id: int = user_id
 
         # Database
         self.db_conn: typehint_History = db_conn or None
+
+        # Pre-fetched user settings to avoid extra database reads
+        self.user_settings: dict = user_settings or {}
         
     # Chat
     async def send_message(self, prompt: str, chat_history: list = None, system_instructions: str = None):
@@ -68,7 +75,11 @@ class ChatSession(OpenAIUtils):
                     "role": "system",
                     "content": system_instructions
                 })
-
+        # Keep the stored system prompt up to date so every thread starts with the same cacheable prefix
+        elif self.model_props.enable_system_instruction and system_instructions \
+            and chat_history and chat_history[0].get("role") == "system" and chat_history[0].get("content") != system_instructions:
+            chat_history[0]["content"] = str(system_instructions)
+            mark_turn_dirty(chat_history[0])
 
         # Format the prompt
         _prep_prompt = {
@@ -90,49 +101,29 @@ class ChatSession(OpenAIUtils):
         # Add the prepared prompt to chat history
         chat_history.append(_prep_prompt)
 
+        # Get response
+        if not self.model_props.model_id:
+            raise ValueError("Model is required, chose nothing")
+
+        # Model params already merged with additional_params
+        _merged_params = dict(self.model_params)
+
         # Check for tools
         if self.model_props.enable_tools:
             await self.load_tools()
-            self.model_params["tools"] = self.tool_schema
+            _merged_params["tools"] = self.tool_schema
 
-        # Get response
-        if not self.model_props.model_id:
-            raise ValueError("Model is required, chose nothing")
-        
-        # Additional model params
-        # Log
-        if self.model_props.additional_params:
-            logging.info("Merging additional_params into model_params: %s", self.model_props.additional_params)
-
-        # Reverse merge 
-        _merged_params = self.model_props.additional_params.copy() if self.model_props.additional_params else {}
-
-        # Remove model and messages if they exist in additional_params to avoid conflicts
-        logging.info("Removing conflicting keys from additional_params if present")
-        # Remove core conflicting keys
-        _merged_params.pop("model", None)
-        _merged_params.pop("messages", None)
-        _merged_params.pop("tools", None)
-
-        # Check if reasoning_effort exists as max_tokens cannot coexist and must be max_completion_tokens instead
-        if "reasoning_effort" in _merged_params:
-            logging.info("reasoning_effort found in additional_params, converting from max_tokens to max_completion_tokens")
-            _merged_params["max_completion_tokens"] = self.model_params.pop("max_tokens", 16000)
-
-        # Remove others found in model_params
-        for _keys in self.model_params.keys():
-            if _keys in _merged_params:
-                logging.info("Removing key from additional_params to avoid conflict: %s", _keys)
-                _merged_params.pop(_keys, None)
-
-        # Update with model defaults
-        _merged_params.update(self.model_params)
-        logging.info("Final merged model parameters: %s", _merged_params)
+        # Requests with the same model, system prompt and tools share a key so they're routed to the same prompt cache
+        if self.openai_client.base_url.host in OPENAI_PROMPT_CACHE_KEY_HOSTS:
+            _merged_params.setdefault("prompt_cache_key", prompt_cache_key(self.model_props.model_id, system_instructions, _merged_params.get("tools")))
+
+        # Token budget for the chat history, older turns are trimmed to fit
+        _context_budget = compute_context_budget(self.model_props, _merged_params)
         
         # Generate responses
         _response = await self.openai_client.chat.completions.create(
             model=self.model_props.model_id,
-            messages=chat_history,
+            messages=strip_turn_metadata(fit_context_window(chat_history, _context_budget)),
             **_merged_params
         )
 
@@ -159,7 +150,7 @@ class ChatSession(OpenAIUtils):
                 # Run the response the second time
                 _response = await self.openai_client.chat.completions.create(
                     model=self.model_props.model_id,
-                    messages=chat_history,
+                    messages=strip_turn_metadata(fit_context_window(chat_history, _context_budget)),
                     **_merged_params
                 )
 
@@ -1,54 +1,29 @@
-from models.validation import TextTaskModelProps
-import aiofiles
+from models.config import get_allowlist, get_text_models
 import discord
 import logging
-import yaml
 
 async def fetch_text_model_config_async(override_model_id: str = None) -> dict:
-    # Load models list
-    async with aiofiles.open("data/text_models.yaml", "r") as _textmodels:
-        _text_models_list = yaml.safe_load(await _textmodels.read())
+    # Models are validated once when data/text_models.yaml is loaded
+    _text_models = get_text_models()
 
-    # Search through models for the first one with default: true
-    _accessFirstDefaultModel = None
-
-    # If override model ID is provided, we search associated dict and use that
+    # If override model ID is provided, we use that model
     if override_model_id:
-        for _model in _text_models_list:
-            # Check if we have a match
-            if _model.get("model_id") == override_model_id:
-                logging.info("Used overridden text model %s", _model.get("model_id"))
-                _accessFirstDefaultModel = _model
-                break
+        _model = _text_models.by_id.get(override_model_id)
+        if not _model:
+            raise ValueError(f"Text model {override_model_id} is not found in text_models.yaml")
+        logging.info("Used overridden text model %s", _model.model_id)
     else:
-        for _model in _text_models_list:
-            if _model.get("default") == True:
-                logging.info("Used default text model %s", _model.get("model_id"))
-                _accessFirstDefaultModel = _model
-                break
-        
-        if not _accessFirstDefaultModel:
+        # The first model with default: true
+        _model = _text_models.default
+        if not _model:
             raise ValueError("No default text generation model found in text_models.yaml. Please set at least one model with 'default: true'")
+        logging.info("Used default text model %s", _model.model_id)
 
-    # return and validate
-    return TextTaskModelProps(**_accessFirstDefaultModel).model_dump()
+    # Callers may modify the returned config so it's dumped on every call
+    return _model.model_dump()
 
         
+# Matches are ranked by the prebuilt index and restricted to the guild's allowlist if it has one
+# https://docs.pycord.dev/en/v2.6.1/api/application_commands.html#discord.AutocompleteContext
 async def get_text_models_async_autocomplete(ctx: discord.AutocompleteContext):
-    # ctx use is unused but required for autocomplete functions
-    # so
-    # TODO: add features like allowlist
-    # https://docs.pycord.dev/en/v2.6.1/api/application_commands.html#discord.AutocompleteContext
-    if not ctx:
-        pass
-
-    # Load the models list from YAML file
-    async with aiofiles.open("data/text_models.yaml", "r") as models:
-        _internal_model_data = yaml.safe_load(await models.read())
-
-    # Return the list of models
-    # Use list comprehension to build discord.OptionChoice list
-    return [
-        discord.OptionChoice(_model.get("model_human_name", "model_id"), _model["model_id"])
-        for _model in _internal_model_data
-    ]
\ No newline at end of file
+    return get_text_models().index.search(ctx.value, allowed=get_allowlist(ctx.interaction.guild_id, "text_models"))
\ No newline at end of file
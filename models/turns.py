@@ -0,0 +1,338 @@
+from dataclasses import dataclass, field
+from os import environ
+import base64
+import json
+import logging
+
+# zstd is optional, large parts are stored uncompressed without it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compact turn format for stored chat threads
+# Providers append raw SDK dumps to the chat history, these carry thought signatures, empty fields and
+# provider specific keys. Turns are normalized before they're stored and converted back to the
+# provider wire format when loaded, turns stored before this format are passed through as-is
+TURN_FORMAT_VERSION = 1
+
+# Text, inline attachments and tool results larger than this many bytes are zstd compressed, 0 disables compression
+CHAT_TURN_COMPRESS_MIN_BYTES = int(environ.get("CHAT_TURN_COMPRESS_MIN_BYTES", 4096))
+
+_compressor = zstandard.ZstdCompressor(level=3) if zstandard else None
+_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+if not zstandard and CHAT_TURN_COMPRESS_MIN_BYTES:
+    logging.info("zstandard is not installed, chat turns are stored uncompressed")
+
+# Gemini has no tool role, tool results are sent as user turns
+_GOOGLE_ROLES = {"assistant": "model", "tool": "user"}
+
+def _compress(data: bytes) -> bytes:
+    if not _compressor or not CHAT_TURN_COMPRESS_MIN_BYTES or len(data) < CHAT_TURN_COMPRESS_MIN_BYTES:
+        return None
+    _compressed = _compressor.compress(data)
+    return _compressed if len(_compressed) < len(data) else None
+
+def _decompress(data: bytes) -> bytes:
+    if not _decompressor:
+        raise RuntimeError("This chat thread has compressed turns, install zstandard to load it")
+    return _decompressor.decompress(data)
+
+@dataclass(slots=True)
+class Part:
+    # text, file, inline, image, call, result or raw for parts we don't know about
+    kind: str
+    text: str = None
+    mime_type: str = None
+    uri: str = None
+    data: bytes = None
+    name: str = None
+    args: object = None
+    response: object = None
+    call_id: str = None
+    raw: dict = None
+    meta: dict = None
+
+    ###############################################
+    # Stored format
+    ###############################################
+    def to_doc(self) -> dict:
+        if self.kind == "text":
+            _compressed = _compress(self.text.encode("utf-8"))
+            _doc = {"tz": _compressed} if _compressed else {"t": self.text}
+        elif self.kind == "file":
+            _doc = {"f": self.uri, "m": self.mime_type}
+        elif self.kind == "inline":
+            # Inline attachments are kept with the turn, text files compress well while most media won't
+            _compressed = _compress(self.data) if isinstance(self.data, bytes) else None
+            _doc = {"iz": _compressed} if _compressed else {"i": self.data}
+            _doc["m"] = self.mime_type
+        elif self.kind == "image":
+            _doc = {"u": self.uri}
+        elif self.kind == "call":
+            _doc = {"c": self.name, "a": self.args}
+        elif self.kind == "result":
+            _doc = {"n": self.name}
+            try:
+                _compressed = _compress(json.dumps(self.response).encode("utf-8"))
+            except (TypeError, ValueError):
+                _compressed = None
+            if _compressed:
+                _doc["rz"] = _compressed
+            else:
+                _doc["r"] = self.response
+        else:
+            _doc = {"x": self.raw}
+
+        if self.call_id:
+            _doc["id"] = self.call_id
+        if self.meta:
+            _doc["_meta"] = self.meta
+        return _doc
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> "Part":
+        _common = {"call_id": doc.get("id"), "meta": doc.get("_meta")}
+        if "t" in doc:
+            return cls("text", text=doc["t"], **_common)
+        if "tz" in doc:
+            return cls("text", text=_decompress(doc["tz"]).decode("utf-8"), **_common)
+        if "f" in doc:
+            return cls("file", uri=doc["f"], mime_type=doc.get("m"), **_common)
+        if "i" in doc:
+            return cls("inline", data=doc["i"], mime_type=doc.get("m"), **_common)
+        if "iz" in doc:
+            return cls("inline", data=_decompress(doc["iz"]), mime_type=doc.get("m"), **_common)
+        if "u" in doc:
+            return cls("image", uri=doc["u"], **_common)
+        if "c" in doc:
+            return cls("call", name=doc["c"], args=doc.get("a"), **_common)
+        if "n" in doc:
+            _response = json.loads(_decompress(doc["rz"])) if "rz" in doc else doc.get("r")
+            return cls("result", name=doc["n"], response=_response, **_common)
+        return cls("raw", raw=doc.get("x"), **_common)
+
+    ###############################################
+    # Gemini wire format
+    ###############################################
+    @classmethod
+    def from_google(cls, part: dict) -> "Part":
+        # Thoughts and their signatures are not needed once the turn is complete
+        if part.get("thought"):
+            return None
+
+        _meta = part.get("_meta")
+        if part.get("function_call"):
+            _call = part["function_call"]
+            return cls("call", name=_call.get("name"), args=_call.get("args"), call_id=_call.get("id"), meta=_meta)
+        if part.get("function_response"):
+            _result = part["function_response"]
+            return cls("result", name=_result.get("name"), response=_result.get("response"), call_id=_result.get("id"), meta=_meta)
+        if part.get("file_data"):
+            return cls("file", uri=part["file_data"].get("file_uri"), mime_type=part["file_data"].get("mime_type"), meta=_meta)
+        if part.get("inline_data"):
+            return cls("inline", data=part["inline_data"].get("data"), mime_type=part["inline_data"].get("mime_type"), meta=_meta)
+        if part.get("text") is not None:
+            return cls("text", text=part["text"], meta=_meta)
+
+        # Keep anything else such as code execution parts
+        _raw = {_key: _value for _key, _value in part.items() if _key not in ("_meta", "thought_signature") and _value is not None}
+        return cls("raw", raw=_raw, meta=_meta) if _raw else None
+
+    def to_google(self) -> dict:
+        if self.kind == "text":
+            _part = {"text": self.text}
+        elif self.kind == "file":
+            _part = {"file_data": {"file_uri": self.uri, "mime_type": self.mime_type}}
+        elif self.kind == "inline":
+            _part = {"inline_data": {"mime_type": self.mime_type, "data": self.data}}
+        elif self.kind == "image":
+            _part = {"text": f"[image: {self.uri}]"}
+        elif self.kind == "call":
+            _part = {"function_call": {"name": self.name, "args": self.args if isinstance(self.args, dict) else {}}}
+            if self.call_id:
+                _part["function_call"]["id"] = self.call_id
+        elif self.kind == "result":
+            _part = {"function_response": {"name": self.name, "response": self.response if isinstance(self.response, dict) else {"api_result": self.response}}}
+            if self.call_id:
+                _part["function_response"]["id"] = self.call_id
+        else:
+            _part = dict(self.raw or {})
+
+        if self.meta:
+            _part["_meta"] = self.meta
+        return _part
+
+    ###############################################
+    # OpenAI wire format, also used by LiteLLM
+    ###############################################
+    @classmethod
+    def from_openai(cls, part) -> "Part":
+        if isinstance(part, str):
+            return cls("text", text=part)
+
+        _meta = part.get("_meta")
+        if part.get("type") == "text":
+            return cls("text", text=part.get("text") or "", meta=_meta)
+        if part.get("type") == "image_url":
+            _url = (part.get("image_url") or {}).get("url") or ""
+
+            # Preprocessed images are sent as data URLs, their bytes are stored rather than the base64 text
+            if _url.startswith("data:") and ";base64," in _url:
+                _mime_type, _data = _url[5:].split(";base64,", 1)
+                return cls("inline", data=base64.b64decode(_data), mime_type=_mime_type, meta=_meta)
+            return cls("image", uri=_url, meta=_meta)
+        return cls("raw", raw={_key: _value for _key, _value in part.items() if _key != "_meta"}, meta=_meta)
+
+    def to_openai(self) -> dict:
+        if self.kind == "text":
+            _part = {"type": "text", "text": self.text}
+        elif self.kind == "image":
+            _part = {"type": "image_url", "image_url": {"url": self.uri}}
+        elif self.kind == "inline":
+            _part = {"type": "image_url", "image_url": {"url": f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('ascii')}"}}
+        elif self.kind == "file":
+            _part = {"type": "text", "text": f"[file: {self.uri}]"}
+        else:
+            _part = dict(self.raw or {})
+
+        if self.meta:
+            _part["_meta"] = self.meta
+        return _part
+
+@dataclass(slots=True)
+class Turn:
+    # system, user, assistant or tool
+    role: str
+    parts: list = field(default_factory=list)
+    meta: dict = None
+
+    # Gemini tool results are appended as bare parts rather than a turn
+    bare: bool = False
+
+    ###############################################
+    # Stored format
+    ###############################################
+    def to_doc(self) -> dict:
+        _doc = {"v": TURN_FORMAT_VERSION, "r": self.role, "p": [_part.to_doc() for _part in self.parts]}
+        if self.bare:
+            _doc["b"] = True
+        if self.meta:
+            _doc["_meta"] = self.meta
+        return _doc
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> "Turn":
+        return cls(doc["r"], [Part.from_doc(_part) for _part in doc["p"]], meta=doc.get("_meta"), bare=doc.get("b", False))
+
+    ###############################################
+    # Wire formats
+    ###############################################
+    @classmethod
+    def from_google(cls, turn: dict) -> "Turn":
+        if "role" not in turn:
+            _part = Part.from_google(turn)
+            return cls("tool", [_part] if _part else [], meta=turn.get("_meta"), bare=True)
+
+        _parts = [_part for _part in map(Part.from_google, turn.get("parts") or []) if _part]
+        if turn["role"] == "model":
+            _role = "assistant"
+        elif _parts and all(_part.kind == "result" for _part in _parts):
+            _role = "tool"
+        else:
+            _role = turn["role"]
+        return cls(_role, _parts, meta=turn.get("_meta"))
+
+    def to_google(self) -> dict:
+        if self.bare and len(self.parts) == 1:
+            _turn = self.parts[0].to_google()
+            if self.meta:
+                _turn["_meta"] = self.meta
+            return _turn
+
+        _turn = {"role": _GOOGLE_ROLES.get(self.role, self.role), "parts": [_part.to_google() for _part in self.parts]}
+        if self.meta:
+            _turn["_meta"] = self.meta
+        return _turn
+
+    @classmethod
+    def from_openai(cls, turn: dict) -> "Turn":
+        _role = turn["role"]
+        _content = turn.get("content")
+
+        if _role == "tool":
+            _parts = [Part("result", response=_content, call_id=turn.get("tool_call_id"), name=turn.get("name"))]
+        elif isinstance(_content, list):
+            _parts = [Part.from_openai(_part) for _part in _content]
+        elif _content:
+            _parts = [Part("text", text=_content)]
+        else:
+            _parts = []
+
+        for _tool_call in turn.get("tool_calls") or []:
+            _function = _tool_call.get("function") or {}
+            _parts.append(Part("call", name=_function.get("name"), args=_function.get("arguments"), call_id=_tool_call.get("id")))
+
+        return cls(_role, _parts, meta=turn.get("_meta"))
+
+    def to_openai(self) -> dict:
+        if self.role == "tool":
+            _result = next((_part for _part in self.parts if _part.kind == "result"), None)
+            _response = _result.response if _result else ""
+            _turn = {
+                "role": "tool",
+                "tool_call_id": _result.call_id if _result else None,
+                "content": _response if isinstance(_response, str) else json.dumps(_response)
+            }
+        else:
+            _content_parts = [_part for _part in self.parts if _part.kind != "call"]
+            _tool_calls = [_part for _part in self.parts if _part.kind == "call"]
+            _turn = {"role": self.role}
+
+            # System and assistant content is sent as a string, user content as typed parts
+            if self.role == "user":
+                _turn["content"] = [_part.to_openai() for _part in _content_parts]
+            else:
+                # Content can only be empty when the assistant calls tools
+                _turn["content"] = "".join(_part.text for _part in _content_parts if _part.kind == "text") or (None if _tool_calls else "")
+
+            if _tool_calls:
+                _turn["tool_calls"] = [
+                    {
+                        "id": _part.call_id,
+                        "type": "function",
+                        "function": {
+                            "name": _part.name,
+                            "arguments": _part.args if isinstance(_part.args, str) else json.dumps(_part.args or {})
+                        }
+                    }
+                    for _part in _tool_calls
+                ]
+
+        if self.meta:
+            _turn["_meta"] = self.meta
+        return _turn
+
+# Checks if a stored turn uses the compact format
+def is_compact_turn(doc) -> bool:
+    return isinstance(doc, dict) and doc.get("v") == TURN_FORMAT_VERSION and "r" in doc
+
+# Converts a provider turn to the stored format
+# Returns None for Gemini turns left without parts, such as turns made only of thoughts, since Gemini rejects empty turns
+def encode_turn(turn: dict, sdk: str) -> dict:
+    if sdk == "google":
+        _turn = Turn.from_google(turn)
+        return _turn.to_doc() if _turn.parts else None
+    return Turn.from_openai(turn).to_doc()
+
+# Converts a stored turn to the provider wire format, turns stored before the compact format are returned as-is
+# Returns None for Gemini turns without parts so they can be skipped
+def decode_turn(doc: dict, sdk: str) -> dict:
+    if not is_compact_turn(doc):
+        return doc
+
+    _turn = Turn.from_doc(doc)
+    if sdk == "google":
+        return _turn.to_google() if _turn.parts else None
+    return _turn.to_openai()
@@ -1,5 +1,5 @@
 from typing import List, Literal
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 class TextTaskModelProps(BaseModel):
     model_id: str = Field(..., description="Model identifier")
@@ -10,6 +10,9 @@ class TextTaskModelProps(BaseModel):
     model_specific_params: dict = Field(default={"temperature": 1}, description="Model specific parameters")
 
 class ModelProps(BaseModel):
+    # Shared across sessions once loaded from data/models.yaml
+    model_config = ConfigDict(frozen=True)
+
     # model_alias is used as a unique identifier to the model for fetching model from history and parse it
     model_alias: str = Field(..., description="Model alias")
     model_human_name: str = Field(..., description="Human-friendly model name")
@@ -24,6 +27,8 @@ class ModelProps(BaseModel):
     enable_threads: bool = Field(default=True, description="Enable chat history")
     enable_system_instruction: bool = Field(default=True, description="Enable system instructions")
     thread_name: str = Field(default=None, description="Use the same SDK but use a different thread name for chat separation")
+    context_window: int = Field(default=None, description="Maximum number of tokens the model accepts, including output tokens")
+    max_image_resolution: int = Field(default=None, description="Longest side in pixels images are downsampled to before they're sent, images are sent as-is when unset")
 
 class ModelParamsOpenAIDefaults(BaseModel):
     temperature: int = Field(default=1)
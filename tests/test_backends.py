@@ -0,0 +1,108 @@
+from core.backends import create_backend
+import asyncio
+import pytest
+
+# Contract of core.backends.base.HistoryBackend, every case runs against each local backend
+
+@pytest.fixture(params=["memory", "sqlite"])
+def run_case(request, tmp_path):
+    def _run(case):
+        async def _main():
+            _backend = create_backend(request.param, db_path=str(tmp_path / "history.db"))
+            await _backend.start()
+            try:
+                await case(_backend)
+            finally:
+                await _backend.close()
+        asyncio.run(_main())
+    return _run
+
+def turns(*names) -> list:
+    return [{"role": "user", "parts": [{"text": _name}]} for _name in names]
+
+def texts(records: list) -> list:
+    return [(_record["seq"], _record["turn"]["parts"][0]["text"]) for _record in records]
+
+def test_append_turns_assigns_seq_ranges(run_case):
+    async def case(backend):
+        assert await backend.append_turns("1", "google", turns("a", "b")) == [0, 1]
+        assert await backend.append_turns("1", "google", turns("c")) == [2]
+
+        # Threads and users have their own sequences
+        assert await backend.append_turns("1", "openai", turns("x")) == [0]
+        assert await backend.append_turns("2", "google", turns("y")) == [0]
+
+        assert texts(await backend.load_turns("1", "google")) == [(0, "a"), (1, "b"), (2, "c")]
+        assert (await backend.get_turn("1", "google", 1))["parts"][0]["text"] == "b"
+        assert await backend.get_turn("1", "google", 9) is None
+    run_case(case)
+
+def test_load_turns_limit_and_before_seq(run_case):
+    async def case(backend):
+        await backend.append_turns("1", "google", turns("a", "b", "c", "d", "e"))
+
+        # Latest turns in ascending order
+        assert texts(await backend.load_turns("1", "google", limit=2)) == [(3, "d"), (4, "e")]
+        assert texts(await backend.load_turns("1", "google", limit=2, before_seq=3)) == [(1, "b"), (2, "c")]
+        assert texts(await backend.load_turns("1", "google", before_seq=2)) == [(0, "a"), (1, "b")]
+        assert await backend.load_turns("1", "missing") == []
+    run_case(case)
+
+def test_update_turns(run_case):
+    async def case(backend):
+        await backend.append_turns("1", "google", turns("a", "b", "c"))
+        await backend.update_turns("1", "google", {0: turns("A")[0], 2: turns("C")[0]})
+        assert texts(await backend.load_turns("1", "google")) == [(0, "A"), (1, "b"), (2, "C")]
+
+        # Missing turns aren't created
+        await backend.update_turns("1", "google", {7: turns("Z")[0]})
+        assert texts(await backend.load_turns("1", "google")) == [(0, "A"), (1, "b"), (2, "C")]
+    run_case(case)
+
+def test_replace_turns(run_case):
+    async def case(backend):
+        await backend.append_turns("1", "google", turns("a", "b", "c", "d", "e"))
+        await backend.replace_turns("1", "google", 0, 3, turns("summary", "ack"))
+        assert texts(await backend.load_turns("1", "google")) == [(0, "summary"), (1, "ack"), (4, "e")]
+
+        # New turns continue after the highest sequence number
+        assert await backend.append_turns("1", "google", turns("f")) == [5]
+    run_case(case)
+
+def test_reset_document(run_case):
+    async def case(backend):
+        await backend.set_fields("1", {"default_model": "a", "tool_use": "b", "other": "c"})
+        await backend.append_turns("1", "google", turns("a"))
+        await backend.put_archive("1", "google", "tool_output:1", {"output": "x"})
+
+        await backend.reset_document("1", ("default_model", "tool_use"), {"tool_use": "d"})
+        assert await backend.get_fields("1", ["default_model", "tool_use", "other"]) == {"default_model": "a", "tool_use": "d"}
+        assert await backend.load_turns("1", "google") == []
+        assert await backend.get_archive("1", "tool_output:1") is None
+    run_case(case)
+
+def test_delete_thread(run_case):
+    async def case(backend):
+        await backend.set_fields("1", {"default_openrouter_model": "a"})
+        await backend.append_turns("1", "google", turns("a"))
+        await backend.append_turns("1", "openrouter", turns("b", "c"))
+        await backend.put_archive("1", "openrouter", "tool_output:1", {"output": "x"})
+        await backend.put_archive("1", "google", "tool_output:2", {"output": "y"})
+
+        await backend.delete_thread("1", "openrouter", {"default_openrouter_model": "b"})
+        assert await backend.load_turns("1", "openrouter") == []
+        assert await backend.get_archive("1", "tool_output:1") is None
+        assert await backend.get_fields("1", ["default_openrouter_model"]) == {"default_openrouter_model": "b"}
+
+        # Other threads are kept, and the cleared thread starts over
+        assert texts(await backend.load_turns("1", "google")) == [(0, "a")]
+        assert await backend.get_archive("1", "tool_output:2") == {"output": "y"}
+        assert await backend.append_turns("1", "openrouter", turns("d")) == [0]
+    run_case(case)
+
+def test_values_round_trip(run_case):
+    async def case(backend):
+        _value = {"bytes": b"\x00\x01", "nested": [1, 2.5, None, "text"]}
+        await backend.set_fields("1", {"value": _value})
+        assert await backend.get_fields("1", ["value", "missing"]) == {"value": _value}
+    run_case(case)
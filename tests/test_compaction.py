@@ -0,0 +1,113 @@
+from core.database import History
+from models.chat_utils import load_history, save_history
+import asyncio
+import models.compaction
+import models.context_window
+import pytest
+import types
+
+# Compaction of stored chat threads against the memory backend, the summarizer is replaced with a stub
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    _prompts = []
+
+    async def completion(prompt: str, **kwargs):
+        _prompts.append(prompt)
+        return "The user greeted Jakey many times"
+
+    async def fetch_text_model_config_async():
+        return {"sdk": "stub", "model_id": "stub", "client_name": None, "model_specific_params": {}}
+
+    async def set_assistant_type(*args, **kwargs):
+        return "Summarize"
+
+    monkeypatch.setattr(models.compaction, "fetch_text_model_config_async", fetch_text_model_config_async)
+    monkeypatch.setattr(models.compaction, "set_assistant_type", set_assistant_type)
+    monkeypatch.setattr(models.compaction, "importlib", types.SimpleNamespace(import_module=lambda name: types.SimpleNamespace(completion=completion)))
+
+    # Only the latest exchange is kept verbatim
+    monkeypatch.setattr(models.compaction, "CHAT_COMPACTION_KEEP_TOKENS", 1)
+    return _prompts
+
+def run(case):
+    async def _main():
+        _db_conn = History(types.SimpleNamespace(loop=asyncio.get_running_loop()), backend="memory")
+        await case(_db_conn)
+    asyncio.run(_main())
+
+def exchanges(start: int, end: int) -> list:
+    _turns = []
+    for _index in range(start, end):
+        _turns.append({"role": "user", "parts": [{"text": f"question {_index}"}]})
+        _turns.append({"role": "model", "parts": [{"text": f"answer {_index}"}]})
+    return _turns
+
+def test_truncated_thread_is_summarized_entirely(summarizer, monkeypatch):
+    monkeypatch.setattr(models.context_window, "CHAT_THREAD_MAX_TURNS", 6)
+
+    async def case(db_conn):
+        await save_history(1, "google", exchanges(0, 20), db_conn, "google")
+        await models.compaction.compact_history(1, "google", "google", db_conn)
+
+        # Turns older than the window are part of the summary
+        assert "question 0" in summarizer[0] and "question 18" in summarizer[0]
+        assert "question 19" not in summarizer[0]
+
+        _records = await db_conn.load_thread(1, "google")
+        assert [_record["seq"] for _record in _records] == [0, 1, 38, 39]
+        assert _records[0]["turn"]["_meta"]["compacted"] == [[0, 37]]
+
+        # The summary stays pinned when the window is truncated again
+        await save_history(1, "google", (await load_history(1, "google", db_conn, "google")) + exchanges(20, 25), db_conn, "google")
+        _history = await load_history(1, "google", db_conn, "google")
+        assert _history[0]["_meta"]["summary"] and _history[0]["_meta"]["seq"] == 0
+        assert [_turn["_meta"]["seq"] for _turn in _history[2:]] == [44, 45, 46, 47, 48, 49]
+    run(case)
+
+def test_compacting_again_covers_previous_summary(summarizer):
+    async def case(db_conn):
+        _system_turn = {"role": "system", "content": "You are Jakey"}
+        _turns = [_system_turn]
+        for _index in range(5):
+            _turns.append({"role": "user", "content": [{"type": "text", "text": f"question {_index}"}]})
+            _turns.append({"role": "assistant", "content": f"answer {_index}"})
+        await save_history(1, "openai", _turns, db_conn, "openai")
+
+        await models.compaction.compact_history(1, "openai", "openai", db_conn)
+        assert [_record["seq"] for _record in await db_conn.load_thread(1, "openai")] == [0, 1, 2, 9, 10]
+
+        await save_history(1, "openai", (await load_history(1, "openai", db_conn, "openai")) + [
+            {"role": "user", "content": [{"type": "text", "text": "question 5"}]},
+            {"role": "assistant", "content": "answer 5"}
+        ], db_conn, "openai")
+        await models.compaction.compact_history(1, "openai", "openai", db_conn)
+
+        assert "conversation_summary" in summarizer[1] and "question 4" in summarizer[1]
+        _records = await db_conn.load_thread(1, "openai")
+        assert [_record["seq"] for _record in _records] == [0, 1, 2, 11, 12]
+        assert _records[1]["turn"]["_meta"]["compacted"] == [[1, 8], [1, 10]]
+    run(case)
+
+def test_stale_save_does_not_overwrite_summary(summarizer):
+    async def case(db_conn):
+        await save_history(1, "google", exchanges(0, 5), db_conn, "google")
+
+        # A request loads the thread, then it's compacted before the request saves
+        _stale_history = await load_history(1, "google", db_conn, "google")
+        await models.compaction.compact_history(1, "google", "google", db_conn)
+
+        _stale_history[0]["parts"][0]["text"] = "edited question 0"
+        _stale_history[0]["_meta"]["dirty"] = True
+        _stale_history[9]["parts"][0]["text"] = "edited answer 4"
+        _stale_history[9]["_meta"]["dirty"] = True
+        await save_history(1, "google", _stale_history + exchanges(5, 6), db_conn, "google")
+
+        _records = await db_conn.load_thread(1, "google")
+        assert _records[0]["turn"]["_meta"]["summary"]
+        assert [_record["seq"] for _record in _records] == [0, 1, 8, 9, 10, 11]
+
+        # Turns after the compacted range are still written back
+        _history = await load_history(1, "google", db_conn, "google")
+        assert _history[3]["parts"][0]["text"] == "edited answer 4"
+    run(case)
@@ -0,0 +1,148 @@
+from models.context_cache import GeminiContextCache, inline_request_config, prompt_cache_key
+import asyncio
+import datetime
+import models.context_cache
+import pytest
+import types
+
+# Gemini context caches against a stub of client.aio.caches
+
+SYSTEM_PROMPT = "You are Jakey. " * 400
+TOOLS = [{"function_declarations": [{"name": "web_search", "description": "Search the web"}]}]
+
+class StubCaches:
+    def __init__(self, clock):
+        self._clock = clock
+        self.created = []
+        self.updated = []
+        self.fail_create = False
+
+    async def create(self, model: str, config: dict):
+        if self.fail_create:
+            raise RuntimeError("Cached content is too small")
+        self.created.append((model, config))
+        return types.SimpleNamespace(name=f"cachedContents/{len(self.created)}", expire_time=self._expire_time(config["ttl"]))
+
+    async def update(self, name: str, config: dict):
+        self.updated.append((name, config))
+        return types.SimpleNamespace(name=name, expire_time=self._expire_time(config["ttl"]))
+
+    def _expire_time(self, ttl: str):
+        return datetime.datetime.fromtimestamp(self._clock[0] + int(ttl.rstrip("s")), tz=datetime.timezone.utc)
+
+@pytest.fixture
+def clock(monkeypatch):
+    _clock = [1_000_000.0]
+    monkeypatch.setattr(models.context_cache, "time", types.SimpleNamespace(time=lambda: _clock[0]))
+    return _clock
+
+@pytest.fixture
+def client(clock):
+    return types.SimpleNamespace(aio=types.SimpleNamespace(caches=StubCaches(clock)))
+
+def test_created_on_first_use_and_reused(client):
+    _cache = GeminiContextCache(ttl=3600, min_tokens=10)
+
+    async def case():
+        _name = await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS)
+        assert _name == "cachedContents/1"
+        assert client.aio.caches.created[0][1]["system_instruction"] == SYSTEM_PROMPT
+        assert client.aio.caches.created[0][1]["tools"] == TOOLS
+
+        # Same model, system prompt and tools
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, list(TOOLS)) == _name
+
+        # A different model, prompt or tools get their own cache
+        assert await _cache.get(client, "gemini-2.5-pro", SYSTEM_PROMPT, TOOLS) == "cachedContents/2"
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT + "!", TOOLS) == "cachedContents/3"
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, []) == "cachedContents/4"
+    asyncio.run(case())
+
+    assert _cache.stats()["created"] == 4 and _cache.stats()["hits"] == 1
+
+def test_small_prefixes_are_sent_inline(client):
+    _cache = GeminiContextCache(ttl=3600, min_tokens=10_000)
+    assert asyncio.run(_cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS)) is None
+    assert not client.aio.caches.created and _cache.stats()["skipped"] == 1
+
+def test_ttl_is_renewed_once_half_passed(client, clock):
+    _cache = GeminiContextCache(ttl=3600, min_tokens=10)
+
+    async def case():
+        _name = await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS)
+
+        clock[0] += 1000
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) == _name
+        assert not client.aio.caches.updated
+
+        clock[0] += 1000
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) == _name
+        assert client.aio.caches.updated == [(_name, {"ttl": "3600s"})]
+
+        # The renewed expiry is used from now on
+        clock[0] += 2000
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) == _name
+        assert len(client.aio.caches.created) == 1
+    asyncio.run(case())
+
+def test_expired_and_invalidated_caches_are_recreated(client, clock):
+    _cache = GeminiContextCache(ttl=3600, min_tokens=10)
+
+    async def case():
+        _name = await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS)
+
+        _cache.invalidate(_name)
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) == "cachedContents/2"
+
+        # Too close to expiring to be used for a request
+        clock[0] += 3600 - 30
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) == "cachedContents/3"
+    asyncio.run(case())
+
+def test_failed_creation_falls_back_inline(client, clock):
+    _cache = GeminiContextCache(ttl=3600, min_tokens=10)
+    client.aio.caches.fail_create = True
+
+    async def case():
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) is None
+
+        # Not retried right away
+        client.aio.caches.fail_create = False
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) is None
+        assert not client.aio.caches.created
+
+        clock[0] += models.context_cache.GEMINI_CONTEXT_CACHE_RETRY_AFTER + 1
+        assert await _cache.get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS) == "cachedContents/1"
+    asyncio.run(case())
+
+    assert _cache.stats()["failed"] == 1
+
+def test_request_config(client):
+    _cache = GeminiContextCache(ttl=3600, min_tokens=10)
+    _params = {"temperature": 0.5, "tools": TOOLS}
+
+    async def case():
+        # The cached content replaces the system instruction and tools
+        _config, _cached_content = await _cache.request_config(client, "gemini-2.5-flash", SYSTEM_PROMPT, _params)
+        assert _config == {"temperature": 0.5, "cached_content": "cachedContents/1"}
+        assert _cached_content == "cachedContents/1"
+
+        # Both are sent inline when the cache can't be created
+        client.aio.caches.fail_create = True
+        _config, _cached_content = await _cache.request_config(client, "gemini-2.5-pro", SYSTEM_PROMPT, _params)
+        assert _config == {"system_instruction": SYSTEM_PROMPT, "temperature": 0.5, "tools": TOOLS}
+        assert _cached_content is None
+        assert _config == inline_request_config(SYSTEM_PROMPT, _params)
+    asyncio.run(case())
+
+def test_disabled_without_ttl_or_prefix(client):
+    assert asyncio.run(GeminiContextCache(ttl=0, min_tokens=10).get(client, "gemini-2.5-flash", SYSTEM_PROMPT, TOOLS)) is None
+    assert asyncio.run(GeminiContextCache(ttl=3600, min_tokens=10).get(client, "gemini-2.5-flash")) is None
+    assert not client.aio.caches.created
+
+def test_prompt_cache_key():
+    _key = prompt_cache_key("gpt-4.1", SYSTEM_PROMPT, TOOLS)
+    assert _key == prompt_cache_key("gpt-4.1", SYSTEM_PROMPT, [dict(_tool) for _tool in TOOLS])
+    assert _key != prompt_cache_key("gpt-4.1-mini", SYSTEM_PROMPT, TOOLS)
+    assert _key != prompt_cache_key("gpt-4.1", SYSTEM_PROMPT + "!", TOOLS)
+    assert _key != prompt_cache_key("gpt-4.1", SYSTEM_PROMPT, None)
@@ -0,0 +1,179 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from core.http_cache import CachedClientSession, CachedResponse, HTTPCacheStore
+from yarl import URL
+import aiohttp
+import asyncio
+import core.http_cache
+import os
+import pytest
+
+# The HTTP cache in core/http_cache.py against a local aiohttp server
+
+LARGE_TEXT = "".join(f"{_index:08x}" for _index in range(40000))
+
+# Bodies that don't compress, about 4 KB each when stored
+ITEMS = {_name: os.urandom(4000).hex() for _name in ("a", "b", "c")}
+
+def create_app(hits: dict) -> web.Application:
+    def count(request: web.Request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+
+    async def etag(request: web.Request):
+        count(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304, headers={"ETag": '"v1"', "Cache-Control": "max-age=60", "X-Revalidated": "yes", "Content-Type": "text/html"})
+        return web.Response(text="version 1", content_type="application/json", headers={"ETag": '"v1"', "Cache-Control": "no-cache", "X-Revalidated": "no"})
+
+    async def vary(request: web.Request):
+        count(request)
+        return web.Response(text=f"hello in {request.headers.get('Accept-Language')}", headers={"Vary": "Accept-Language", "Cache-Control": "max-age=60"})
+
+    async def auth(request: web.Request):
+        count(request)
+        return web.Response(text=f"results for {request.headers.get('X-API-Key')}", headers={"Cache-Control": "max-age=60"})
+
+    async def item(request: web.Request):
+        count(request)
+        return web.Response(text=ITEMS[request.match_info["name"]], headers={"Cache-Control": "max-age=60"})
+
+    async def large(request: web.Request):
+        count(request)
+        _response = web.StreamResponse(headers={"Content-Type": "text/plain", "Cache-Control": "max-age=60"})
+        _response.enable_chunked_encoding()
+        await _response.prepare(request)
+        for _offset in range(0, len(LARGE_TEXT), 50000):
+            await _response.write(LARGE_TEXT[_offset:_offset + 50000].encode("ascii"))
+        await _response.write_eof()
+        return _response
+
+    async def attachment(request: web.Request):
+        count(request)
+        return web.json_response({"file": "attachment"}, headers={"Cache-Control": "max-age=60"})
+
+    _app = web.Application()
+    _app.router.add_get("/etag", etag)
+    _app.router.add_get("/vary", vary)
+    _app.router.add_get("/auth", auth)
+    _app.router.add_get("/item/{name}", item)
+    _app.router.add_get("/large", large)
+    _app.router.add_get("/attachment", attachment)
+    return _app
+
+@pytest.fixture
+def run_case(tmp_path):
+    def _run(case, max_bytes: int = 1024 * 1024):
+        async def _main():
+            _hits = {}
+            _server = TestServer(create_app(_hits))
+            await _server.start_server()
+            _session = CachedClientSession(aiohttp.ClientSession(), HTTPCacheStore(str(tmp_path / "http_cache.db"), max_bytes=max_bytes))
+            try:
+                await case(_session, lambda path: str(_server.make_url(path)), _hits)
+            finally:
+                await _session.close()
+                await _server.close()
+        asyncio.run(_main())
+    return _run
+
+def test_revalidation_merges_304_headers(run_case):
+    async def case(session, url, hits):
+        async with session.get(url("/etag")) as _response:
+            assert await _response.text() == "version 1"
+            assert not _response.from_cache
+
+        # Stored but stale, the server answers with a 304
+        async with session.get(url("/etag")) as _response:
+            assert _response.from_cache
+            assert await _response.text() == "version 1"
+            assert _response.headers["X-Revalidated"] == "yes"
+            assert _response.headers["Cache-Control"] == "max-age=60"
+
+            # The stored body keeps its own content type
+            assert _response.content_type == "application/json"
+        assert hits["/etag"] == 2 and session.stats()["revalidated"] == 1
+
+        # Fresh after the 304 extended it
+        async with session.get(url("/etag")) as _response:
+            assert _response.headers["X-Revalidated"] == "yes"
+        assert hits["/etag"] == 2
+    run_case(case)
+
+def test_vary_headers_are_matched(run_case):
+    async def case(session, url, hits):
+        for _language, _expected_hits in (("en", 1), ("en", 1), ("fr", 2), ("fr", 2)):
+            async with session.get(url("/vary"), headers={"Accept-Language": _language}) as _response:
+                assert await _response.text() == f"hello in {_language}"
+            assert hits["/vary"] == _expected_hits
+    run_case(case)
+
+def test_responses_are_keyed_by_credentials(run_case):
+    async def case(session, url, hits):
+        for _api_key in ("first", "second", "first", "second"):
+            async with session.get(url("/auth"), headers={"X-API-Key": _api_key}) as _response:
+                assert await _response.text() == f"results for {_api_key}"
+        assert hits["/auth"] == 2
+
+        async with session.get(url("/auth"), headers={"Authorization": "Bearer token"}) as _response:
+            assert await _response.text() == "results for None"
+        assert hits["/auth"] == 3
+    run_case(case)
+
+def test_least_recently_used_responses_are_evicted(run_case, monkeypatch):
+    # Record every access
+    monkeypatch.setattr(core.http_cache, "_TOUCH_INTERVAL", -1)
+
+    async def case(session, url, hits):
+        for _name in ("a", "b", "a", "c"):
+            async with session.get(url(f"/item/{_name}")) as _response:
+                assert await _response.text() == ITEMS[_name]
+        assert session.stats()["evictions"] == 1
+
+        # b wasn't used since it was stored
+        for _name in ("a", "c", "b"):
+            async with session.get(url(f"/item/{_name}")) as _response:
+                await _response.read()
+        assert hits == {"/item/a": 1, "/item/b": 2, "/item/c": 1}
+        assert session.stats()["bytes"] <= session.stats()["max_bytes"]
+    # Room for two responses
+    run_case(case, max_bytes=10000)
+
+def test_partial_reads(run_case):
+    async def case(session, url, hits):
+        await (await session.get(url("/item/a"))).read()
+        _response = await session.get(url("/item/a"))
+        assert isinstance(_response, CachedResponse) and _response.from_cache
+
+        _body = ITEMS["a"].encode("ascii")
+        assert await _response.content.read(3) == _body[:3]
+        assert await _response.content.read(3) == _body[3:6]
+        assert not _response.content.at_eof()
+        assert await _response.content.read() == _body[6:]
+        assert _response.content.at_eof()
+        _response.release()
+    run_case(case)
+
+def test_large_bodies_are_streamed_without_storing(run_case, monkeypatch):
+    monkeypatch.setattr(core.http_cache, "HTTP_CACHE_MAX_ENTRY_BYTES", 100000)
+
+    async def case(session, url, hits):
+        async with session.get(url("/large")) as _response:
+            # The buffered beginning followed by the rest of the response
+            _chunks = [_chunk async for _chunk in _response.content.iter_chunked(30000)]
+            assert b"".join(_chunks).decode("ascii") == LARGE_TEXT
+            assert _response.content.at_eof()
+
+        async with session.get(url("/large")) as _response:
+            assert not _response.from_cache
+            assert await _response.text() == LARGE_TEXT
+        assert hits["/large"] == 2 and session.stats()["stored"] == 0
+    run_case(case)
+
+def test_discord_attachments_are_not_stored(run_case, monkeypatch):
+    async def case(session, url, hits):
+        monkeypatch.setattr(core.http_cache, "_UNCACHED_HOSTS", (URL(url("/")).host,))
+        for _ in range(2):
+            async with session.get(url("/attachment")) as _response:
+                assert await _response.json() == {"file": "attachment"}
+        assert hits["/attachment"] == 2 and session.stats()["stored"] == 0
+    run_case(case)
@@ -0,0 +1,149 @@
+from models.turns import decode_turn, encode_turn, is_compact_turn
+import base64
+import models.turns
+import pytest
+
+# Round trips of the compact turn format in models/turns.py
+
+requires_zstd = pytest.mark.skipif(models.turns.zstandard is None or not models.turns.CHAT_TURN_COMPRESS_MIN_BYTES, reason="zstandard is not installed")
+
+LARGE_TEXT = "The quick brown fox jumps over the lazy dog. " * 500
+
+def roundtrip(turn: dict, sdk: str) -> dict:
+    _doc = encode_turn(turn, sdk)
+    assert is_compact_turn(_doc)
+    return decode_turn(_doc, sdk)
+
+############################################
+# Gemini
+############################################
+def test_google_user_turn():
+    _turn = {
+        "role": "user",
+        "parts": [
+            {"file_data": {"file_uri": "https://files/abc", "mime_type": "application/pdf"}, "_meta": {"expires_at": 123.0}},
+            {"text": "What is in this file?"}
+        ],
+        "_meta": {"tokens": 42}
+    }
+    assert roundtrip(_turn, "google") == _turn
+
+def test_google_model_turn_drops_thoughts():
+    _turn = {
+        "role": "model",
+        "parts": [
+            {"thought": True, "text": "Let me think about it"},
+            {"text": "Let me search for that", "thought_signature": b"signature"},
+            {"function_call": {"name": "web_search", "args": {"query": "weather"}, "id": "call_1"}}
+        ]
+    }
+    assert roundtrip(_turn, "google") == {
+        "role": "model",
+        "parts": [
+            {"text": "Let me search for that"},
+            {"function_call": {"name": "web_search", "args": {"query": "weather"}, "id": "call_1"}}
+        ]
+    }
+
+def test_google_thought_only_turn_is_not_stored():
+    _turn = {"role": "model", "parts": [{"thought": True, "text": "Hmm"}]}
+    assert encode_turn(_turn, "google") is None
+
+    # Turns stored without parts before they were skipped
+    assert decode_turn({"v": 1, "r": "assistant", "p": []}, "google") is None
+
+def test_google_function_response_turn():
+    _turn = {
+        "role": "user",
+        "parts": [
+            {"function_response": {"name": "web_search", "response": {"api_result": "sunny"}, "id": "call_1"}},
+            {"function_response": {"name": "url_browse", "response": {"api_result": "page"}}}
+        ]
+    }
+    _doc = encode_turn(_turn, "google")
+    assert _doc["r"] == "tool"
+    assert decode_turn(_doc, "google") == _turn
+
+def test_google_bare_tool_part():
+    _turn = {"function_response": {"name": "web_search", "response": {"api_result": "sunny"}}, "_meta": {"tokens": 10}}
+    _doc = encode_turn(_turn, "google")
+    assert _doc["b"] is True
+    assert decode_turn(_doc, "google") == _turn
+
+def test_google_inline_data():
+    _turn = {"role": "user", "parts": [{"inline_data": {"mime_type": "image/png", "data": b"\x89PNG\r\n\x1a\n"}}, {"text": "Describe it"}]}
+    assert roundtrip(_turn, "google") == _turn
+
+@requires_zstd
+def test_google_compressed_parts():
+    _turn = {
+        "role": "user",
+        "parts": [
+            {"inline_data": {"mime_type": "text/plain", "data": LARGE_TEXT.encode("utf-8")}},
+            {"text": LARGE_TEXT}
+        ]
+    }
+    _doc = encode_turn(_turn, "google")
+    assert "iz" in _doc["p"][0] and "tz" in _doc["p"][1]
+    assert decode_turn(_doc, "google") == _turn
+
+@requires_zstd
+def test_google_compressed_function_response():
+    _turn = {"role": "user", "parts": [{"function_response": {"name": "url_browse", "response": {"api_result": LARGE_TEXT}}}]}
+    _doc = encode_turn(_turn, "google")
+    assert "rz" in _doc["p"][0]
+    assert decode_turn(_doc, "google") == _turn
+
+############################################
+# OpenAI
+############################################
+def test_openai_system_and_assistant_turns():
+    for _turn in ({"role": "system", "content": "You are Jakey"}, {"role": "assistant", "content": "Hello!"}):
+        assert roundtrip(_turn, "openai") == _turn
+
+def test_openai_user_turn_with_image():
+    _data_url = f"data:image/jpeg;base64,{base64.b64encode(b'jpeg bytes').decode('ascii')}"
+    _turn = {
+        "role": "user",
+        "content": [
+            {"type": "image_url", "image_url": {"url": _data_url}},
+            {"type": "image_url", "image_url": {"url": "https://example.com/cat.png"}},
+            {"type": "text", "text": "What are these?"}
+        ],
+        "_meta": {"tokens": 2100}
+    }
+    _doc = encode_turn(_turn, "openai")
+
+    # Data URLs are stored as bytes
+    assert _doc["p"][0]["i"] == b"jpeg bytes"
+    assert decode_turn(_doc, "openai") == _turn
+
+def test_openai_tool_calls_and_results():
+    _call_turn = {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{"id": "call_1", "type": "function", "function": {"name": "web_search", "arguments": "{\"query\": \"weather\"}"}}]
+    }
+    assert roundtrip(_call_turn, "openai") == _call_turn
+
+    _result_turn = {"role": "tool", "tool_call_id": "call_1", "content": "sunny"}
+    assert roundtrip(_result_turn, "openai") == _result_turn
+
+@requires_zstd
+def test_openai_compressed_parts():
+    _turn = {"role": "user", "content": [{"type": "text", "text": LARGE_TEXT}]}
+    _doc = encode_turn(_turn, "openai")
+    assert "tz" in _doc["p"][0]
+    assert decode_turn(_doc, "openai") == _turn
+
+    _result_turn = {"role": "tool", "tool_call_id": "call_1", "content": LARGE_TEXT}
+    _doc = encode_turn(_result_turn, "openai")
+    assert "rz" in _doc["p"][0]
+    assert decode_turn(_doc, "openai") == _result_turn
+
+############################################
+# Legacy turns
+############################################
+def test_legacy_turns_pass_through():
+    _turn = {"role": "user", "parts": [{"text": "Stored before the compact format"}]}
+    assert decode_turn(_turn, "google") is _turn
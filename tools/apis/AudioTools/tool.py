@@ -1,5 +1,6 @@
 from models.tasks.media.fal_ai import run_audio
 from os import environ
+from tools.runtime import ToolDiscordStateBase
 import aiohttp
 import datetime
 import discord
@@ -8,11 +9,7 @@ import io
 import logging
 
 # Function implementations
-class Tools:
-    def __init__(self, discord_message, discord_bot):
-        self.discord_message = discord_message
-        self.discord_bot = discord_bot
-
+class Tools(ToolDiscordStateBase):
     # Audio generator
     async def tool_text_to_speech(self, text: str, voice: str = "Brian", style: float = 0.5):
         # Create audio       
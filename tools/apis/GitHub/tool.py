@@ -1,15 +1,12 @@
 from os import environ
+from tools.runtime import ToolDiscordStateBase
 import aiohttp
 import base64
 import html
 import re
 
 # Function implementations
-class Tools:
-    def __init__(self, discord_message, discord_bot):
-        self.discord_message = discord_message
-        self.discord_bot = discord_bot
-    
+class Tools(ToolDiscordStateBase):
     # A method to extract relevant result from GitHub API to only extract the necessary information
     # https://docs.github.com/en/rest/search/search?apiVersion=2022-11-28#about-search
     async def _search_extractor(self, search_type: str, search_result: dict):
@@ -1,4 +1,5 @@
 from models.tasks.media.fal_ai import run_image
+from tools.runtime import ToolDiscordStateBase
 import aiohttp
 import datetime
 import discord
@@ -6,11 +7,7 @@ import filetype
 import io
 import logging
 
-class Tools:
-    def __init__(self, discord_message, discord_bot):
-        self.discord_message = discord_message
-        self.discord_bot = discord_bot
-
+class Tools(ToolDiscordStateBase):
     # Image generator
     async def tool_imagen_image_gen(self, prompt: str, aspect_ratio: str = "1:1", resolution: str = "1K", negative_prompt: str = None):
         # Create image
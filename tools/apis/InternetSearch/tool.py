@@ -1,15 +1,12 @@
 from os import environ
+from tools.runtime import ToolDiscordStateBase
 import aiohttp
 import discord
 import io
 import logging
 
 # Function implementations
-class Tools:
-    def __init__(self, discord_message, discord_bot):
-        self.discord_message = discord_message
-        self.discord_bot = discord_bot
-
+class Tools(ToolDiscordStateBase):
     async def tool_web_search(self, query: str, search_depth: str = "basic", max_results: int = 5, include_domains: list = None, exclude_domains: list = None, show_sources_list: bool = False):
         if not query or not query.strip():
             raise ValueError("query parameter is required and cannot be empty")
@@ -77,6 +74,14 @@ class Tools:
             "results": _searchResults["results"]
         }
         
+        await self._send_web_search_status(query, _searchResults["results"], search_depth, show_sources_list)
+        return _output
+
+    # Cached results are reused for the same search, the sources still need to be shown
+    async def replay_web_search(self, result: dict, query: str, search_depth: str = "basic", show_sources_list: bool = False, **kwargs):
+        await self._send_web_search_status(query, result["results"], search_depth, show_sources_list)
+
+    async def _send_web_search_status(self, query: str, results: list, search_depth: str, show_sources_list: bool):
          # Embed that contains first 10 sources
         if show_sources_list:
             _sembed = discord.Embed(
@@ -85,7 +90,7 @@ class Tools:
 
             # Iterate description
             _desclinks = []
-            for _results in _searchResults["results"]:
+            for _results in results:
                 if len(_desclinks) <= 10:
                     _desclinks.append(f"- [{_results.get('title', 'url').replace('/', ' ')}]({_results['url']})")
                 else:
@@ -96,8 +101,6 @@ class Tools:
         else:
             _sembed = None
         await self.discord_message.channel.send(f"🔍 Searched for **{query}**", embed=_sembed)
-        
-        return _output
 
     async def tool_url_browse(self, url: str):
         # Powered by Jina AI
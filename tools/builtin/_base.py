@@ -1,6 +1,5 @@
-import discord
+from tools.runtime import ToolDiscordStateBase
 
-class BuiltInToolDiscordStateBase:
-    def __init__(self, discord_message, discord_bot):
-        self.discord_message: discord.Message = discord_message
-        self.discord_bot: discord.Bot = discord_bot
+# Built-in tools share the same pooled instances and request context as agent tools
+class BuiltInToolDiscordStateBase(ToolDiscordStateBase):
+    pass
@@ -0,0 +1,14 @@
+from tools.builtin._base import BuiltInToolDiscordStateBase
+
+# Built-in tools regardless of tool selection unless Disabled
+class BuiltInTool(BuiltInToolDiscordStateBase):
+    async def tool_fetch_archived_tool_output(self, archive_id: str):
+        # Set by the Chat cog
+        _history_db = getattr(self.discord_bot, "history_db", None)
+        if not _history_db:
+            raise Exception("Chat history is not available at the moment")
+
+        _archived = await _history_db.get_archive(self.discord_message.author.id, f"tool_output:{archive_id}")
+        if _archived is None:
+            raise ValueError(f"No archived tool output found with archive_id {archive_id}, it may have been cleared along with the chat history")
+        return _archived
@@ -0,0 +1,159 @@
+from core.config import config_registry
+from types import MappingProxyType
+from typing import NamedTuple
+import logging
+import os
+
+# Tool manifests are scanned once when this module is imported and kept in the config registry
+# so edited manifests are reloaded, schemas are built per (agent, provider format) on first use
+TOOLS_APIS_PATH = "tools/apis"
+TOOLS_BUILTIN_PATH = "tools/builtin"
+
+# How the bot runs a tool, set next to the tool's name in the manifest and never sent to the model
+class ToolOptions(NamedTuple):
+    # Calls from the same turn run one at a time in the order the model made them, for tools that post to the channel
+    serialize: bool = False
+
+    # Maximum calls of this tool running at once across every request, None for no limit
+    max_concurrency: int = None
+
+    # Seconds results are reused for calls with the same arguments, only for tools without side effects
+    cache_ttl: float = None
+
+# Option name -> validator
+_OPTION_VALIDATORS = {
+    "serialize": lambda value: isinstance(value, bool),
+    "max_concurrency": lambda value: isinstance(value, int) and not isinstance(value, bool) and value > 0,
+    "cache_ttl": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+}
+
+class ToolManifest(NamedTuple):
+    # Human friendly name shown in /agent, None for built-in tools
+    tool_name: str
+
+    # Function declarations as sent to the model
+    declarations: tuple
+    names: frozenset
+
+    # Tool name -> ToolOptions
+    options: MappingProxyType
+
+def _parse_options(declaration: dict, path: str) -> ToolOptions:
+    _options = {}
+    for _option, _validator in _OPTION_VALIDATORS.items():
+        if _option not in declaration:
+            continue
+        if _validator(declaration[_option]):
+            _options[_option] = declaration[_option]
+        else:
+            logging.error("Ignoring invalid %s of tool %s in %s", _option, declaration["name"], path)
+    return ToolOptions(**_options)
+
+# Returns the declarations that have a name and the options of each, invalid entries are logged and skipped
+def _validate_declarations(declarations, path: str) -> tuple:
+    _valid = []
+    _options = {}
+    for _index, _declaration in enumerate(declarations or []):
+        if not isinstance(_declaration, dict) or not _declaration.get("name"):
+            logging.error("Skipping tool %s in %s, it doesn't have a name", _index, path)
+            continue
+        if _declaration["name"] in _options:
+            logging.error("Skipping tool %s in %s, its name is already used", _declaration["name"], path)
+            continue
+
+        _options[_declaration["name"]] = _parse_options(_declaration, path)
+        _valid.append({_key: _value for _key, _value in _declaration.items() if _key not in _OPTION_VALIDATORS})
+    return tuple(_valid), _options
+
+def _build_manifest(tool_name: str, declarations: tuple, options: dict) -> ToolManifest:
+    _names = frozenset(_declaration["name"] for _declaration in declarations)
+    return ToolManifest(
+        tool_name,
+        declarations,
+        _names,
+        MappingProxyType({_name: _value for _name, _value in options.items() if _name in _names})
+    )
+
+def _agent_manifest_parser(path: str):
+    def _parse(data) -> ToolManifest:
+        if not isinstance(data, dict) or not data.get("tool_name"):
+            logging.error("The tool manifest %s does not have a tool_name", path)
+            return None
+
+        return _build_manifest(data["tool_name"], *_validate_declarations(data.get("tool_list"), path))
+    return _parse
+
+def _parse_builtin_manifest(data) -> ToolManifest:
+    _path = f"{TOOLS_BUILTIN_PATH}/manifest.yaml"
+    _declarations = []
+    _valid, _options = _validate_declarations((data or {}).get("builtin_tool_list"), _path)
+    for _declaration in _valid:
+        # Built-in tools are only declared if they can be imported
+        if not os.path.isfile(f"{TOOLS_BUILTIN_PATH}/tools/{_declaration['name']}.py"):
+            logging.error("Skipping built-in tool %s, %s/tools/%s.py does not exist", _declaration["name"], TOOLS_BUILTIN_PATH, _declaration["name"])
+            continue
+        _declarations.append(_declaration)
+    return _build_manifest(None, tuple(_declarations), _options)
+
+# Agents in the order they're listed in /agent
+_agents = []
+
+def _scan_tools():
+    config_registry.register("tool_manifest:builtin", f"{TOOLS_BUILTIN_PATH}/manifest.yaml", _parse_builtin_manifest, optional=True)
+
+    if not os.path.isdir(TOOLS_APIS_PATH):
+        return
+
+    for _agent in sorted(os.listdir(TOOLS_APIS_PATH)):
+        # Folders starting with __pycache__ or . are not tools
+        if _agent.startswith("__") or _agent.startswith("."):
+            continue
+
+        # Check if it has manifest.yaml file
+        _path = f"{TOOLS_APIS_PATH}/{_agent}/manifest.yaml"
+        if not os.path.isfile(_path):
+            logging.error("The tool %s does not have manifest.yaml file", _agent)
+            continue
+
+        config_registry.register(f"tool_manifest:{_agent}", _path, _agent_manifest_parser(_path))
+        _agents.append(_agent)
+
+_scan_tools()
+
+# Ready to send schemas by (agent, provider format), cleared when a manifest changes
+_schemas = {}
+
+def get_agent_manifest(tool_api_name: str) -> ToolManifest:
+    if tool_api_name not in _agents:
+        return None
+    return config_registry.get(f"tool_manifest:{tool_api_name}")
+
+def get_builtin_manifest() -> ToolManifest:
+    return config_registry.get("tool_manifest:builtin")
+
+# Agents with a valid manifest as (directory name, tool_name)
+def get_agents() -> list:
+    return [(_agent, _manifest.tool_name) for _agent in _agents if (_manifest := get_agent_manifest(_agent))]
+
+# Returns the agent and built-in tool declarations in the provider's format
+# The list is shared between requests and must not be modified
+def get_tool_schema(tool_api_name: str, tool_type: str) -> list:
+    _agent_manifest = None
+    _versions = (config_registry.version("tool_manifest:builtin"),)
+    if tool_api_name:
+        _agent_manifest = get_agent_manifest(tool_api_name)
+        _versions += (config_registry.version(f"tool_manifest:{tool_api_name}"),)
+
+    _key = (tool_api_name, tool_type)
+    _cached = _schemas.get(_key)
+    if _cached and _cached[0] == _versions:
+        return _cached[1]
+
+    _declarations = (_agent_manifest.declarations if _agent_manifest else ()) + get_builtin_manifest().declarations
+    if tool_type == "openai":
+        _schema = [{"type": "function", "function": _declaration} for _declaration in _declarations]
+    else:
+        _schema = list(_declarations)
+
+    _schemas[_key] = (_versions, _schema)
+    return _schema
@@ -0,0 +1,105 @@
+from core.cache import TTLCache
+from os import environ
+import asyncio
+import hashlib
+import inspect
+import json
+import logging
+
+# Results of idempotent tools by (tool, normalized arguments), shared by every user
+# Tools opt in with cache_ttl in their manifest entry, identical calls running at the same time
+# share a single upstream call and only successful results are cached
+TOOL_RESULT_CACHE_MAX_ENTRIES = int(environ.get("TOOL_RESULT_CACHE_MAX_ENTRIES", 1024))
+TOOL_RESULT_CACHE_MAX_BYTES = int(environ.get("TOOL_RESULT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+class ToolResultCache:
+    def __init__(self, max_entries: int = TOOL_RESULT_CACHE_MAX_ENTRIES, max_bytes: int = TOOL_RESULT_CACHE_MAX_BYTES):
+        # Results are stored serialized so callers can't modify the cached value and sizes are known
+        self._results = TTLCache(max_entries=max_entries, ttl=0, max_bytes=max_bytes)
+
+        # key -> future of the call in flight
+        self._in_flight = {}
+
+        # coroutine -> signature, used to fill in default arguments
+        self._signatures = {}
+
+        # Counters
+        self.coalesced = 0
+        self.uncacheable = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._results.max_entries > 0
+
+    def stats(self) -> dict:
+        return {
+            **self._results.stats(),
+            "in_flight": len(self._in_flight),
+            "coalesced": self.coalesced,
+            "uncacheable": self.uncacheable
+        }
+
+    # Arguments with defaults filled in, unset values dropped and strings stripped so equivalent calls share a key
+    def _normalize(self, coroutine, arguments: dict) -> dict:
+        if coroutine not in self._signatures:
+            self._signatures[coroutine] = inspect.signature(coroutine)
+
+        try:
+            _bound = self._signatures[coroutine].bind(**arguments)
+            _bound.apply_defaults()
+            _arguments = _bound.arguments
+        except TypeError:
+            # Let the tool raise its own error
+            _arguments = arguments
+
+        return {
+            _name: _value.strip() if isinstance(_value, str) else _value
+            for _name, _value in _arguments.items()
+            if _value is not None
+        }
+
+    def make_key(self, name: str, coroutine, arguments: dict) -> str:
+        _serialized = json.dumps(self._normalize(coroutine, arguments), sort_keys=True, separators=(",", ":"), default=str)
+        return f"{name}:{hashlib.sha256(_serialized.encode('utf-8')).hexdigest()}"
+
+    # Returns (result, shared) where shared is True when the result came from the cache or another caller's call
+    async def get_or_call(self, key: str, ttl: float, call) -> tuple:
+        _serialized = self._results.get(key)
+        if _serialized is not None:
+            return json.loads(_serialized), True
+
+        if key in self._in_flight:
+            self.coalesced += 1
+            return json.loads(await asyncio.shield(self._in_flight[key])), True
+
+        _future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = _future
+        try:
+            _result = await call()
+            try:
+                _serialized = json.dumps(_result)
+            except (TypeError, ValueError):
+                # Not cached, callers that joined this call get a JSON copy with the values converted to strings
+                self.uncacheable += 1
+                logging.warning("The result of %s cannot be cached because it's not JSON serializable", key.split(":")[0])
+                _serialized = json.dumps(_result, default=str)
+            else:
+                self._results.set(key, _serialized, ttl=ttl, size=len(_serialized))
+            _future.set_result(_serialized)
+            return _result, False
+        except asyncio.CancelledError:
+            # Callers that joined this call get an error instead of being cancelled with it
+            _future.set_exception(RuntimeError("The tool call was cancelled"))
+            _future.exception()
+            raise
+        except Exception as _error:
+            # Callers that joined this call get the same error, errors are never cached
+            _future.set_exception(_error)
+
+            # Retrieve the exception so it's not reported as never retrieved when there are no followers
+            _future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+tool_result_cache = ToolResultCache()
@@ -0,0 +1,164 @@
+from core.config import config_registry
+from os import environ
+from tools.registry import ToolOptions, get_agent_manifest, get_builtin_manifest
+from tools.result_cache import tool_result_cache
+from types import MappingProxyType
+from typing import NamedTuple
+import asyncio
+import contextlib
+import contextvars
+import discord
+import importlib
+import logging
+
+# Tool classes are imported and constructed once and shared by every request, the Discord state of
+# the request calling a tool is passed as a ToolContext and read through ToolDiscordStateBase
+class ToolContext(NamedTuple):
+    discord_message: discord.Message
+    discord_bot: discord.Bot
+
+# Each task gets its own copy so concurrent requests never see each other's context
+_tool_context = contextvars.ContextVar("tool_context", default=None)
+
+# Base class of tool classes, discord_message and discord_bot are the ones of the request calling the tool
+class ToolDiscordStateBase:
+    @property
+    def discord_message(self) -> discord.Message:
+        _context = _tool_context.get()
+        return _context.discord_message if _context else None
+
+    @property
+    def discord_bot(self) -> discord.Bot:
+        _context = _tool_context.get()
+        return _context.discord_bot if _context else None
+
+class ToolFunction(NamedTuple):
+    name: str
+    coroutine: object
+
+    # Agent tools show a "Using" indicator, built-in tools don't
+    agentic: bool
+
+    # See ToolOptions
+    serialize: bool = False
+    cache_ttl: float = None
+
+    # Shared by every request, None when the tool has no max_concurrency
+    semaphore: asyncio.Semaphore = None
+
+    # Optional replay_<name>(result, **arguments) method of the tool, called instead of the tool when a
+    # cached result is used so the tool can send what it normally sends to the channel
+    replay: object = None
+
+class ToolDispatch(NamedTuple):
+    # Every tool name declared to the model
+    names: frozenset
+
+    # Tool name -> ToolFunction, declared tools without an implementation are missing
+    functions: MappingProxyType
+
+# Maximum tool calls running at once across every request, 0 disables the limit
+TOOL_CALL_CONCURRENCY = int(environ.get("TOOL_CALL_CONCURRENCY", 8))
+_call_semaphore = asyncio.Semaphore(TOOL_CALL_CONCURRENCY) if TOOL_CALL_CONCURRENCY > 0 else None
+
+# Module name -> pooled tool instance, None when the module failed to import
+_instances = {}
+
+# (tool name, max_concurrency) -> semaphore, kept across reloads unless the limit changes
+_semaphores = {}
+
+# Dispatch tables by agent, cleared when a manifest changes
+_dispatch = {}
+
+def _get_instance(module_name: str, class_name: str):
+    if module_name not in _instances:
+        try:
+            _instances[module_name] = getattr(importlib.import_module(module_name), class_name)()
+        except ModuleNotFoundError as e:
+            logging.error("I cannot import the tool because the module is not found: %s", e)
+            _instances[module_name] = None
+    return _instances[module_name]
+
+def _resolve(instance, name: str, agentic: bool, options: ToolOptions) -> ToolFunction:
+    _coroutine = getattr(instance, f"tool_{name}", None)
+    if _coroutine is None:
+        logging.error("The tool function tool_%s is not implemented", name)
+        return None
+
+    _semaphore = None
+    if options.max_concurrency:
+        _semaphore = _semaphores.setdefault((name, options.max_concurrency), asyncio.Semaphore(options.max_concurrency))
+    return ToolFunction(name, _coroutine, agentic, options.serialize, options.cache_ttl, _semaphore, getattr(instance, f"replay_{name}", None))
+
+# Returns the dispatch table of the agent and the built-in tools
+def get_tool_dispatch(tool_api_name: str) -> ToolDispatch:
+    if tool_api_name == "disabled":
+        tool_api_name = None
+
+    _versions = (config_registry.version("tool_manifest:builtin"),)
+    _agent_manifest = get_agent_manifest(tool_api_name) if tool_api_name else None
+    if _agent_manifest:
+        _versions += (config_registry.version(f"tool_manifest:{tool_api_name}"),)
+
+    _cached = _dispatch.get(tool_api_name)
+    if _cached and _cached[0] == _versions:
+        return _cached[1]
+
+    _names = set()
+    _functions = {}
+    _builtin_manifest = get_builtin_manifest()
+    for _name in _builtin_manifest.names:
+        _names.add(_name)
+        _instance = _get_instance(f"tools.builtin.tools.{_name}", "BuiltInTool")
+        if _instance and (_function := _resolve(_instance, _name, False, _builtin_manifest.options[_name])):
+            _functions[_name] = _function
+
+    # Agent tools take precedence over built-in tools with the same name
+    if _agent_manifest:
+        _names.update(_agent_manifest.names)
+        _instance = _get_instance(f"tools.apis.{tool_api_name}.tool", "Tools")
+        for _name in _agent_manifest.names:
+            if _instance and (_function := _resolve(_instance, _name, True, _agent_manifest.options[_name])):
+                _functions[_name] = _function
+
+    _tool_dispatch = ToolDispatch(frozenset(_names), MappingProxyType(_functions))
+    _dispatch[tool_api_name] = (_versions, _tool_dispatch)
+    return _tool_dispatch
+
+async def _invoke(function: ToolFunction, context: ToolContext, arguments: dict, serial_lock: asyncio.Lock = None):
+    async with contextlib.AsyncExitStack() as _stack:
+        # Wait for our turn before taking any slot so waiting calls don't block other requests
+        if function.serialize and serial_lock:
+            await _stack.enter_async_context(serial_lock)
+        if function.semaphore:
+            await _stack.enter_async_context(function.semaphore)
+        if _call_semaphore:
+            await _stack.enter_async_context(_call_semaphore)
+
+        _token = _tool_context.set(context)
+        try:
+            return await function.coroutine(**arguments)
+        finally:
+            _tool_context.reset(_token)
+
+# Calls the tool with the Discord state of the current request
+# serial_lock is shared by the calls of one turn so tools with serialize run one at a time
+async def call_tool(function: ToolFunction, context: ToolContext, arguments: dict, serial_lock: asyncio.Lock = None):
+    if not function.cache_ttl or not tool_result_cache.enabled:
+        return await _invoke(function, context, arguments, serial_lock)
+
+    _result, _shared = await tool_result_cache.get_or_call(
+        tool_result_cache.make_key(function.name, function.coroutine, arguments),
+        function.cache_ttl,
+        lambda: _invoke(function, context, arguments, serial_lock)
+    )
+
+    if _shared and function.replay:
+        _token = _tool_context.set(context)
+        try:
+            await function.replay(_result, **arguments)
+        except Exception:
+            logging.warning("Failed to replay the cached result of %s", function.name, exc_info=True)
+        finally:
+            _tool_context.reset(_token)
+    return _result